@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+"""
+Benchmarks the ingest pipeline (reading, decoding and handling frames and
+queueing the updates) without the server.
+
+Every capture is run through each stage in a fresh process so the peak memory
+of a stage isn't inflated by the ones before it:
+
+    read      pcap.read_frames only
+    decode    read + decoding the 802.11 headers
+    handle    read + decode + the handlers, into a single in memory store
+    pipeline  sniffer.read with the worker pool, database and update queue
+
+The stages build on each other, so the difference between two stages is the
+cost of the later one. Results can be saved as JSON and compared with an
+earlier run.
+
+NOTE: the pipeline stage clears the state tables in the wifi_map database,
+just like running wifi_map does.
+"""
+import argparse
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+
+import wifi_map
+from wmap_common import constants
+import wmap_common.models as models
+from wmap_sniffer import frame as wmap_frame
+from wmap_sniffer import pcap, read, synth, workers
+
+STAGES = ("read", "decode", "handle", "pipeline")
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pcap_samples")
+
+# Stages whose frames/sec dropped by more than this much are flagged by
+# --compare
+REGRESSION_THRESHOLD = 0.1
+
+
+def parse_args():
+    """
+    Parses and returns argparse arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the wifi_map ingest pipeline."
+    )
+
+    parser.add_argument(
+        "files", nargs="*", type=wifi_map.filename, metavar="FNAME",
+        help="Capture files to benchmark. Defaults to everything in pcap_samples "
+             "unless --synthetic is given."
+    )
+
+    parser.add_argument(
+        "--stages", type=stage_list, default=STAGES, metavar="STAGE,...",
+        help="Stages to run. Any of {}.".format(", ".join(STAGES))
+    )
+
+    parser.add_argument(
+        "--synthetic", action="store_true",
+        help="Also benchmark a generated capture."
+    )
+
+    parser.add_argument(
+        "--stations", type=wifi_map.positive_int, default=1000, metavar="N",
+        help="Client stations in the generated capture."
+    )
+
+    parser.add_argument(
+        "--aps", type=wifi_map.positive_int, metavar="N",
+        help="Access points in the generated capture. Defaults to one per {} stations.".format(
+            synth.DEFAULT_STATIONS_PER_AP
+        )
+    )
+
+    parser.add_argument(
+        "--frames", type=wifi_map.positive_int, default=100000, metavar="N",
+        help="Frames in the generated capture."
+    )
+
+    parser.add_argument(
+        "--mix", type=frame_mix, default=synth.DEFAULT_MIX, metavar="KIND=SHARE,...",
+        help="Share of beacon, probe and data frames in the generated capture, "
+             "like beacon=0.2,probe=0.1,data=0.7"
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Random seed for the generated capture."
+    )
+
+    parser.add_argument(
+        "--save-synthetic", metavar="FNAME",
+        help="Keep the generated capture in this file (.gz to compress it) instead of a temporary one."
+    )
+
+    parser.add_argument(
+        "--workers", type=wifi_map.positive_int, metavar="N",
+        help="Number of workers in the pipeline stage. Defaults to the cpu count."
+    )
+
+    parser.add_argument(
+        "--processes", action="store_const", dest="worker_mode",
+        const=constants.WORKER_MODE_PROCESS, default=constants.DEFAULT_WORKER_MODE,
+        help="Run the pipeline workers as separate processes instead of threads."
+    )
+
+    parser.add_argument(
+        "-o", "--output", metavar="FNAME",
+        help="Save the results to this JSON file."
+    )
+
+    parser.add_argument(
+        "--compare", type=wifi_map.filename, metavar="FNAME",
+        help="Compare the results to an earlier run saved with --output."
+    )
+
+    parser.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="Show the output of the pipeline instead of hiding it."
+    )
+
+    args = parser.parse_args()
+
+    if not args.files and not args.synthetic:
+        args.files = sorted(glob.glob(os.path.join(SAMPLES_DIR, "*")))
+
+    return args
+
+
+def stage_list(value):
+    """
+    argparse type function for a comma separated list of stages
+    """
+    stages = [stage.strip() for stage in value.split(",")]
+    for stage in stages:
+        if stage not in STAGES:
+            raise argparse.ArgumentTypeError(
+                "Unknown stage {}. Use any of {}.".format(stage, ", ".join(STAGES))
+            )
+
+    # Keep them in pipeline order
+    return tuple(stage for stage in STAGES if stage in stages)
+
+
+def frame_mix(value):
+    """
+    argparse type function for the mix of frames in a generated capture
+    """
+    try:
+        return synth.parse_mix(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
+def main():
+    args = parse_args()
+
+    config = dict(constants.DEFAULT_CONFIG)
+    config["workers"] = args.workers
+    config["worker_mode"] = args.worker_mode
+
+    cases = [(os.path.basename(fname), fname, {}) for fname in args.files]
+
+    synthetic_fname = None
+    if args.synthetic:
+        synthetic_fname = args.save_synthetic
+        if synthetic_fname is None:
+            fd, synthetic_fname = tempfile.mkstemp(prefix="wifi_map-", suffix=".pcap")
+            os.close(fd)
+
+        print("Generating {} frames from {} stations...".format(args.frames, args.stations))
+        start = time.monotonic()
+        pcap.write_pcap(synthetic_fname, synth.generate_frames(
+            args.stations,
+            args.frames,
+            aps=args.aps,
+            mix=args.mix,
+            seed=args.seed
+        ))
+
+        cases.append(("synthetic", synthetic_fname, {
+            "stations": args.stations,
+            "aps": args.aps,
+            "frames": args.frames,
+            "mix": args.mix,
+            "seed": args.seed,
+            "generate_seconds": time.monotonic() - start
+        }))
+
+    # The stores need the database even when they never flush to it
+    wifi_map.db_init()
+
+    results = []
+    try:
+        for name, fname, extra in cases:
+            result = {"name": name, "file_bytes": os.path.getsize(fname), "stages": {}}
+            result.update(extra)
+
+            for stage in args.stages:
+                print("{}: {}...".format(name, stage), end="", flush=True)
+                result["stages"][stage] = run_stage(stage, fname, config, args.verbose)
+                print(" {:.0f} frames/sec".format(result["stages"][stage]["frames_per_sec"]))
+
+            results.append(result)
+    finally:
+        if synthetic_fname is not None and args.save_synthetic is None:
+            os.remove(synthetic_fname)
+
+    report = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "workers": config["workers"],
+            "worker_mode": config["worker_mode"]
+        },
+        "results": results
+    }
+
+    print()
+    print_report(report)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print()
+            print_comparison(json.load(f), report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+        print("Saved results to {}".format(args.output))
+
+
+def run_stage(stage, fname, config, verbose=False):
+    """
+    Runs one stage over a capture in a child process and returns its results
+    """
+    context = multiprocessing.get_context("fork")
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    proc = context.Process(target=stage_process, args=(stage, fname, config, verbose, child_conn))
+    proc.start()
+    child_conn.close()
+
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+
+    proc.join()
+
+    if result is None:
+        raise RuntimeError("The {} stage failed on {}".format(stage, fname))
+
+    return result
+
+
+def stage_process(stage, fname, config, verbose, conn):
+    """
+    Entry point of the child process that runs a stage. Sends the results
+    back over conn.
+    """
+    if not verbose:
+        # dup2 rather than replacing sys.stdout so worker processes started
+        # by the pipeline are quiet too
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+
+    start = time.monotonic()
+    result = STAGE_FUNCTIONS[stage](fname, config)
+    seconds = time.monotonic() - start
+
+    result["seconds"] = seconds
+    result["frames_per_sec"] = result["frames"] / seconds if seconds else 0.0
+    result["peak_rss_kb"] = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+
+    conn.send(result)
+    conn.close()
+
+
+def bench_read(fname, config):
+    frames = 0
+    for _ in pcap.read_frames(fname):
+        frames += 1
+
+    return {"frames": frames}
+
+
+def bench_decode(fname, config):
+    frames = 0
+    malformed = 0
+    for raw, _ in pcap.read_frames(fname):
+        frames += 1
+        try:
+            wmap_frame.decode(raw)
+        except ValueError:
+            malformed += 1
+
+    return {"frames": frames, "malformed": malformed}
+
+
+def bench_handle(fname, config):
+    # Never flushed, so this is just the handlers and the in memory state
+    store = workers.make_store(config)
+
+    frames = 0
+    changes = 0
+    for raw, timestamp in pcap.read_frames(fname):
+        frames += 1
+        changes += len(workers.handle_frame(raw, timestamp, store))
+
+    return {
+        "frames": frames,
+        "changes": changes,
+        "stations": len(store.stations),
+        "networks": len(store.networks),
+        "connections": len(store.connections)
+    }
+
+
+def bench_pipeline(fname, config):
+    wifi_map.db_init()
+
+    update_queue = queue.Queue()
+    updates = []
+
+    def drain():
+        count = 0
+        while True:
+            update = update_queue.get()
+            if update is None:
+                break
+
+            count += sum(len(changes) for changes in update.values())
+
+        updates.append(count)
+
+    drainer = threading.Thread(target=drain)
+    drainer.start()
+
+    latency = read(fname, update_queue, config)
+    update_queue.put(None)
+    drainer.join()
+
+    return {
+        "frames": latency.count,
+        "changes": updates[0],
+        "latency_ms": {
+            "mean": latency.total / latency.count * 1000 if latency.count else 0.0,
+            "p50": latency.percentile(50) * 1000,
+            "p99": latency.percentile(99) * 1000,
+            "max": latency.max * 1000
+        },
+        "stations": models.Station.select().count(),
+        "networks": models.Network.select().count(),
+        "connections": models.Connection.select().count(),
+        "db_bytes": db_size()
+    }
+
+
+STAGE_FUNCTIONS = {
+    "read": bench_read,
+    "decode": bench_decode,
+    "handle": bench_handle,
+    "pipeline": bench_pipeline
+}
+
+
+def db_size():
+    """
+    Returns the size of the database on disk, including its write ahead log
+    """
+    size = 0
+    for suffix in ("", "-wal"):
+        try:
+            size += os.path.getsize(constants.DB_FILE + suffix)
+        except OSError:
+            pass
+
+    return size
+
+
+def git_commit():
+    """
+    Returns the commit being benchmarked, or None if it isn't a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report):
+    print("{:<28} {:<9} {:>9} {:>12} {:>10} {:>10}".format(
+        "capture", "stage", "frames", "frames/sec", "us/frame", "peak MB"
+    ))
+
+    for result in report["results"]:
+        previous = None
+        for stage in STAGES:
+            if stage not in result["stages"]:
+                continue
+
+            stats = result["stages"][stage]
+            # What this stage adds on top of the one before it
+            per_frame = stats["seconds"] / stats["frames"] * 1e6 if stats["frames"] else 0.0
+            added = per_frame - previous if previous is not None else per_frame
+            previous = per_frame
+
+            print("{:<28} {:<9} {:>9} {:>12.0f} {:>10.2f} {:>10.1f}".format(
+                result["name"][:28],
+                stage,
+                stats["frames"],
+                stats["frames_per_sec"],
+                added,
+                stats["peak_rss_kb"] / 1024
+            ))
+
+        pipeline = result["stages"].get("pipeline")
+        if pipeline:
+            print("{:<28} latency p50 {:.2f}ms, p99 {:.2f}ms, db {:.1f}KB".format(
+                "",
+                pipeline["latency_ms"]["p50"],
+                pipeline["latency_ms"]["p99"],
+                pipeline["db_bytes"] / 1024
+            ))
+
+
+def print_comparison(old, new):
+    """
+    Prints how the frames/sec of every stage changed between two reports
+    """
+    print("Compared to {} ({}):".format(old.get("commit") or "unknown commit", old.get("time")))
+
+    old_results = {result["name"]: result for result in old["results"]}
+    for result in new["results"]:
+        before = old_results.get(result["name"])
+        if before is None:
+            continue
+
+        for stage, stats in result["stages"].items():
+            old_stats = before["stages"].get(stage)
+            if not old_stats or not old_stats["frames_per_sec"]:
+                continue
+
+            change = stats["frames_per_sec"] / old_stats["frames_per_sec"] - 1
+            print("{:<28} {:<9} {:>12.0f} -> {:>12.0f} {:>+7.1%}{}".format(
+                result["name"][:28],
+                stage,
+                old_stats["frames_per_sec"],
+                stats["frames_per_sec"],
+                change,
+                "  REGRESSION" if change < -REGRESSION_THRESHOLD else ""
+            ))
+
+
+if __name__ == "__main__":
+    main()
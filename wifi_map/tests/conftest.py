@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+# The packages are imported from the wifi_map directory, the same way
+# wifi_map.py imports them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wmap_common import constants, db_utils  # noqa: E402
+from wmap_common.models import Station, Network, Connection, StationArchive  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """
+    Points the models at an empty database for the length of a test
+    """
+    database = db_utils.get_db()
+    database.close()
+    database.init(str(tmp_path / "wifi_map.db"), pragmas=db_utils.DB_PRAGMAS)
+    database.create_tables([Station, Network, Connection, StationArchive])
+    yield database
+    database.close()
+    database.init(constants.DB_FILE, pragmas=db_utils.DB_PRAGMAS, timeout=db_utils.DB_BUSY_TIMEOUT)
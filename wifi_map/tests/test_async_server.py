@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from wmap_server import async_server  # noqa: E402
+
+
+class Rooms():
+    """
+    Records room changes like python-socketio before 5.x, where entering and
+    leaving rooms aren't coroutines
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def enter_room(self, sid, room):
+        self.calls.append(("enter", sid, room))
+
+    def leave_room(self, sid, room):
+        self.calls.append(("leave", sid, room))
+
+
+class AsyncRooms(Rooms):
+    """
+    Same as Rooms but like python-socketio 5.x
+    """
+
+    async def enter_room(self, sid, room):
+        super().enter_room(sid, room)
+
+    async def leave_room(self, sid, room):
+        super().leave_room(sid, room)
+
+
+@pytest.mark.parametrize("rooms", [Rooms, AsyncRooms])
+def test_room_changes_work_with_either_socketio(rooms):
+    async def run():
+        server = async_server.AsyncServer.__new__(async_server.AsyncServer)
+        server.client_formats = async_server.ClientFormats(async_server.wire.FORMATS)
+        server.sio = rooms()
+        await server.set_client_format("sid", "json")
+        await server.set_client_format("sid", "binary")
+        return server.sio.calls
+
+    assert asyncio.run(run()) == [("enter", "sid", "json"), ("leave", "sid", "json"), ("enter", "sid", "binary")]
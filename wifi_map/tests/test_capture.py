@@ -0,0 +1,52 @@
+import os
+import threading
+
+import pytest
+
+from wmap_sniffer import capture, pcap
+
+SAMPLE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "pcap_samples",
+    "wpa-eap-tls.pcap.gz"
+)
+
+# Seconds to wait for the replayed frames to come back
+REPLAY_TIMEOUT = 10
+
+
+@pytest.mark.parametrize("ring_frames", [0, 256])
+def test_replay_through_lo(ring_frames):
+    # Control frames are dropped by the capture's filter
+    expected = [
+        frame for frame, _ in pcap.read_frames(SAMPLE)
+        if frame[0] & capture.FC_TYPE_MASK != capture.FC_TYPE_CTRL
+    ]
+
+    try:
+        live = capture.LiveCapture("lo", linktype=pcap.LINKTYPE_RADIOTAP, ring_frames=ring_frames)
+    except capture.CaptureError as err:
+        pytest.skip(str(err))
+
+    captured = []
+    wanted = set(expected)
+    done = threading.Event()
+
+    def read():
+        for frame, _ in live.frames():
+            # Anything else that happens to go over lo is ignored
+            if frame in wanted:
+                captured.append(frame)
+                if len(captured) == len(expected):
+                    break
+
+        done.set()
+
+    with live:
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        capture.replay(SAMPLE, "lo")
+        done.wait(REPLAY_TIMEOUT)
+
+    assert len(captured) == len(expected)
+    assert captured == expected
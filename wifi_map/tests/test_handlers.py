@@ -0,0 +1,61 @@
+import struct
+
+from wmap_common import constants, macs
+from wmap_common.store import StateStore
+from wmap_sniffer import frame as wmap_frame
+from wmap_sniffer import handlers
+
+AP = 0x0013100a0b0c
+CLIENT = 0x8c8590010203
+
+STATUS_REFUSED = 1
+
+
+def mgmt_frame(subtype, dst, src, bssid, body):
+    """
+    Returns a management frame with the given addresses and body
+    """
+    header = bytes([subtype << 4 | constants.FRAME_TYPE_MGMT << 2, 0, 0, 0])
+    for mac in (dst, src, bssid):
+        header += mac.to_bytes(macs.MAC_LEN, "big")
+
+    return header + bytes(2) + body
+
+
+def handle(raw, store):
+    frame = wmap_frame.decode(raw)
+    return handlers.get_handler(frame.type, frame.subtype)(frame, 1.0, store)
+
+
+def test_successful_association_response_connects():
+    store = StateStore()
+    body = struct.pack("<HHH", 0x0431, constants.STATUS_SUCCESS, 0xc001)
+    handle(mgmt_frame(constants.FRAME_SUBTYPE_ASSOC_RES, CLIENT, AP, AP, body), store)
+
+    assert store.connections[macs.pair_key(AP, CLIENT)].connected
+
+
+def test_refused_association_response_doesnt_connect():
+    store = StateStore()
+    body = struct.pack("<HHH", 0x0431, STATUS_REFUSED, 0)
+    handle(mgmt_frame(constants.FRAME_SUBTYPE_REASSOC_RES, CLIENT, AP, AP, body), store)
+
+    assert store.connections == {}
+    assert set(store.stations) == {AP, CLIENT}
+
+
+def test_requests_and_authentication_dont_connect():
+    store = StateStore()
+    handle(mgmt_frame(constants.FRAME_SUBTYPE_ASSOC_REQ, AP, CLIENT, AP, struct.pack("<HH", 0x0431, 10)), store)
+    handle(mgmt_frame(constants.FRAME_SUBTYPE_AUTH, AP, CLIENT, AP, struct.pack("<HHH", 0, 1, 0)), store)
+    handle(mgmt_frame(constants.FRAME_SUBTYPE_AUTH, CLIENT, AP, AP, struct.pack("<HHH", 0, 2, 0)), store)
+
+    assert store.connections == {}
+    assert set(store.stations) == {AP, CLIENT}
+
+
+def test_truncated_association_response_doesnt_connect():
+    store = StateStore()
+    handle(mgmt_frame(constants.FRAME_SUBTYPE_ASSOC_RES, CLIENT, AP, AP, b"\x31"), store)
+
+    assert store.connections == {}
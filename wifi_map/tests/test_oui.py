@@ -0,0 +1,14 @@
+import sys
+
+from wmap_common import oui
+
+
+def test_scapy_manuf_falls_back_to_manufdb(monkeypatch):
+    shipped = oui.read_scapy_manuf()
+
+    # Like scapy before 2.5, which has no scapy.libs.manuf
+    monkeypatch.setitem(sys.modules, "scapy.libs.manuf", None)
+    loaded = oui.read_scapy_manuf()
+
+    assert loaded
+    assert sorted(loaded) == sorted(shipped)
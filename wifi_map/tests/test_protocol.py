@@ -0,0 +1,44 @@
+from wmap_server import protocol, wire
+from wmap_server.broadcast import StateView, UpdateLog
+
+
+def test_hello_picks_binary_for_clients_that_can_decode_it():
+    fmt, reply = protocol.hello_reply({"formats": ["binary", "json"]})
+    assert fmt == wire.FORMAT_BINARY
+    assert reply["schema"] == wire.SCHEMA
+
+
+def test_malformed_hello_gets_json():
+    for data in (None, "binary", ["binary"], {"formats": "binary"}):
+        assert protocol.hello_reply(data) == (wire.FORMAT_JSON, {"format": wire.FORMAT_JSON})
+
+
+def test_malformed_resync_sends_the_client_to_init():
+    view = StateView()
+    update_log = UpdateLog(10)
+
+    for data in (None, "resync", [view.instance], {"instance": view.instance, "generation": "soon"},
+                 {"instance": view.instance, "generation": [1]}):
+        reply = protocol.resync_reply(data, view, update_log)
+        assert reply["messages"] is None
+        assert "error" in reply
+
+
+def test_resync_replies_with_missed_messages():
+    view = StateView()
+    update_log = UpdateLog(10)
+    update = {"network": [{"action": "create", "objtype": "network", "obj": {"ssid": "net"}, "updates": []}]}
+    update_log.append(view.apply(update), update)
+
+    reply = protocol.resync_reply({"instance": view.instance, "generation": 0}, view, update_log)
+    assert reply == {"messages": [wire.encode_message(wire.FORMAT_JSON, 1, update)]}
+    assert protocol.resync_reply({"instance": "old", "generation": 0}, view, update_log) == {"restarted": True}
+
+
+def test_etag_matches_if_none_match():
+    etag = "instance-3"
+    assert protocol.etag_matches(protocol.quote_etag(etag), etag)
+    assert protocol.etag_matches("W/\"other\", W/\"instance-3\"", etag)
+    assert protocol.etag_matches("*", etag)
+    assert not protocol.etag_matches("\"instance-2\"", etag)
+    assert not protocol.etag_matches(None, etag)
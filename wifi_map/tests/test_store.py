@@ -0,0 +1,136 @@
+from wmap_common import constants, macs, state
+from wmap_common.models import Connection
+from wmap_common.store import StateStore
+from wmap_sniffer import workers
+
+AP = 0x0013100a0b0c
+CLIENT = 0x8c8590010203
+OTHER = 0x8c8590040506
+
+FC_DATA = constants.FRAME_TYPE_DATA << 2
+TO_DS = 0x01
+FROM_DS = 0x02
+
+
+def test_flapping_connection_is_scheduled_once():
+    store = StateStore(connection_timeout=30.0)
+
+    store.observe_connection(AP, CLIENT, 1.0)
+    for i in range(50):
+        t = 2.0 + i * 0.5
+        store.observe_connection(AP, CLIENT, t, connected=False)
+        store.observe_connection(AP, CLIENT, t + 0.25)
+
+    assert len(store.connection_wheel) == 1
+
+
+def test_idle_connection_times_out_and_comes_back():
+    store = StateStore(connection_timeout=30.0)
+
+    store.observe_connection(AP, CLIENT, 1.0)
+    store.observe_connection(AP, CLIENT, 20.0)
+    changes = store.age_connections(40.0)
+    assert changes == []
+    assert len(store.connection_wheel) == 1
+
+    changes = store.age_connections(60.0)
+    assert [change.obj.connected for change in changes] == [False]
+    assert len(store.connection_wheel) == 0
+
+    store.observe_connection(AP, CLIENT, 61.0)
+    store.observe_connection(AP, CLIENT, 62.0, connected=False)
+    store.observe_connection(AP, CLIENT, 63.0)
+    assert len(store.connection_wheel) == 1
+
+
+def test_evicted_stations_take_their_connections_rows_with_them(db):
+    store = StateStore(max_stations=2)
+
+    store.observe_station(AP, 1.0, is_ap=True)
+    store.observe_station(CLIENT, 2.0)
+    store.observe_connection(AP, CLIENT, 2.0)
+    store.flush()
+    assert Connection.select().count() == 1
+
+    store.observe_station(CLIENT + 1, 3.0)
+    store.observe_station(CLIENT + 2, 4.0)
+    assert store.connections == {}
+    store.flush()
+    assert Connection.select().count() == 0
+
+
+def test_flush_writes_the_conn_id_clients_were_sent(db):
+    Connection.create(conn_id=1, station1=macs.to_str(AP), station2=macs.to_str(CLIENT),
+                      connected=False, last_update=1.0)
+
+    store = StateStore(last_conn_id=10)
+    changes = store.observe_connection(AP, CLIENT, 2.0)
+    store.flush()
+
+    assert [row.conn_id for row in Connection.select()] == [changes[0].obj.conn_id]
+
+
+def data_frame(dst, bssid, src, seq=0):
+    """
+    Returns a from-DS data frame with the given addresses
+    """
+    header = bytes([FC_DATA, FROM_DS, 0, 0])
+    for mac in (dst, bssid, src):
+        header += mac.to_bytes(macs.MAC_LEN, "big")
+
+    return header + seq.to_bytes(2, "little") + b"payload"
+
+
+def wds_frame(receiver, transmitter, dst, src, seq=0):
+    """
+    Returns a data frame with both DS flags set, and so four addresses
+    """
+    header = bytes([FC_DATA, TO_DS | FROM_DS, 0, 0])
+    for mac in (receiver, transmitter, dst):
+        header += mac.to_bytes(macs.MAC_LEN, "big")
+
+    header += seq.to_bytes(2, "little") + src.to_bytes(macs.MAC_LEN, "big")
+    return header + b"payload"
+
+
+def test_skipped_data_frames_refresh_their_stations():
+    store = StateStore(max_stations=3)
+    frame = data_frame(CLIENT, AP, AP)
+
+    workers.handle_frame(frame, 1.0, store)
+    store.observe_station(OTHER, 1.2)
+    assert workers.handle_frame(frame, 1.5, store) == []
+    assert store.stations[CLIENT].last_update == 1.5
+
+    # The station seen longest ago is OTHER now
+    store.observe_station(OTHER + 1, 2.0)
+    assert OTHER not in store.stations
+    assert AP in store.stations and CLIENT in store.stations
+
+
+def test_evicted_stations_take_their_flows_with_them():
+    store = StateStore(max_stations=2, duplicate_window=10.0)
+    frame = data_frame(CLIENT, AP, AP)
+
+    workers.handle_frame(frame, 1.0, store)
+    store.observe_station(OTHER, 2.0)
+    assert CLIENT not in store.stations
+    assert store.station_flows == {}
+
+    # Handled in full again, so the client comes back
+    workers.handle_frame(frame, 3.0, store)
+    assert CLIENT in store.stations
+    assert macs.pair_key(AP, CLIENT) in store.connections
+
+
+def test_four_address_frames_are_skipped_like_the_rest():
+    store = StateStore(max_stations=10)
+
+    # Every frame has a new sequence number, which isn't part of the flow
+    workers.handle_frame(wds_frame(AP, AP + 1, CLIENT, OTHER, seq=1), 1.0, store)
+    assert workers.handle_frame(wds_frame(AP, AP + 1, CLIENT, OTHER, seq=2), 1.5, store) == []
+    assert store.duplicates.hits == 1
+    assert store.stations[OTHER].last_update == 1.5
+
+    store.observe_station(CLIENT + 1, 2.0)
+    assert set(store.station_flows) == {AP, AP + 1, CLIENT, OTHER}
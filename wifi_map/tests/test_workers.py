@@ -0,0 +1,71 @@
+import queue
+import threading
+
+import pytest
+
+from wmap_common import constants, macs
+from wmap_sniffer import workers
+
+AP = 0x0013100a0b0c
+CLIENT = 0x8c8590010203
+
+FC_DATA = constants.FRAME_TYPE_DATA << 2
+FROM_DS = 0x02
+
+# Seconds to give a pool to shut down
+CLOSE_TIMEOUT = 10
+
+
+def data_frame(dst, bssid, src):
+    """
+    Returns a from-DS data frame with the given addresses
+    """
+    header = bytes([FC_DATA, FROM_DS, 0, 0])
+    for mac in (dst, bssid, src):
+        header += mac.to_bytes(macs.MAC_LEN, "big")
+
+    return header + bytes(2) + b"payload"
+
+
+def close_pool(pool):
+    """
+    Closes a pool, failing the test instead of hanging if it doesn't
+    """
+    closer = threading.Thread(target=pool.close, daemon=True)
+    closer.start()
+    closer.join(CLOSE_TIMEOUT)
+    assert not closer.is_alive(), "close hung"
+
+
+def test_frame_that_raises_doesnt_stop_its_worker(db, monkeypatch):
+    bad = data_frame(CLIENT + 1, AP, AP)
+    handle_frame = workers.handle_frame
+
+    def raise_on_bad(frame, *args):
+        if bytes(frame) == bad:
+            raise IndexError("bad frame")
+
+        return handle_frame(frame, *args)
+
+    monkeypatch.setattr(workers, "handle_frame", raise_on_bad)
+    config = dict(constants.DEFAULT_CONFIG, workers=2)
+    pool = workers.ThreadPool(queue.Queue(), 2, config)
+
+    pool.dispatch(bad, 1.0)
+    pool.dispatch(data_frame(CLIENT, AP, AP), 2.0)
+    close_pool(pool)
+
+    assert any(CLIENT in store.stations for store in pool.stores)
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_dead_worker_doesnt_block_close(db):
+    config = dict(constants.DEFAULT_CONFIG, workers=2)
+    pool = workers.ThreadPool(queue.Queue(), 2, config)
+
+    def die():
+        raise RuntimeError("worker died")
+
+    pool.stores[0].flush_if_due = die
+    pool.dispatch(data_frame(CLIENT, AP, AP), 1.0)
+    close_pool(pool)
@@ -3,6 +3,8 @@
 import threading
 import queue
 import argparse
+import importlib.util
+import logging
 import os
 
 from wmap_sniffer import sniff, read
@@ -37,6 +39,48 @@ def port(portno):
         return portno
 
 
+def positive_float(value):
+    """
+    argparse type function that makes sure a number is greater than zero
+    """
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(
+            "{} must be greater than zero.".format(value)
+        )
+    else:
+        return number
+
+
+def positive_int(value):
+    """
+    argparse type function that makes sure a whole number is greater than zero
+    """
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(
+            "{} must be greater than zero.".format(value)
+        )
+    else:
+        return number
+
+
+def speed(value):
+    """
+    argparse type function for a replay speed. Takes a multiplier like 10 or
+    10x, or max to replay as fast as possible (returned as None).
+    """
+    if value.lower() == "max":
+        return None
+
+    try:
+        return positive_float(value[:-1] if value.lower().endswith("x") else value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Invalid speed {}. Use a multiplier like 10x or max.".format(value)
+        )
+
+
 def interface(nic_name):
     """
     argparse type function that makes sure a network interface with the given
@@ -72,6 +116,12 @@ def parse_args():
         help="Network interface to listen on"
     )
 
+    parser.add_argument(
+        "--speed", type=speed, default=constants.DEFAULT_SPEED,
+        help="How many times faster than real time to replay the pcap file, "
+             "like 1x or 10x. Defaults to max, as fast as possible."
+    )
+
     parser.add_argument(
         "-p", "--port", type=port, default=constants.DEFAULT_SERVER_PORT,
         help="TCP port to run the web client on"
@@ -87,7 +137,174 @@ def parse_args():
         help="TCP port that RabbitMQ is running on."
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--oui-file", type=filename, metavar="FNAME", action="append", dest="oui_files",
+        help="IEEE registry csv (oui.csv, mam.csv, oui36.csv) or Wireshark manuf file to look "
+             "manufacturers up in. Can be given more than once. Defaults to the ones in ~/.wifi_map "
+             "or installed by ieee-data or Wireshark, then the copy that comes with scapy."
+    )
+
+    parser.add_argument(
+        "--flush-interval", type=positive_float, metavar="SECONDS",
+        default=constants.DEFAULT_FLUSH_INTERVAL,
+        help="How often captured state is written to the database."
+    )
+
+    parser.add_argument(
+        "--flush-batch-size", type=positive_int, metavar="N",
+        default=constants.DEFAULT_FLUSH_BATCH_SIZE,
+        help="Write captured state early once this many records have changed."
+    )
+
+    parser.add_argument(
+        "--beacon-cache-size", type=positive_int, metavar="N",
+        default=constants.DEFAULT_BEACON_CACHE_SIZE,
+        help="Number of access points each worker remembers the last beacon of, "
+             "so unchanged beacons can be skipped."
+    )
+
+    parser.add_argument(
+        "--no-beacon-cache", action="store_const", dest="beacon_cache_size", const=0,
+        help="Handle every beacon in full, even ones that haven't changed."
+    )
+
+    parser.add_argument(
+        "--beacon-cache-ttl", type=positive_float, metavar="SECONDS",
+        default=constants.DEFAULT_BEACON_CACHE_TTL,
+        help="How long (in capture time) an unchanged beacon is skipped before it is handled again."
+    )
+
+    parser.add_argument(
+        "--duplicate-cache-size", type=positive_int, metavar="N",
+        default=constants.DEFAULT_DUPLICATE_CACHE_SIZE,
+        help="Number of data flows each worker remembers the last frame of, so repeats can be skipped."
+    )
+
+    parser.add_argument(
+        "--no-duplicate-cache", action="store_const", dest="duplicate_cache_size", const=0,
+        help="Handle every data frame, even ones that repeat the last one of their flow."
+    )
+
+    parser.add_argument(
+        "--duplicate-window", type=positive_float, metavar="SECONDS",
+        default=constants.DEFAULT_DUPLICATE_WINDOW,
+        help="How long (in capture time) repeats of a data frame are skipped before one is handled again."
+    )
+
+    parser.add_argument(
+        "--connection-timeout", type=positive_float, metavar="SECONDS",
+        default=constants.DEFAULT_CONNECTION_TIMEOUT,
+        help="How long (in capture time) a connection can go without traffic before it is shown as disconnected."
+    )
+
+    parser.add_argument(
+        "--no-connection-timeout", action="store_const", dest="connection_timeout", const=0,
+        help="Only mark connections disconnected when a deauthentication or disassociation is seen."
+    )
+
+    parser.add_argument(
+        "--max-stations", type=positive_int, metavar="N",
+        default=constants.DEFAULT_MAX_STATIONS,
+        help="Most stations to keep track of. Once there are more the ones seen longest ago are evicted."
+    )
+
+    parser.add_argument(
+        "--no-max-stations", action="store_const", dest="max_stations", const=0,
+        help="Keep track of every station ever seen."
+    )
+
+    parser.add_argument(
+        "--no-archive", action="store_const", dest="archive_stations", const=False,
+        default=constants.DEFAULT_ARCHIVE_STATIONS,
+        help="Delete evicted stations instead of moving them to the station_archive table."
+    )
+
+    parser.add_argument(
+        "--emit-interval", type=positive_float, metavar="SECONDS",
+        default=constants.DEFAULT_EMIT_INTERVAL,
+        help="How long updates are collected and merged before being sent to the browser."
+    )
+
+    parser.add_argument(
+        "--emit-max-changes", type=positive_int, metavar="N",
+        default=constants.DEFAULT_EMIT_MAX_CHANGES,
+        help="Max number of object changes in a single message to the browser."
+    )
+
+    parser.add_argument(
+        "--update-log-size", type=positive_int, metavar="N",
+        default=constants.DEFAULT_UPDATE_LOG_SIZE,
+        help="Number of recent messages kept for browsers that missed some."
+    )
+
+    parser.add_argument(
+        "--async-server", action="store_const", dest="server_mode",
+        const=constants.SERVER_MODE_ASYNC, default=constants.DEFAULT_SERVER_MODE,
+        help="Serve browsers from a single asyncio event loop. Needs aiohttp."
+    )
+
+    parser.add_argument(
+        "--capture", dest="capture_backend",
+        choices=[constants.CAPTURE_BACKEND_SOCKET, constants.CAPTURE_BACKEND_SCAPY],
+        default=constants.DEFAULT_CAPTURE_BACKEND,
+        help="How frames are captured from the interface. 'socket' (Linux only) is much faster."
+    )
+
+    parser.add_argument(
+        "--no-ring", action="store_const", dest="ring_frames", const=0,
+        default=constants.DEFAULT_RING_FRAMES,
+        help="Read captured frames from the socket one at a time instead of a shared memory ring."
+    )
+
+    parser.add_argument(
+        "--metrics", action="store_true",
+        help="Collect pipeline metrics and serve them on /metrics (Prometheus) and /metrics.json."
+    )
+
+    parser.add_argument(
+        "--trace", metavar="FNAME",
+        help="Write sampled per frame timings to this file (.gz to compress it). "
+             "Print the slowest frames with 'python -m wmap_common.trace FNAME'."
+    )
+
+    parser.add_argument(
+        "--trace-sample", type=positive_int, metavar="N",
+        default=constants.DEFAULT_TRACE_SAMPLE,
+        help="Trace one in this many frames."
+    )
+
+    parser.add_argument(
+        "--trace-slow", type=positive_float, metavar="SECONDS",
+        default=constants.DEFAULT_TRACE_SLOW,
+        help="Also trace every frame that takes longer than this."
+    )
+
+    parser.add_argument(
+        "--profile", metavar="FNAME",
+        help="Profile the replay with a sampling profiler and write the stacks to this file "
+             "in the folded format flamegraph.pl and speedscope read. Only works with -r."
+    )
+
+    parser.add_argument(
+        "--workers", type=positive_int, metavar="N",
+        help="Number of workers handling frames. Defaults to the cpu count."
+    )
+
+    parser.add_argument(
+        "--processes", action="store_const", dest="worker_mode",
+        const=constants.WORKER_MODE_PROCESS, default=constants.DEFAULT_WORKER_MODE,
+        help="Run the workers as separate processes instead of threads."
+    )
+
+    args = parser.parse_args()
+
+    if args.profile and not args.read:
+        parser.error("--profile only works when reading a pcap file (-r)")
+
+    if args.server_mode == constants.SERVER_MODE_ASYNC and importlib.util.find_spec("aiohttp") is None:
+        parser.error("--async-server needs aiohttp (pip install aiohttp)")
+
+    return args
 
 
 def main():
@@ -96,13 +313,38 @@ def main():
     # TODO spin up server process
 
     args = parse_args()
+    # Workers report what they did when they exit
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
     config = {
         "portno": args.port,
-        "mq_port": args.mq_port
+        "mq_port": args.mq_port,
+        "flush_interval": args.flush_interval,
+        "flush_batch_size": args.flush_batch_size,
+        "beacon_cache_size": args.beacon_cache_size,
+        "beacon_cache_ttl": args.beacon_cache_ttl,
+        "duplicate_cache_size": args.duplicate_cache_size,
+        "duplicate_window": args.duplicate_window,
+        "connection_timeout": args.connection_timeout,
+        "max_stations": args.max_stations,
+        "archive_stations": args.archive_stations,
+        "emit_interval": args.emit_interval,
+        "emit_max_changes": args.emit_max_changes,
+        "update_log_size": args.update_log_size,
+        "server_mode": args.server_mode,
+        "capture_backend": args.capture_backend,
+        "ring_frames": args.ring_frames,
+        "speed": args.speed,
+        "metrics": args.metrics,
+        "trace": args.trace,
+        "trace_sample": args.trace_sample,
+        "trace_slow": args.trace_slow,
+        "profile": args.profile,
+        "workers": args.workers,
+        "worker_mode": args.worker_mode
     }
 
-    db_init()
+    db_init(args.oui_files)
 
     update_queue = queue.Queue()
 
@@ -115,20 +357,15 @@ def main():
         sniff(args.interface, update_queue, config)
 
 
-def db_init():
+def db_init(oui_files=None):
     """
     Creates the database if it doesn't exist. Clears if it does.
     """
     if not os.path.isdir(constants.DB_DIR):
         os.mkdir(constants.DB_DIR)
-        create_db()
-    elif not os.path.exists(constants.DB_FILE):
-        create_db()
-    else:
-        # Clearing the database insead of just deleting is so we don't have
-        # to recreate the IEEE mac address table
-        for model in [models.Station, models.Network, models.Connection]:
-            model.delete().where(True).execute()
+
+    create_db()
+    db_utils.create_mac_table(oui_files)
 
 
 def create_db():
@@ -136,13 +373,18 @@ def create_db():
     Creates the database and the tables.
     """
     db = db_utils.get_db()
+    state_models = [
+        models.Station,
+        models.Network,
+        models.Connection,
+        models.StationArchive
+    ]
 
     with db:
-        db.create_tables([
-            models.Station,
-            models.Network,
-            models.Connection
-        ])
+        # Dropping the state tables instead of just clearing them makes sure
+        # schema changes (like new indexes) get picked up
+        db.drop_tables(state_models)
+        db.create_tables(state_models)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+class FingerprintCache():
+    """
+    Remembers the last fingerprint (any hashable, usually the bytes of a
+    frame body) seen for each key, so that frames which repeat what was
+    already handled can be skipped.
+
+    Entries expire ttl seconds (of capture time) after they were last
+    refreshed, so an unchanged frame still gets handled every so often and
+    the records it touches keep a recent last_update. Once there are size
+    entries the one refreshed longest ago is evicted. Dicts keep insertion
+    order and an entry is reinserted every time it is refreshed, so the
+    oldest is always the first.
+
+    Like the StateStore it belongs to, only one worker touches a cache so it
+    needs no lock.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        # key -> (fingerprint, capture time it expires at)
+        self._entries = {}
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def check(self, key, fingerprint, now):
+        """
+        Returns True if fingerprint is what was last seen for key and that
+        hasn't expired yet. Otherwise remembers it and returns False, and the
+        frame should be handled as usual.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] == fingerprint:
+                if now < entry[1]:
+                    self.hits += 1
+                    return True
+
+                self.expired += 1
+
+            del self._entries[key]
+        elif len(self._entries) >= self.size:
+            del self._entries[next(iter(self._entries))]
+            self.evicted += 1
+
+        self.misses += 1
+        self._entries[key] = (fingerprint, now + self.ttl)
+        return False
+
+    def discard(self, key):
+        """
+        Forgets key, so the next frame for it is handled in full
+        """
+        self._entries.pop(key, None)
+
+    def stats(self):
+        """
+        Returns a one line summary of the cache's counters
+        """
+        checked = self.hits + self.misses
+        return "{} hits, {} misses ({:.1f}% hit rate), {} expired, {} evicted, {} of {} entries used".format(
+            self.hits,
+            self.misses,
+            self.hits * 100 / checked if checked else 0.0,
+            self.expired,
+            self.evicted,
+            len(self._entries),
+            self.size
+        )
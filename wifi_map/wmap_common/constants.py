@@ -3,10 +3,98 @@ import os
 DEFAULT_DB_PORT = 3306  # MySQL
 DEFAULT_MQ_PORT = 5672  # rabbit mq
 DEFAULT_SERVER_PORT = 6363
+# Seconds between writes of the in memory state to the database
+DEFAULT_FLUSH_INTERVAL = 1.0
+# Dirty records that trigger a flush before the interval is up
+DEFAULT_FLUSH_BATCH_SIZE = 5000
+# BSSIDs each worker remembers the last beacon of. 0 handles every beacon.
+DEFAULT_BEACON_CACHE_SIZE = 4096
+# Seconds (of capture time) before an unchanged beacon is handled again
+DEFAULT_BEACON_CACHE_TTL = 10.0
+# Number of data flows (frames with the same addresses) each worker
+# remembers, so repeats can be skipped. 0 handles every data frame.
+DEFAULT_DUPLICATE_CACHE_SIZE = 4096
+# Seconds (of capture time) repeats of a data frame are skipped for before
+# one is handled again
+DEFAULT_DUPLICATE_WINDOW = 1.0
+# Seconds (of capture time) without traffic before a connection is marked
+# disconnected. 0 never ages connections out.
+DEFAULT_CONNECTION_TIMEOUT = 300.0
+# Stations kept in memory (and on the map) across all workers. Once there
+# are more the ones seen longest ago are evicted. 0 keeps every station.
+DEFAULT_MAX_STATIONS = 10000
+# Whether evicted stations are moved to the station_archive table rather
+# than just deleted
+DEFAULT_ARCHIVE_STATIONS = True
+
+# Seconds the server collects updates for before sending them to clients
+DEFAULT_EMIT_INTERVAL = 0.1
+# Max number of object changes in a single message to clients
+DEFAULT_EMIT_MAX_CHANGES = 1000
+# Number of recent messages kept so clients can catch up on ones they missed
+DEFAULT_UPDATE_LOG_SIZE = 1000
+
+SERVER_MODE_THREAD = "thread"
+SERVER_MODE_ASYNC = "async"
+DEFAULT_SERVER_MODE = SERVER_MODE_THREAD
+
+WORKER_MODE_THREAD = "thread"
+WORKER_MODE_PROCESS = "process"
+DEFAULT_WORKER_MODE = WORKER_MODE_THREAD
+# Frames are handed to worker processes in batches of this many
+DEFAULT_WORKER_BATCH_SIZE = 256
+# Seconds a partly filled batch can wait before it is sent anyway
+DEFAULT_WORKER_BATCH_TIMEOUT = 0.05
+
+CAPTURE_BACKEND_SOCKET = "socket"
+CAPTURE_BACKEND_SCAPY = "scapy"
+DEFAULT_CAPTURE_BACKEND = CAPTURE_BACKEND_SOCKET
+# Slots in the ring live frames are captured into. 0 reads from the socket
+# one frame at a time instead.
+DEFAULT_RING_FRAMES = 4096
+# How many times faster than real time capture files are replayed. None
+# replays them as fast as they can be handled.
+DEFAULT_SPEED = None
+# Whether to collect pipeline metrics and serve them on /metrics
+DEFAULT_METRICS = False
+# File to write sampled per frame traces to. None turns tracing off.
+DEFAULT_TRACE = None
+# Trace one in this many frames, plus every frame slower than
+# DEFAULT_TRACE_SLOW seconds
+DEFAULT_TRACE_SAMPLE = 100
+DEFAULT_TRACE_SLOW = 0.001
+# File to write a sampling profile of a replay to. None turns it off.
+DEFAULT_PROFILE = None
+
 DEFAULT_CONFIG = {
     "portno": DEFAULT_SERVER_PORT,
     "mq_port": DEFAULT_MQ_PORT,
-    "db_port": DEFAULT_DB_PORT
+    "db_port": DEFAULT_DB_PORT,
+    "flush_interval": DEFAULT_FLUSH_INTERVAL,
+    "flush_batch_size": DEFAULT_FLUSH_BATCH_SIZE,
+    "beacon_cache_size": DEFAULT_BEACON_CACHE_SIZE,
+    "beacon_cache_ttl": DEFAULT_BEACON_CACHE_TTL,
+    "duplicate_cache_size": DEFAULT_DUPLICATE_CACHE_SIZE,
+    "duplicate_window": DEFAULT_DUPLICATE_WINDOW,
+    "connection_timeout": DEFAULT_CONNECTION_TIMEOUT,
+    "max_stations": DEFAULT_MAX_STATIONS,
+    "archive_stations": DEFAULT_ARCHIVE_STATIONS,
+    "emit_interval": DEFAULT_EMIT_INTERVAL,
+    "emit_max_changes": DEFAULT_EMIT_MAX_CHANGES,
+    "update_log_size": DEFAULT_UPDATE_LOG_SIZE,
+    "server_mode": DEFAULT_SERVER_MODE,
+    "workers": None,
+    "worker_mode": DEFAULT_WORKER_MODE,
+    "batch_size": DEFAULT_WORKER_BATCH_SIZE,
+    "batch_timeout": DEFAULT_WORKER_BATCH_TIMEOUT,
+    "capture_backend": DEFAULT_CAPTURE_BACKEND,
+    "ring_frames": DEFAULT_RING_FRAMES,
+    "speed": DEFAULT_SPEED,
+    "metrics": DEFAULT_METRICS,
+    "trace": DEFAULT_TRACE,
+    "trace_sample": DEFAULT_TRACE_SAMPLE,
+    "trace_slow": DEFAULT_TRACE_SLOW,
+    "profile": DEFAULT_PROFILE
 }
 
 DB_DIR = os.path.join(
@@ -19,6 +107,24 @@ DB_FILE = os.path.join(
     "wifi_map.db"
 )
 
+# Index of mac address manufacturers built from the IEEE registries
+OUI_INDEX_FILE = os.path.join(
+    DB_DIR,
+    "oui.idx"
+)
+
+# Where to look for the IEEE registry csv files (oui.csv, mam.csv,
+# oui36.csv) or a Wireshark manuf file to build the index from
+OUI_REGISTRY_DIRS = [
+    DB_DIR,
+    "/usr/share/ieee-data",
+    "/usr/share/wireshark",
+    "/usr/local/share/wireshark"
+]
+
+# Max number of captured frames waiting for a worker
+PACKET_QUEUE_SIZE = 10000
+
 FRAME_TYPE_MGMT = 0x0
 FRAME_TYPE_CTRL = 0x1
 FRAME_TYPE_DATA = 0x2
@@ -37,23 +143,12 @@ FRAME_SUBTYPE_DEUATH = 0xC
 FC_FLAG_TO_DS = 0x1
 FC_FLAG_FROM_DS = 0x2
 
+# Status code of association responses and authentication frames that
+# accepted the client
+STATUS_SUCCESS = 0x0
+
 ADDRESS_RCV = "reciever"
 ADDRESS_TRNSMT = "transmitter"
 ADDRESS_SRC = "source"
 ADDRESS_DST = "destination"
 ADDRESS_BSSID = "bssid"
-
-MAC_BROADCAST = "ff:ff:ff:ff:ff:ff"
-MAC_NONE = "00:00:00:00:00:00"
-
-UNSAFE_MACS = [
-    MAC_BROADCAST,
-    MAC_NONE
-]
-
-# starts of reserved mac addresses
-MAC_RES_START = [
-    "01:80:c2",
-    "33:33",
-    "01:00:5e"
-]
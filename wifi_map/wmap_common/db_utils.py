@@ -1,6 +1,17 @@
 import peewee
 
-from .constants import DB_FILE
+from .constants import DB_FILE, OUI_INDEX_FILE
+
+# WAL lets the server read while the workers write and with WAL, NORMAL
+# only syncs at checkpoints instead of on every commit.
+DB_PRAGMAS = (
+    ("foreign_keys", "on"),
+    ("journal_mode", "wal"),
+    ("synchronous", "normal"),
+)
+
+# Seconds to wait for another connection's write lock before giving up
+DB_BUSY_TIMEOUT = 30
 
 db = None
 
@@ -12,11 +23,86 @@ def get_db():
     global db
 
     if not db:
-        db = peewee.SqliteDatabase(DB_FILE, pragmas=(('foreign_keys', 'on'),))
+        db = peewee.SqliteDatabase(DB_FILE, pragmas=DB_PRAGMAS, timeout=DB_BUSY_TIMEOUT)
         # db = peewee.SqliteDatabase(DB_FILE)
 
     return db
 
 
-def create_mac_table():
-    pass
+def upsert_many(model, records, conflict_target=None):
+    """
+    Inserts or updates model instances with a single prepared statement.
+    Rows that clash with conflict_target (a list of fields with a unique
+    constraint) have their other columns, the primary key included, updated
+    in place. Without a conflict_target rows are replaced. Should be called
+    inside a transaction.
+    """
+    fields = model._meta.sorted_fields
+    columns = ", ".join("\"{}\"".format(field.column_name) for field in fields)
+    params = ", ".join("?" for field in fields)
+
+    if conflict_target:
+        target = [field.column_name for field in conflict_target]
+        updates = ", ".join(
+            "\"{0}\" = excluded.\"{0}\"".format(field.column_name)
+            for field in fields
+            if field.column_name not in target
+        )
+        sql = "INSERT INTO \"{}\" ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}".format(
+            model._meta.table_name,
+            columns,
+            params,
+            ", ".join("\"{}\"".format(column) for column in target),
+            updates
+        )
+    else:
+        sql = "INSERT OR REPLACE INTO \"{}\" ({}) VALUES ({})".format(
+            model._meta.table_name,
+            columns,
+            params
+        )
+
+    rows = (
+        tuple(field.db_value(record.__data__.get(field.name)) for field in fields)
+        for record in records
+    )
+
+    get_db().connection().executemany(sql, rows)
+
+
+def delete_many(model, keys, fields=None):
+    """
+    Deletes the rows with the given keys with a single prepared statement.
+    Keys are primary keys, or tuples of values for fields (a list of fields
+    with a unique constraint) if those are given. Should be called inside a
+    transaction.
+    """
+    if fields is None:
+        fields = [model._meta.primary_key]
+        keys = ((key,) for key in keys)
+
+    sql = "DELETE FROM \"{}\" WHERE {}".format(
+        model._meta.table_name,
+        " AND ".join("\"{}\" = ?".format(field.column_name) for field in fields)
+    )
+    rows = (
+        tuple(field.db_value(value) for field, value in zip(fields, key))
+        for key in keys
+    )
+    get_db().connection().executemany(sql, rows)
+
+
+def create_mac_table(registries=None):
+    """
+    Builds the mac address manufacturer index if it is missing or older than
+    the registry files. Registries are looked for in the usual places when
+    none are given.
+    """
+    # Imported here so that running the oui module as a script doesn't
+    # import it twice
+    from . import oui
+
+    registries = registries or oui.find_registries()
+    if oui.index_is_stale(OUI_INDEX_FILE, registries):
+        print("Building the manufacturer index from {}...".format(", ".join(registries) or "scapy's manuf"))
+        oui.build_index(OUI_INDEX_FILE, registries)
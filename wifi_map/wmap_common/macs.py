@@ -0,0 +1,92 @@
+"""
+Mac addresses as 48 bit integers.
+
+Addresses are read out of frames as integers and stay integers through the
+workers, so checking what kind of address something is takes a bitmask,
+comparing and hashing them is cheap and no strings are built for every frame.
+Colon separated strings are only made at the edges, when a record is created
+for the database and browsers, or a trace is written.
+"""
+import struct
+
+MAC_BITS = 48
+MAC_LEN = 6
+
+BROADCAST = 0xffffffffffff
+NONE = 0
+
+# Bits of the first octet
+GROUP_BIT = 0x01 << 40
+LOCAL_BIT = 0x02 << 40
+
+# A mac address read as a u16 and a u32, which is quicker than int.from_bytes
+# on a slice
+_mac = struct.Struct(">HI")
+
+
+def from_raw(raw, offset):
+    """
+    Returns the 6 bytes of raw starting at offset as an integer mac address
+    """
+    high, low = _mac.unpack_from(raw, offset)
+    return high << 32 | low
+
+
+def parse(mac):
+    """
+    Returns the integer value of a colon (or dash) separated mac address.
+    Raises ValueError if it isn't one.
+    """
+    digits = mac.replace(":", "").replace("-", "")
+    if len(digits) != MAC_LEN * 2:
+        raise ValueError("{} isn't a mac address".format(mac))
+
+    return int(digits, 16)
+
+
+def to_str(mac):
+    """
+    Returns an integer mac address as a lower case colon separated string
+    """
+    return mac.to_bytes(MAC_LEN, "big").hex(":")
+
+
+def is_group(mac):
+    """
+    True for broadcast and multicast addresses. Every reserved address
+    (spanning tree, IPv4 and IPv6 multicast and so on) is one of these.
+    """
+    return bool(mac & GROUP_BIT)
+
+
+def is_local(mac):
+    """
+    True for locally administered addresses, which is what phones and laptops
+    use when they randomize their address
+    """
+    return bool(mac & LOCAL_BIT)
+
+
+def is_station(mac):
+    """
+    True if the address can belong to a single device, which rules out group
+    addresses and all zeroes
+    """
+    return not mac & GROUP_BIT and mac != NONE
+
+
+def pair_key(mac1, mac2):
+    """
+    Returns a single integer identifying an unordered pair of addresses
+    """
+    if mac1 < mac2:
+        return mac1 << MAC_BITS | mac2
+
+    return mac2 << MAC_BITS | mac1
+
+
+def split_pair(key):
+    """
+    Returns the two addresses of a pair_key, lowest first
+    """
+    return key >> MAC_BITS, key & BROADCAST
@@ -0,0 +1,362 @@
+"""
+Counters, gauges and latency histograms describing the pipeline. The server
+exposes them on /metrics in the Prometheus text format and on /metrics.json.
+
+Values come from collectors, functions that the parts of the pipeline register
+and that return a list of Samples when called. Nothing is added up until
+somebody scrapes. The only per frame cost is in the workers, which only time
+handlers when metrics are enabled.
+"""
+import collections
+import json
+import threading
+
+from . import constants
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# Number of power of two buckets (of microseconds) in a LatencyHistogram
+LATENCY_BUCKETS = 40
+
+# Buckets exported to Prometheus, up to about a minute. Anything slower only
+# counts towards +Inf.
+EXPORTED_BUCKETS = 27
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+FRAME_TYPE_NAMES = {
+    constants.FRAME_TYPE_MGMT: "mgmt",
+    constants.FRAME_TYPE_CTRL: "ctrl",
+    constants.FRAME_TYPE_DATA: "data"
+}
+
+Sample = collections.namedtuple("Sample", ["name", "kind", "help", "labels", "value"])
+
+
+def counter(name, help, value, **labels):
+    return Sample(name, COUNTER, help, labels, value)
+
+
+def gauge(name, help, value, **labels):
+    return Sample(name, GAUGE, help, labels, value)
+
+
+def histogram(name, help, value, **labels):
+    return Sample(name, HISTOGRAM, help, labels, value)
+
+
+class LatencyHistogram():
+    """
+    Counts latencies in power of two buckets of microseconds. Cheap enough to
+    record every frame.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * LATENCY_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        micros = int(seconds * 1e6)
+        self.buckets[min(micros.bit_length(), LATENCY_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """
+        Returns an upper bound (in seconds) on the given percentile
+        """
+        wanted = self.count * percent / 100
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return min((1 << i) / 1e6, self.max)
+
+        return self.max
+
+    def summary(self):
+        """
+        Returns a one line summary of the recorded latencies
+        """
+        if not self.count:
+            return "no frames"
+
+        return "mean {:.2f}ms, p50 <= {:.2f}ms, p99 <= {:.2f}ms, max {:.2f}ms".format(
+            self.total / self.count * 1000,
+            self.percentile(50) * 1000,
+            self.percentile(99) * 1000,
+            self.max * 1000
+        )
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max
+        }
+
+
+def merged(histograms):
+    """
+    Returns a new LatencyHistogram with everything recorded in histograms
+    """
+    total = LatencyHistogram()
+    for other in histograms:
+        total.merge(other)
+
+    return total
+
+
+class WorkerMetrics():
+    """
+    What one worker has seen and how long its handlers took. Only its worker
+    writes to it, so there is no locking. Process workers send copies of
+    theirs to the parent every so often.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        # (frame type, subtype) -> frames
+        self.frames = collections.Counter()
+        self.malformed = 0
+        # handler name -> LatencyHistogram
+        self.handlers = {}
+        # Copied from the worker's store and latency histogram when a process
+        # worker sends its metrics
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_seconds = 0.0
+        self.beacon_hits = 0
+        self.beacon_misses = 0
+        self.duplicate_hits = 0
+        self.duplicate_misses = 0
+        self.connections_closed = 0
+        self.connections_expired = 0
+        self.stations_evicted = 0
+        self.latency = None
+
+    def record(self, frame_type, subtype, handler, seconds):
+        self.frames[frame_type, subtype] += 1
+
+        latency = self.handlers.get(handler)
+        if latency is None:
+            latency = self.handlers[handler] = LatencyHistogram()
+
+        latency.record(seconds)
+
+    def copy_store_stats(self, store):
+        self.flushes = store.flush_count
+        self.flushed_rows = store.flushed_rows
+        self.flush_seconds = store.flush_seconds
+        if store.beacons is not None:
+            self.beacon_hits = store.beacons.hits
+            self.beacon_misses = store.beacons.misses
+        if store.duplicates is not None:
+            self.duplicate_hits = store.duplicates.hits
+            self.duplicate_misses = store.duplicates.misses
+        self.connections_closed = store.connections_closed
+        self.connections_expired = store.connections_expired
+        self.stations_evicted = store.stations_evicted
+
+
+def worker_samples(worker_metrics, latency):
+    """
+    Returns the samples for a pool of workers, added up over all of them.
+    latency is the LatencyHistogram of every frame the pool has handled.
+    """
+    frames = collections.Counter()
+    handlers = collections.defaultdict(LatencyHistogram)
+    malformed = 0
+    flushes = 0
+    flushed_rows = 0
+    flush_seconds = 0.0
+    beacon_hits = 0
+    beacon_misses = 0
+    duplicate_hits = 0
+    duplicate_misses = 0
+    connections_closed = 0
+    connections_expired = 0
+    stations_evicted = 0
+
+    for metrics in worker_metrics:
+        # Copied since the worker may be adding new keys right now
+        frames.update(dict(metrics.frames))
+        for name, handler_latency in list(metrics.handlers.items()):
+            handlers[name].merge(handler_latency)
+
+        malformed += metrics.malformed
+        flushes += metrics.flushes
+        flushed_rows += metrics.flushed_rows
+        flush_seconds += metrics.flush_seconds
+        beacon_hits += metrics.beacon_hits
+        beacon_misses += metrics.beacon_misses
+        duplicate_hits += metrics.duplicate_hits
+        duplicate_misses += metrics.duplicate_misses
+        connections_closed += metrics.connections_closed
+        connections_expired += metrics.connections_expired
+        stations_evicted += metrics.stations_evicted
+
+    samples = [
+        counter(
+            "wifi_map_frames_total", "Frames handled by type and subtype", count,
+            type=FRAME_TYPE_NAMES.get(frame_type, str(frame_type)), subtype=str(subtype)
+        )
+        for (frame_type, subtype), count in sorted(frames.items())
+    ]
+    samples.extend(
+        histogram("wifi_map_handler_seconds", "Time spent in each frame handler", handlers[name], handler=name)
+        for name in sorted(handlers)
+    )
+    samples.extend([
+        counter("wifi_map_frames_malformed_total", "Frames that couldn't be decoded", malformed),
+        counter("wifi_map_db_flushes_total", "Transactions writing state to the database", flushes),
+        counter("wifi_map_db_flushed_rows_total", "Rows written to the database", flushed_rows),
+        counter("wifi_map_db_flush_seconds_total", "Time spent writing to the database", flush_seconds),
+        counter("wifi_map_beacon_cache_hits_total", "Beacons skipped because nothing changed", beacon_hits),
+        counter("wifi_map_beacon_cache_misses_total", "Beacons that were handled in full", beacon_misses),
+        counter("wifi_map_duplicate_cache_hits_total", "Data frames skipped as repeats", duplicate_hits),
+        counter("wifi_map_duplicate_cache_misses_total", "Data frames that were handled", duplicate_misses),
+        counter(
+            "wifi_map_connections_closed_total", "Connections ended by a deauthentication or disassociation",
+            connections_closed
+        ),
+        counter(
+            "wifi_map_connections_expired_total", "Connections marked disconnected after going idle",
+            connections_expired
+        ),
+        counter(
+            "wifi_map_stations_evicted_total", "Stations dropped to stay under the station limit",
+            stations_evicted
+        ),
+        histogram(
+            "wifi_map_frame_latency_seconds",
+            "Time from a frame being dispatched to its updates being queued",
+            latency
+        )
+    ])
+
+    return samples
+
+
+class Registry():
+    """
+    The collectors that make up the metrics of this process
+    """
+
+    def __init__(self):
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self):
+        """
+        Returns the samples of every collector, grouped by name
+        """
+        with self._lock:
+            collectors = list(self._collectors)
+
+        samples = []
+        for collector in collectors:
+            samples.extend(collector())
+
+        # sorted is stable so samples keep their order within a name
+        return sorted(samples, key=lambda sample: sample.name)
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        previous = None
+        for sample in self.collect():
+            if sample.name != previous:
+                lines.append("# HELP {} {}".format(sample.name, sample.help))
+                lines.append("# TYPE {} {}".format(sample.name, sample.kind))
+                previous = sample.name
+
+            if sample.kind == HISTOGRAM:
+                lines.extend(histogram_lines(sample))
+            else:
+                lines.append("{}{} {}".format(sample.name, format_labels(sample.labels), sample.value))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Returns the metrics as a dict for JSON. Metrics with labels are lists
+        of {"labels": ..., "value": ...} and histograms are summarized.
+        """
+        summary = {}
+        for sample in self.collect():
+            value = sample.value
+            if sample.kind == HISTOGRAM:
+                value = value.to_dict()
+
+            if sample.labels:
+                summary.setdefault(sample.name, []).append({"labels": sample.labels, "value": value})
+            else:
+                summary[sample.name] = value
+
+        return summary
+
+    def json(self):
+        return json.dumps(self.summary())
+
+
+def format_labels(labels, **extra):
+    if not labels and not extra:
+        return ""
+
+    pairs = list(labels.items()) + list(extra.items())
+    return "{" + ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in pairs
+    ) + "}"
+
+
+def histogram_lines(sample):
+    """
+    Returns the Prometheus lines of a histogram sample, with cumulative
+    buckets in seconds
+    """
+    value = sample.value
+    lines = []
+    seen = 0
+    for i in range(EXPORTED_BUCKETS):
+        seen += value.buckets[i]
+        lines.append("{}_bucket{} {}".format(
+            sample.name,
+            format_labels(sample.labels, le=repr((1 << i) / 1e6)),
+            seen
+        ))
+
+    lines.append("{}_bucket{} {}".format(sample.name, format_labels(sample.labels, le="+Inf"), value.count))
+    lines.append("{}_sum{} {}".format(sample.name, format_labels(sample.labels), value.total))
+    lines.append("{}_count{} {}".format(sample.name, format_labels(sample.labels), value.count))
+
+    return lines
+
+
+# Metrics of this process. Collectors are only registered when metrics are
+# enabled.
+REGISTRY = Registry()
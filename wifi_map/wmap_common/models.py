@@ -16,7 +16,7 @@ class Network(peewee.Model):
     auth = peewee.TextField(null=True)
     enc = peewee.TextField(null=True)
     cipher = peewee.TextField(null=True)
-    last_update = peewee.DateTimeField(default=time.time())
+    last_update = peewee.DateTimeField(default=time.time(), index=True)
 
     class Meta:
         database = get_db()
@@ -33,15 +33,26 @@ class Station(peewee.Model):
     # removeing the foreign key constraint until I can figure out how to prevent
     # peewee from auto filling in the ssid with the entire network object
     # ssid = peewee.ForeignKeyField(Network, null=True)
-    ssid = peewee.TextField(null=True)
+    ssid = peewee.TextField(null=True, index=True)
     channel = peewee.IntegerField(null=True)
     manufacturer = peewee.TextField(null=True)
-    last_update = peewee.DateTimeField(default=time.time())
+    last_update = peewee.DateTimeField(default=time.time(), index=True)
 
     class Meta:
         database = get_db()
 
 
+class StationArchive(Station):
+    """
+    A station that was evicted from memory to make room for newer ones, as
+    it was when it was last seen
+    """
+    class_name = "station_archive"
+
+    class Meta:
+        table_name = "station_archive"
+
+
 class Connection(peewee.Model):
     """
     An authentication/association relationship between two devices
@@ -49,11 +60,11 @@ class Connection(peewee.Model):
     class_name = "connection"
     conn_id = peewee.AutoField(primary_key=True, null=False, unique=True)
     # station1 = peewee.ForeignKeyField(Station)
-    station1 = peewee.TextField(null=False)
+    station1 = peewee.TextField(null=False, index=True)
     # station2 = peewee.ForeignKeyField(Station)
-    station2 = peewee.TextField(null=False)
+    station2 = peewee.TextField(null=False, index=True)
     connected = peewee.BooleanField()
-    last_update = peewee.DateTimeField(default=time.time())
+    last_update = peewee.DateTimeField(default=time.time(), index=True)
 
     class Meta:
         # primary_key = peewee.CompositeKey("station1", "station2")
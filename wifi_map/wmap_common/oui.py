@@ -0,0 +1,373 @@
+"""
+Looks up the manufacturer of a mac address.
+
+The IEEE hands out blocks of mac addresses of three sizes: MA-L (24 bit
+prefixes, oui.csv), MA-M (28 bit, mam.csv) and MA-S (36 bit, oui36.csv).
+The smaller blocks are carved out of MA-L blocks owned by the IEEE itself, so
+the longest matching prefix wins. Wireshark's manuf file has all three in one
+file and scapy ships a copy of it, which is used when no registry files are
+around.
+
+Registries are compiled into an index file of non overlapping address ranges
+sorted by their first address, where each range has the manufacturer of the
+longest prefix covering it. A table indexed by the first 16 bits of an
+address narrows each lookup down to the few ranges that could hold it before
+a binary search over just those, which keeps lookups under a microsecond.
+The index is memory mapped on first use, so it costs no time at startup and
+every worker process shares the same pages.
+
+Index layout (native byte order, it never leaves the machine):
+
+    header:  "WMOUI", u8 version, u16 padding, u32 ranges, u32 names
+    starts:  u64 first address of each range
+    buckets: u32 index of the first range starting at or after each 16 bit
+             prefix (2**16 + 1 of them)
+    names:   u32 index of each range's manufacturer, NO_NAME if nobody's
+    offsets: u32 start of each manufacturer's name in the text, plus the end
+    text:    utf-8 manufacturer names one after another
+
+Run this module to build an index by hand or look addresses up in one:
+
+    python -m wmap_common.oui build oui.csv mam.csv oui36.csv
+    python -m wmap_common.oui lookup 00:1b:c5:00:00:01
+"""
+import argparse
+import bisect
+import csv
+import io
+import mmap
+import os
+import struct
+
+from . import constants
+from . import macs
+
+INDEX_MAGIC = b"WMOUI"
+INDEX_VERSION = 1
+_header = struct.Struct("=5sBHII")
+
+BUCKET_BITS = 16
+BUCKET_SHIFT = macs.MAC_BITS - BUCKET_BITS
+BUCKETS = (1 << BUCKET_BITS) + 1
+
+NO_NAME = 0xffffffff
+
+# Registry files looked for in each of constants.OUI_REGISTRY_DIRS, in order
+IEEE_REGISTRY_FILES = ("oui.csv", "mam.csv", "oui36.csv")
+MANUF_FILE = "manuf"
+
+_index = None
+
+
+class OUIIndex():
+    """
+    A memory mapped index file
+    """
+
+    def __init__(self, fname):
+        with open(fname, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, ranges, names = _header.unpack_from(self._map)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("{} isn't a version {} oui index".format(fname, INDEX_VERSION))
+
+        view = memoryview(self._map)
+        offset = _header.size
+        self.starts = view[offset:offset + ranges * 8].cast("Q")
+        offset += ranges * 8
+        self.buckets = view[offset:offset + BUCKETS * 4].cast("I")
+        offset += BUCKETS * 4
+        self.names = view[offset:offset + ranges * 4].cast("I")
+        offset += ranges * 4
+        self.offsets = view[offset:offset + (names + 1) * 4].cast("I")
+        self.text = view[offset + (names + 1) * 4:]
+        # Decoded names, so every station of a manufacturer shares one string
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, value):
+        """
+        Returns the manufacturer of the mac address with the given integer
+        value, or None if it isn't known
+        """
+        bucket = value >> BUCKET_SHIFT
+        i = bisect.bisect_right(self.starts, value, self.buckets[bucket], self.buckets[bucket + 1]) - 1
+        if i < 0:
+            return None
+
+        name = self.names[i]
+        if name == NO_NAME:
+            return None
+
+        decoded = self._decoded.get(name)
+        if decoded is None:
+            decoded = self._decoded[name] = str(self.text[self.offsets[name]:self.offsets[name + 1]], "utf-8")
+
+        return decoded
+
+
+def lookup(mac):
+    """
+    Returns the manufacturer of an integer mac address, or None if it isn't
+    known or there is no index
+    """
+    global _index
+
+    # Multicast and locally administered (randomized) addresses aren't
+    # assigned to anybody
+    if mac & (macs.GROUP_BIT | macs.LOCAL_BIT):
+        return None
+
+    if _index is None:
+        try:
+            _index = OUIIndex(constants.OUI_INDEX_FILE)
+        except (OSError, ValueError) as err:
+            print("Manufacturers won't be looked up: {}".format(err))
+            _index = False
+
+    if not _index:
+        return None
+
+    return _index.lookup(mac)
+
+
+def find_registries():
+    """
+    Returns the registry files to build the index from: IEEE csv files or a
+    Wireshark manuf file from the first of constants.OUI_REGISTRY_DIRS that
+    has any. An empty list means scapy's copy of manuf should be used.
+    """
+    for directory in constants.OUI_REGISTRY_DIRS:
+        found = [
+            os.path.join(directory, fname)
+            for fname in IEEE_REGISTRY_FILES
+            if os.path.isfile(os.path.join(directory, fname))
+        ]
+        if not found and os.path.isfile(os.path.join(directory, MANUF_FILE)):
+            found = [os.path.join(directory, MANUF_FILE)]
+
+        if found:
+            return found
+
+    return []
+
+
+def read_ieee_csv(f):
+    """
+    Generator that yields (prefix, prefix bits, manufacturer) for every
+    assignment in an IEEE registry csv file
+    """
+    for row in csv.DictReader(f):
+        assignment = row.get("Assignment", "").strip()
+        name = row.get("Organization Name", "").strip()
+        if not assignment or not name:
+            continue
+
+        bits = len(assignment) * 4
+        yield int(assignment, 16), bits, name
+
+
+def read_manuf(f):
+    """
+    Generator that yields (prefix, prefix bits, manufacturer) for every line
+    of a Wireshark manuf file ("00:1B:C5:00:00:00/36 <short> <long>")
+    """
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        parts = line.split(None, 2)
+        if len(parts) < 2:
+            continue
+
+        address, _, bits = parts[0].partition("/")
+        address = address.replace(":", "").replace("-", "").replace(".", "")
+        try:
+            value = int(address, 16)
+        except ValueError:
+            continue
+
+        bits = int(bits) if bits else len(address) * 4
+        name = parts[2].lstrip("#").strip() if len(parts) > 2 else ""
+        yield value >> (len(address) * 4 - bits), bits, name or parts[1]
+
+
+def read_registry(fname):
+    """
+    Reads an IEEE csv registry or Wireshark manuf file, whichever fname is
+    """
+    with open(fname, newline="", encoding="utf-8", errors="replace") as f:
+        text = f.read()
+
+    if text.startswith("Registry,"):
+        return list(read_ieee_csv(io.StringIO(text)))
+
+    return list(read_manuf(io.StringIO(text)))
+
+
+def read_scapy_manuf():
+    """
+    Reads the copy of Wireshark's manuf that comes with scapy. Scapy versions
+    before 2.5 don't ship one and load the system's manuf file into
+    conf.manufdb instead, which is read back from there. Returns no
+    assignments if neither is available.
+    """
+    try:
+        # Imported here since it is a couple of megabytes of text that is
+        # only needed to build the index
+        from scapy.libs.manuf import DATA
+    except ImportError:
+        from scapy.config import conf
+
+        if conf.manufdb is None:
+            print("No manuf file found, manufacturers won't be looked up")
+            return []
+
+        # The long name goes last, where read_manuf looks for it
+        lines = (
+            "{} {} {}".format(prefix, *conf.manufdb[prefix])
+            for prefix in conf.manufdb.keys()
+        )
+        return list(read_manuf(lines))
+
+    return list(read_manuf(io.StringIO(DATA)))
+
+
+def flatten(assignments):
+    """
+    Turns (prefix, prefix bits, name) assignments into a sorted list of
+    non overlapping (first address, name) ranges, each running until the
+    next one starts. Gaps get a name of None.
+    """
+    blocks = []
+    for prefix, bits, name in assignments:
+        if not 0 < bits <= macs.MAC_BITS:
+            continue
+
+        start = prefix << (macs.MAC_BITS - bits)
+        blocks.append((start, start + (1 << (macs.MAC_BITS - bits)), name))
+
+    # Bigger blocks first so the ones nested in them come after
+    blocks.sort(key=lambda block: (block[0], -block[1]))
+
+    ranges = []
+
+    def add(start, name):
+        if ranges and ranges[-1][0] == start:
+            ranges[-1] = (start, name)
+        else:
+            ranges.append((start, name))
+
+        # Merge neighbours with the same manufacturer
+        if len(ranges) > 1 and ranges[-2][1] == name:
+            ranges.pop()
+
+    # (end, name) of the blocks the sweep is currently inside of
+    open_blocks = []
+    for start, end, name in blocks:
+        while open_blocks and open_blocks[-1][0] <= start:
+            closed = open_blocks.pop()
+            add(closed[0], open_blocks[-1][1] if open_blocks else None)
+
+        add(start, name)
+        open_blocks.append((end, name))
+
+    while open_blocks:
+        closed = open_blocks.pop()
+        add(closed[0], open_blocks[-1][1] if open_blocks else None)
+
+    return ranges
+
+
+def build_index(fname, registries=None):
+    """
+    Builds an index file from the given registry files, or scapy's manuf if
+    there aren't any. Returns the number of ranges in it.
+    """
+    assignments = []
+    for registry in registries or []:
+        assignments.extend(read_registry(registry))
+
+    if not assignments:
+        assignments = read_scapy_manuf()
+
+    ranges = flatten(assignments)
+
+    names = {}
+    name_ids = []
+    for _, name in ranges:
+        if name is None:
+            name_ids.append(NO_NAME)
+        else:
+            name_ids.append(names.setdefault(name, len(names)))
+
+    text = bytearray()
+    offsets = []
+    for name in names:
+        offsets.append(len(text))
+        text.extend(name.encode("utf-8"))
+    offsets.append(len(text))
+
+    starts = [start for start, _ in ranges]
+    buckets = [bisect.bisect_left(starts, bucket << BUCKET_SHIFT) for bucket in range(BUCKETS)]
+
+    # Written next to the index and moved over it so a worker never maps a
+    # half written file
+    partial = fname + ".partial"
+    with open(partial, "wb") as f:
+        f.write(_header.pack(INDEX_MAGIC, INDEX_VERSION, 0, len(ranges), len(names)))
+        f.write(struct.pack("={}Q".format(len(starts)), *starts))
+        f.write(struct.pack("={}I".format(BUCKETS), *buckets))
+        f.write(struct.pack("={}I".format(len(name_ids)), *name_ids))
+        f.write(struct.pack("={}I".format(len(offsets)), *offsets))
+        f.write(text)
+
+    os.replace(partial, fname)
+    return len(ranges)
+
+
+def index_is_stale(fname, registries):
+    """
+    Returns True if the index file is missing or older than the registry files
+    it would be built from
+    """
+    try:
+        built = os.path.getmtime(fname)
+    except OSError:
+        return True
+
+    return any(os.path.getmtime(registry) > built for registry in registries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query wifi_map's mac address manufacturer index.")
+    parser.add_argument("-o", "--index", default=constants.OUI_INDEX_FILE, help="Index file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="Build the index from IEEE csv or Wireshark manuf files")
+    build.add_argument("registries", nargs="*", help="Registry files. Defaults to the ones wifi_map looks for.")
+
+    query = commands.add_parser("lookup", help="Print the manufacturer of mac addresses")
+    query.add_argument("macs", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        registries = args.registries or find_registries()
+        ranges = build_index(args.index, registries)
+        print("Wrote {} ranges from {} to {}".format(
+            ranges,
+            ", ".join(registries) or "scapy's manuf",
+            args.index
+        ))
+    else:
+        index = OUIIndex(args.index)
+        for mac in args.macs:
+            print(mac, index.lookup(macs.parse(mac)))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,8 @@ from . import models
 
 ACTION_CREATE = "create"
 ACTION_UPDATE = "update"
+# The object is gone. Clients should forget it and anything attached to it.
+ACTION_DELETE = "delete"
 
 
 # def get_devices_state(addr1, addr2, addr3, addr4=None):
@@ -29,7 +31,7 @@ class StateChange():
     """
 
     def __init__(self, action, objtype, obj, updates=[]):
-        assert(action in [ACTION_CREATE, ACTION_UPDATE])
+        assert(action in [ACTION_CREATE, ACTION_UPDATE, ACTION_DELETE])
         self.action = action
         self.objtype = objtype
         self.obj = obj
@@ -46,7 +48,8 @@ class StateChange():
         dict_copy = {
             "action": self.action,
             "objtype": self.objtype.class_name,
-            "obj": models.to_dict(self.obj)
+            "obj": models.to_dict(self.obj),
+            "updates": self.updates
         }
 
         return dict_copy
@@ -0,0 +1,657 @@
+import itertools
+import time
+import zlib
+
+from peewee import fn
+
+from . import macs
+from . import oui
+from . import state
+from .cache import FingerprintCache
+from .constants import DEFAULT_FLUSH_INTERVAL, DEFAULT_FLUSH_BATCH_SIZE, \
+    DEFAULT_BEACON_CACHE_SIZE, DEFAULT_BEACON_CACHE_TTL, DEFAULT_DUPLICATE_CACHE_SIZE, \
+    DEFAULT_DUPLICATE_WINDOW, DEFAULT_CONNECTION_TIMEOUT, \
+    DEFAULT_MAX_STATIONS, DEFAULT_ARCHIVE_STATIONS, FRAME_SUBTYPE_BEACON, FRAME_SUBTYPE_PROBE_RES
+from .db_utils import get_db, upsert_many, delete_many
+from .models import Station, Network, Connection, StationArchive
+from .wheel import TimerWheel
+
+# Seconds (of capture time) before a station or network that belongs to
+# another partition is forwarded to its owner again just to refresh its
+# last_update.
+FORWARD_REFRESH_INTERVAL = 5.0
+
+# Seconds (of capture time) between looks for connections that went idle.
+# Also the resolution of their timer wheel.
+AGING_INTERVAL = 1.0
+
+# Observation kind telling the other partitions a station was evicted
+STATION_EVICTED = "station_evicted"
+
+# Network fields that beacons can change, in the order observe_network takes
+NETWORK_DETAILS = ("channel", "auth", "enc", "cipher")
+
+
+def partition_of(key, partitions):
+    """
+    Returns the index of the partition that owns the record with the given
+    key (an integer mac address or an ssid). This has to be stable across
+    processes so python's hash() can't be used on strings. The low bits of a
+    mac address are the serial number its manufacturer gave the device, so
+    they are spread out well enough as they are.
+    """
+    if isinstance(key, int):
+        return key % partitions
+
+    return zlib.crc32(key.encode("utf-8", "surrogateescape")) % partitions
+
+
+def get_last_conn_id():
+    """
+    Returns the highest conn_id in the connection table, or 0 if it is empty.
+    Queried once by whoever creates the stores so that the ids they hand out
+    continue from it.
+    """
+    return Connection.select(fn.MAX(Connection.conn_id)).scalar() or 0
+
+
+def flow_stations(addresses):
+    """
+    Yields the addresses in the address bytes of a data frame's flow key
+    that can be stations, as integers
+    """
+    for offset in range(0, len(addresses), macs.MAC_LEN):
+        mac = macs.from_raw(addresses, offset)
+        if macs.is_station(mac):
+            yield mac
+
+
+class StateStore():
+    """
+    In memory copy of the part of the station, network and connection tables
+    that one worker owns.
+
+    State is split into partitions and each partition is only ever touched by
+    the worker that owns it, so nothing here needs a lock. Stations are owned
+    by the partition of their mac, networks by the partition of their ssid and
+    connections by the partition of their anchor station (the BSSID for AP
+    to client connections). Frames are routed to the owner of their BSSID so
+    most of what a frame touches is already local. Observations of records
+    owned by another partition are put in that partition's mailbox and applied
+    by its worker.
+
+    Records that changed are marked dirty and written back to the database by
+    the owning worker in a single transaction every flush_interval seconds, or
+    sooner once flush_batch_size records are dirty.
+
+    beacons remembers the information elements last seen from each BSSID so
+    that repeated beacons and probe responses can be skipped before they
+    touch any state. A beacon_cache_size of 0 turns that off.
+
+    duplicates does the same for data frames, which are the bulk of the
+    traffic. Their handler only looks at the addresses and frame control, so
+    repeats of a frame within duplicate_window seconds of capture time change
+    nothing but last_update and are skipped before they are even decoded.
+    Records that see steady traffic are still refreshed once a window, and
+    the stations in a skipped frame get a new last_update in memory right
+    away. A duplicate_cache_size of 0 turns that off.
+
+    Connections that carry no traffic for connection_timeout seconds of
+    capture time are marked disconnected by age_connections. Each one sits
+    in a timer wheel under the time it would expire if it saw no more
+    traffic, and is only looked at again once that time comes, so aging
+    costs nothing for connections that stay busy.
+
+    At most max_stations stations are kept across all partitions, each
+    partition keeping its share. Stations are kept in the order they were
+    last seen in, so once a partition has too many the first one is the
+    one to evict. Evicting a station deletes its row (moving it to the
+    station_archive table if archive_stations is set) at the next flush and
+    tells the other partitions, and every partition drops its connections
+    to it. Clients get a delete for each. A station that shows up again is
+    created anew. A max_stations of 0 keeps every station.
+    """
+
+    def __init__(self, partition=0, partitions=1, mailboxes=None,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 flush_batch_size=DEFAULT_FLUSH_BATCH_SIZE,
+                 beacon_cache_size=DEFAULT_BEACON_CACHE_SIZE,
+                 beacon_cache_ttl=DEFAULT_BEACON_CACHE_TTL,
+                 duplicate_cache_size=DEFAULT_DUPLICATE_CACHE_SIZE,
+                 duplicate_window=DEFAULT_DUPLICATE_WINDOW,
+                 connection_timeout=DEFAULT_CONNECTION_TIMEOUT,
+                 max_stations=DEFAULT_MAX_STATIONS,
+                 archive_stations=DEFAULT_ARCHIVE_STATIONS,
+                 last_conn_id=0):
+        self.partition = partition
+        self.partitions = partitions
+        self.mailboxes = mailboxes
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.stations = {}
+        self.networks = {}
+        # keyed by the macs.pair_key of station1 and station2
+        self.connections = {}
+
+        # This partition's share of max_stations, rounded up
+        self.max_stations = -(-max_stations // partitions) if max_stations else 0
+        self.archive_stations = archive_stations
+        # Stations evicted since the last flush, to be deleted then
+        self.evicted = []
+        # (station1, station2) of the connections dropped with them since
+        # the last flush, to be deleted then too
+        self.dropped = []
+        # mac -> keys of the connections it is part of, so they can be
+        # dropped with it. Only kept when stations can be evicted.
+        self.station_connections = {}
+
+        # keys of the records that changed since the last flush
+        self.dirty = {
+            Station: set(),
+            Network: set(),
+            Connection: set()
+        }
+
+        # What was last forwarded to other partitions, so the same
+        # observation isn't sent over and over
+        self.forwarded_stations = {}
+        self.forwarded_networks = {}
+
+        self.beacons = None
+        if beacon_cache_size:
+            self.beacons = FingerprintCache(beacon_cache_size, beacon_cache_ttl)
+
+        self.duplicates = None
+        if duplicate_cache_size:
+            self.duplicates = FingerprintCache(duplicate_cache_size, duplicate_window)
+        # mac -> addresses (the key in duplicates) of the data flows it is in,
+        # so they can be dropped from the cache with it. Only kept when
+        # stations can be evicted.
+        self.station_flows = {}
+
+        self.connection_timeout = connection_timeout
+        self.connection_wheel = None
+        # Capture time after which age_connections should be called next.
+        # Checked before every frame, so it is a plain attribute.
+        self.next_aging = float("inf")
+        if connection_timeout:
+            self.connection_wheel = TimerWheel(tick=AGING_INTERVAL)
+            self.next_aging = 0.0
+        # keys that have an entry in the wheel. A connection only ever needs
+        # one since age_connections reschedules it from its last_update.
+        self.aging = set()
+
+        # Connection ids are handed out here rather than by the database so
+        # that clients get them as soon as the connection is seen. Every
+        # partition counts in steps of the partition count so ids never clash.
+        # They start after last_conn_id, see get_last_conn_id.
+        self._conn_ids = itertools.count(last_conn_id + 1 + partition, partitions)
+        self._last_flush = time.monotonic()
+
+        # Write throughput stats
+        self.flush_count = 0
+        self.flushed_rows = 0
+        self.flush_seconds = 0.0
+
+        # Connection stats
+        self.connections_expired = 0
+        self.connections_closed = 0
+
+        # Eviction stats
+        self.stations_evicted = 0
+        self.connections_dropped = 0
+
+    def owns(self, key):
+        """
+        Returns True if the record with the given key belongs to this partition
+        """
+        return self.partitions == 1 or partition_of(key, self.partitions) == self.partition
+
+    def apply(self, observation):
+        """
+        Applies an observation that another partition forwarded to this one.
+        Returns the resulting state changes.
+        """
+        kind, args = observation
+        if kind == Station.class_name:
+            return self.observe_station(*args)
+        elif kind == Network.class_name:
+            return self.observe_network(*args)
+        elif kind == Connection.class_name:
+            return self.observe_connection(*args)
+        elif kind == STATION_EVICTED:
+            return self.forget_station(*args)
+
+        raise ValueError("Unknown observation type {}".format(kind))
+
+    def _forward(self, key, observation):
+        owner = partition_of(key, self.partitions)
+        self.mailboxes[owner].put(observation)
+
+    def observe_station(self, mac, time_recieved, is_ap=False, ssid=None):
+        """
+        Records that a station was seen. Returns the resulting state changes.
+        """
+        if not self.owns(mac):
+            last = self.forwarded_stations.get(mac)
+            if last is None or (is_ap and not last[0]) or (ssid and not last[1]) \
+                    or time_recieved - last[2] > FORWARD_REFRESH_INTERVAL:
+                self.forwarded_stations[mac] = (
+                    is_ap or (last is not None and last[0]),
+                    ssid or (last[1] if last is not None else None),
+                    time_recieved
+                )
+                self._forward(mac, (Station.class_name, (mac, time_recieved, is_ap, ssid)))
+
+            return []
+
+        state_changes = []
+
+        sta = self.stations.get(mac)
+        if sta is None:
+            sta = Station(
+                mac=macs.to_str(mac),
+                is_ap=is_ap,
+                ssid=ssid,
+                manufacturer=oui.lookup(mac),
+                last_update=time_recieved
+            )
+            self.stations[mac] = sta
+            state_changes.append(state.StateChange(
+                state.ACTION_CREATE,
+                Station,
+                sta
+            ))
+
+            if self.max_stations and len(self.stations) > self.max_stations:
+                state_changes.extend(self.evict_station())
+        else:
+            if self.max_stations:
+                # Move it to the end so the first station is always the one
+                # seen longest ago
+                del self.stations[mac]
+                self.stations[mac] = sta
+
+            updates = []
+            # we've got an existing AP that hasn't been marked as one yet.
+            if is_ap and not sta.is_ap:
+                sta.is_ap = True
+                updates.append("is_ap")
+
+            if ssid and not sta.ssid:
+                sta.ssid = ssid
+                updates.append("ssid")
+
+            if time_recieved > sta.last_update:
+                sta.last_update = time_recieved
+
+            if updates:
+                state_changes.append(state.StateChange(
+                    state.ACTION_UPDATE,
+                    Station,
+                    sta,
+                    updates=updates
+                ))
+
+        self.dirty[Station].add(mac)
+
+        return state_changes
+
+    def observe_network(self, ssid, time_recieved, channel=None, auth=None, enc=None, cipher=None):
+        """
+        Records that a network was seen. Returns the resulting state changes.
+        """
+        details = (channel, auth, enc, cipher)
+        if not self.owns(ssid):
+            last = self.forwarded_networks.get(ssid)
+            if last is None or last[1] != details or time_recieved - last[0] > FORWARD_REFRESH_INTERVAL:
+                self.forwarded_networks[ssid] = (time_recieved, details)
+                self._forward(ssid, (Network.class_name, (ssid, time_recieved) + details))
+
+            return []
+
+        state_changes = []
+
+        network = self.networks.get(ssid)
+        if network is None:
+            network = Network(
+                ssid=ssid,
+                channel=channel,
+                auth=auth,
+                enc=enc,
+                cipher=cipher,
+                last_update=time_recieved
+            )
+            self.networks[ssid] = network
+            state_changes.append(state.StateChange(
+                state.ACTION_CREATE,
+                Network,
+                network
+            ))
+        else:
+            updates = []
+            for field, value in zip(NETWORK_DETAILS, details):
+                # The access points of one network are usually spread over
+                # several channels, so only fill the channel in once rather
+                # than flip between them
+                if value is None or (field == "channel" and network.channel is not None):
+                    continue
+
+                if getattr(network, field) != value:
+                    setattr(network, field, value)
+                    updates.append(field)
+
+            if time_recieved > network.last_update:
+                network.last_update = time_recieved
+
+            if updates:
+                state_changes.append(state.StateChange(
+                    state.ACTION_UPDATE,
+                    Network,
+                    network,
+                    updates=updates
+                ))
+
+        self.dirty[Network].add(ssid)
+
+        return state_changes
+
+    def observe_connection(self, anchor, mac, time_recieved, connected=True):
+        """
+        Records traffic between two stations, or with connected=False that
+        one of them disconnected the other. The connection belongs to the
+        partition of anchor. Returns the resulting state changes.
+        """
+        # NOTE: two APs talking to each other could be each other's anchor in
+        # different frames, in which case both partitions track the pair. The
+        # flush upserts on UNIQUE (station1, station2) so the database still
+        # ends up with one row.
+        if not self.owns(anchor):
+            # Connections carry last_update so they are always forwarded.
+            self._forward(anchor, (Connection.class_name, (anchor, mac, time_recieved, connected)))
+            return []
+
+        state_changes = []
+        # Connections forwarded from other partitions can get here before
+        # this partition has seen a frame, and the wheel has to be started
+        # before anything goes in it
+        if time_recieved >= self.next_aging:
+            state_changes.extend(self.age_connections(time_recieved))
+
+        key = macs.pair_key(anchor, mac)
+
+        con = self.connections.get(key)
+        if con is None and not connected:
+            # Nothing to disconnect
+            return state_changes
+        elif con is None:
+            # connection.station1 and connection.station2 are sorted, which
+            # is the same order for the integers and their strings
+            station1, station2 = macs.split_pair(key)
+            con = Connection(
+                conn_id=next(self._conn_ids),
+                station1=macs.to_str(station1),
+                station2=macs.to_str(station2),
+                connected=True,
+                last_update=time_recieved
+            )
+            self.connections[key] = con
+            self._schedule_aging(key, time_recieved)
+            if self.max_stations:
+                self.station_connections.setdefault(anchor, set()).add(key)
+                self.station_connections.setdefault(mac, set()).add(key)
+            state_changes.append(state.StateChange(
+                state.ACTION_CREATE,
+                Connection,
+                con
+            ))
+        else:
+            if con.connected != connected:
+                con.connected = connected
+                if connected:
+                    self._schedule_aging(key, time_recieved)
+                else:
+                    self.connections_closed += 1
+
+                state_changes.append(state.StateChange(
+                    state.ACTION_UPDATE,
+                    Connection,
+                    con,
+                    updates=["connected"]
+                ))
+
+            if time_recieved > con.last_update:
+                con.last_update = time_recieved
+
+        self.dirty[Connection].add(key)
+
+        return state_changes
+
+    def evict_station(self):
+        """
+        Evicts the station seen longest ago. Returns the resulting state
+        changes.
+        """
+        mac = next(iter(self.stations))
+        sta = self.stations.pop(mac)
+        self.dirty[Station].discard(mac)
+        self.evicted.append(sta)
+        self.stations_evicted += 1
+
+        # So that its next beacon is handled and creates it again. The beacon
+        # cache is keyed by (bssid, subtype).
+        if self.beacons is not None:
+            self.beacons.discard((mac, FRAME_SUBTYPE_BEACON))
+            self.beacons.discard((mac, FRAME_SUBTYPE_PROBE_RES))
+
+        for partition, mailbox in enumerate(self.mailboxes or []):
+            if partition != self.partition:
+                mailbox.put((STATION_EVICTED, (mac,)))
+
+        state_changes = [state.StateChange(state.ACTION_DELETE, Station, sta)]
+        state_changes.extend(self.forget_station(mac))
+
+        return state_changes
+
+    def forget_station(self, mac):
+        """
+        Drops this partition's connections to a station that was evicted.
+        Returns the resulting state changes.
+        """
+        # Its next observation has to reach the owner to create it again
+        self.forwarded_stations.pop(mac, None)
+        # and so does its next data frame
+        for addresses in self.station_flows.pop(mac, ()):
+            self.duplicates.discard(addresses)
+            for other in flow_stations(addresses):
+                flows = self.station_flows.get(other)
+                if flows is not None:
+                    flows.discard(addresses)
+                    if not flows:
+                        del self.station_flows[other]
+
+        state_changes = []
+        for key in self.station_connections.pop(mac, ()):
+            con = self.connections.pop(key, None)
+            if con is None:
+                continue
+
+            # The wheel still has the key but skips connections that are gone.
+            # If the connection comes back it reuses that entry.
+            self.dirty[Connection].discard(key)
+            self.dropped.append((con.station1, con.station2))
+            station1, station2 = macs.split_pair(key)
+            other = station2 if station1 == mac else station1
+            others = self.station_connections.get(other)
+            if others is not None:
+                others.discard(key)
+                if not others:
+                    del self.station_connections[other]
+
+            state_changes.append(state.StateChange(state.ACTION_DELETE, Connection, con))
+
+        self.connections_dropped += len(state_changes)
+        return state_changes
+
+    def track_flow(self, addresses):
+        """
+        Remembers which stations are in a data flow that was just added to
+        the duplicate cache, so that it can be dropped when one of them is
+        evicted
+        """
+        if self.max_stations:
+            for mac in flow_stations(addresses):
+                self.station_flows.setdefault(mac, set()).add(addresses)
+
+    def refresh_flow(self, addresses, time_recieved):
+        """
+        Refreshes the stations this partition owns in a data flow whose frame
+        was skipped as a duplicate. Only the copies in memory are touched, it
+        is just so a busy station isn't the one evicted. The next frame of
+        the flow that is handled updates the rows.
+        """
+        # Called for most data frames, so this skips flow_stations. Group
+        # addresses are never in stations anyway.
+        stations = self.stations
+        for offset in range(0, len(addresses), macs.MAC_LEN):
+            mac = macs.from_raw(addresses, offset)
+            sta = stations.get(mac)
+            if sta is None:
+                continue
+
+            if time_recieved > sta.last_update:
+                sta.last_update = time_recieved
+            if self.max_stations:
+                del stations[mac]
+                stations[mac] = sta
+
+    def _schedule_aging(self, key, time_recieved):
+        if self.connection_wheel is not None and key not in self.aging:
+            self.aging.add(key)
+            self.connection_wheel.schedule(key, time_recieved + self.connection_timeout)
+
+    def age_connections(self, time_recieved):
+        """
+        Marks connections that have been idle for connection_timeout seconds
+        as disconnected. Returns the resulting state changes, all at once.
+        """
+        self.next_aging = time_recieved + AGING_INTERVAL
+        state_changes = []
+
+        for key in self.connection_wheel.advance(time_recieved):
+            self.aging.discard(key)
+            con = self.connections.get(key)
+            if con is None or not con.connected:
+                continue
+
+            expires = con.last_update + self.connection_timeout
+            if expires > time_recieved:
+                # Saw traffic since it was scheduled
+                self._schedule_aging(key, con.last_update)
+                continue
+
+            con.connected = False
+            self.dirty[Connection].add(key)
+            state_changes.append(state.StateChange(
+                state.ACTION_UPDATE,
+                Connection,
+                con,
+                updates=["connected"]
+            ))
+
+        self.connections_expired += len(state_changes)
+        return state_changes
+
+    def flush_if_due(self):
+        """
+        Flushes dirty records if flush_interval has passed since the last flush
+        or there are at least flush_batch_size of them
+        """
+        if time.monotonic() - self._last_flush >= self.flush_interval \
+                or sum(len(keys) for keys in self.dirty.values()) + len(self.evicted) \
+                + len(self.dropped) >= self.flush_batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all dirty records to the database in a single transaction
+        """
+        tables = [
+            (Station, self.stations, None),
+            (Network, self.networks, None),
+            # Upserting on the station pair writes the conn_id clients were
+            # sent, over the one a connection had before it was dropped and
+            # seen again or before a restart. If two partitions both end up
+            # tracking the same pair the last one to flush wins.
+            (Connection, self.connections, (Connection.station1, Connection.station2))
+        ]
+
+        start = time.monotonic()
+        self._last_flush = start
+
+        if not any(self.dirty.values()) and not self.evicted and not self.dropped:
+            return
+
+        rows = 0
+        with get_db().atomic():
+            # Before the upserts, in case an evicted station came back
+            if self.evicted:
+                if self.archive_stations:
+                    upsert_many(StationArchive, self.evicted)
+
+                delete_many(Station, [sta.mac for sta in self.evicted])
+                rows += len(self.evicted)
+                self.evicted = []
+
+            if self.dropped:
+                delete_many(Connection, self.dropped, (Connection.station1, Connection.station2))
+                rows += len(self.dropped)
+                self.dropped = []
+
+            for model, records, conflict_target in tables:
+                keys = self.dirty[model]
+                self.dirty[model] = set()
+                upsert_many(model, (records[key] for key in keys), conflict_target)
+                rows += len(keys)
+
+        self.flush_count += 1
+        self.flushed_rows += rows
+        self.flush_seconds += time.monotonic() - start
+
+    def station_stats(self):
+        """
+        Returns a one line summary of the stations and how many were evicted
+        """
+        return "{} stations (at most {}), {} evicted{}, {} connections dropped with them".format(
+            len(self.stations),
+            self.max_stations or "unlimited",
+            self.stations_evicted,
+            " to the archive" if self.archive_stations else "",
+            self.connections_dropped
+        )
+
+    def connection_stats(self):
+        """
+        Returns a one line summary of the connections and how they ended
+        """
+        connected = sum(1 for con in self.connections.values() if con.connected)
+        return "{} connections ({} connected), {} disconnected, {} timed out, {} waiting to age".format(
+            len(self.connections),
+            connected,
+            self.connections_closed,
+            self.connections_expired,
+            len(self.connection_wheel) if self.connection_wheel is not None else 0
+        )
+
+    def flush_stats(self):
+        """
+        Returns a one line summary of how much has been written to the database
+        """
+        rate = self.flushed_rows / self.flush_seconds if self.flush_seconds else 0
+        return "partition {}: wrote {} rows in {} transactions ({:.3f}s, {:.0f} rows/s)".format(
+            self.partition,
+            self.flushed_rows,
+            self.flush_count,
+            self.flush_seconds,
+            rate
+        )
@@ -0,0 +1,338 @@
+"""
+Per frame tracing and sampling profiling, for finding the rare frames (or
+code paths) that are much slower than the average.
+
+Tracing writes a JSON lines file (gzipped if its name ends in .gz). The first
+line is a header listing the fields of each kind of record, and every line
+after it is a list starting with the record kind:
+
+    frame  a sampled frame and how long decoding, handling and serializing
+           its changes took
+    flush  a worker writing its state to the database
+    emit   the server sending a round of updates to browsers
+
+Every sample'th frame is traced, along with every frame that takes longer
+than slow seconds, so slow frames show up no matter how rare they are.
+
+The sampling profiler looks at the stack of every thread every so often and
+writes how many times each stack was seen in the folded format used by
+flamegraph.pl, speedscope and friends.
+
+Run this module with a trace file to print the slowest frames in it:
+
+    python -m wmap_common.trace trace.jsonl.gz
+"""
+import argparse
+import collections
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+
+from . import constants
+from . import macs
+
+TRACE_VERSION = 1
+
+RECORD_FRAME = "frame"
+RECORD_FLUSH = "flush"
+RECORD_EMIT = "emit"
+
+# Fields of each kind of record, after the kind. Times are in microseconds
+# except for ts, which is the capture timestamp for frames and the wall clock
+# time otherwise.
+RECORD_FIELDS = {
+    RECORD_FRAME: [
+        "ts", "worker", "type", "subtype", "addr1", "addr2", "addr3", "length",
+        "decode_us", "handler_us", "serialize_us", "changes"
+    ],
+    RECORD_FLUSH: ["ts", "worker", "rows", "flush_us"],
+    RECORD_EMIT: ["ts", "messages", "changes", "emit_us"]
+}
+
+# Workers hand their records to the writer once they have this many
+TRACE_BATCH_SIZE = 256
+
+# How often the profiler samples stacks, in seconds
+PROFILE_INTERVAL = 0.005
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def micros(seconds):
+    return round(seconds * 1e6, 1)
+
+
+def format_mac(mac):
+    return None if mac is None else macs.to_str(mac)
+
+
+class TraceRecords(list):
+    """
+    A batch of trace records sent from a worker process to the parent
+    """
+    pass
+
+
+class StackCounts(collections.Counter):
+    """
+    Folded stack -> number of times it was sampled
+    """
+    pass
+
+
+class TraceWriter():
+    """
+    Writes trace records to a file. Safe to use from any thread.
+    """
+
+    def __init__(self, fname, sample=constants.DEFAULT_TRACE_SAMPLE, slow=constants.DEFAULT_TRACE_SLOW):
+        self.fname = fname
+        self.sample = sample
+        self.slow = slow
+        self.records = 0
+        self._lock = threading.Lock()
+
+        opener = gzip.open if fname.endswith(".gz") else open
+        self._file = opener(fname, "wt")
+        self._file.write(json.dumps({
+            "wifi_map_trace": TRACE_VERSION,
+            "fields": RECORD_FIELDS,
+            "sample": sample,
+            "slow_us": micros(slow)
+        }) + "\n")
+
+    def write(self, records):
+        if not records:
+            return
+
+        lines = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(lines)
+                self._file.flush()
+                self.records += len(records)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def get_writer(config=constants.DEFAULT_CONFIG):
+    """
+    Returns the TraceWriter of this process, opening it the first time, or
+    None if tracing isn't on
+    """
+    global _writer
+
+    fname = config.get("trace", constants.DEFAULT_TRACE)
+    if fname is None:
+        return None
+
+    with _writer_lock:
+        if _writer is None:
+            _writer = TraceWriter(
+                fname,
+                sample=config.get("trace_sample", constants.DEFAULT_TRACE_SAMPLE),
+                slow=config.get("trace_slow", constants.DEFAULT_TRACE_SLOW)
+            )
+
+        return _writer
+
+
+class FrameTracer():
+    """
+    Collects the trace records of one worker and hands them to sink (a
+    function taking a list of records) in batches. Only its worker uses it.
+    """
+
+    def __init__(self, worker, sink, sample=constants.DEFAULT_TRACE_SAMPLE, slow=constants.DEFAULT_TRACE_SLOW):
+        self.worker = worker
+        self.sink = sink
+        self.sample = sample
+        self.slow = slow
+        self.records = []
+        self._seen = 0
+        self._flushes = 0
+        self._flushed_rows = 0
+        self._flush_seconds = 0.0
+
+    def frame(self, time_recieved, frame, length, decode_seconds, handler_seconds, serialize_seconds, changes):
+        """
+        Records a frame if it is one of the sampled ones or was slow
+        """
+        self._seen += 1
+        if self._seen % self.sample and decode_seconds + handler_seconds + serialize_seconds < self.slow:
+            return
+
+        self.records.append([
+            RECORD_FRAME,
+            time_recieved,
+            self.worker,
+            frame.type,
+            frame.subtype,
+            format_mac(frame.addr1),
+            format_mac(frame.addr2),
+            format_mac(frame.addr3),
+            length,
+            micros(decode_seconds),
+            micros(handler_seconds),
+            micros(serialize_seconds),
+            changes
+        ])
+
+    def check_flush(self, store):
+        """
+        Records any flushes the store did since the last call
+        """
+        if store.flush_count == self._flushes:
+            return
+
+        self.records.append([
+            RECORD_FLUSH,
+            time.time(),
+            self.worker,
+            store.flushed_rows - self._flushed_rows,
+            micros(store.flush_seconds - self._flush_seconds)
+        ])
+        self._flushes = store.flush_count
+        self._flushed_rows = store.flushed_rows
+        self._flush_seconds = store.flush_seconds
+
+    def send(self, force=False):
+        """
+        Hands the collected records to the sink once there are enough of
+        them, or right away with force
+        """
+        if len(self.records) >= TRACE_BATCH_SIZE or (force and self.records):
+            self.sink(self.records)
+            self.records = []
+
+
+def emit_record(messages, changes, seconds):
+    return [RECORD_EMIT, time.time(), messages, changes, micros(seconds)]
+
+
+class StackSampler():
+    """
+    Sampling profiler. A thread records the stack of every other thread of
+    the process every interval seconds.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL, prefix=""):
+        self.interval = interval
+        # Put in front of every thread name, to tell processes apart
+        self.prefix = prefix
+        self.counts = StackCounts()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling and returns the StackCounts
+        """
+        self._stopped.set()
+        self._thread.join()
+        return self.counts
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(
+                        code.co_name,
+                        os.path.basename(code.co_filename),
+                        code.co_firstlineno
+                    ))
+                    frame = frame.f_back
+
+                stack.append(self.prefix + names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+
+
+def write_folded(fname, counts):
+    """
+    Writes stack counts in the folded format, one "stack count" per line
+    """
+    with open(fname, "w") as f:
+        for stack, count in counts.most_common():
+            f.write("{} {}\n".format(stack, count))
+
+
+def read_trace(fname):
+    """
+    Generator that yields the records of a trace file as dicts
+    """
+    opener = gzip.open if fname.endswith(".gz") else open
+    with opener(fname, "rt") as f:
+        header = json.loads(f.readline())
+        fields = header["fields"]
+
+        try:
+            for line in f:
+                record = json.loads(line)
+                entry = dict(zip(fields[record[0]], record[1:]))
+                entry["kind"] = record[0]
+                yield entry
+        except EOFError:
+            # wifi_map runs until it is killed, so gzipped traces are
+            # usually missing their end. Every record was flushed though.
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the slowest frames in a wifi_map trace.")
+    parser.add_argument("fname", help="Trace file written with --trace")
+    parser.add_argument("-n", "--top", type=int, default=20, help="Number of frames to show")
+    args = parser.parse_args()
+
+    frames = []
+    kinds = collections.Counter()
+    for record in read_trace(args.fname):
+        kinds[record["kind"]] += 1
+        if record["kind"] == RECORD_FRAME:
+            record["total_us"] = record["decode_us"] + record["handler_us"] + record["serialize_us"]
+            frames.append(record)
+
+    print(", ".join("{} {} records".format(count, kind) for kind, count in sorted(kinds.items())))
+    if not frames:
+        return
+
+    frames.sort(key=lambda record: record["total_us"])
+    print("median traced frame {:.1f}us (slow frames are always traced)".format(frames[len(frames) // 2]["total_us"]))
+    print()
+    print("{:>10} {:>9} {:>9} {:>9}  {:<8} {:<17} {:<17} {:<17} {:>6}".format(
+        "total_us", "decode", "handler", "serial", "type", "addr1", "addr2", "addr3", "bytes"
+    ))
+
+    for record in reversed(frames[-args.top:]):
+        print("{:>10.1f} {:>9.1f} {:>9.1f} {:>9.1f}  {:<8} {:<17} {:<17} {:<17} {:>6}".format(
+            record["total_us"],
+            record["decode_us"],
+            record["handler_us"],
+            record["serialize_us"],
+            "{}/{}".format(record["type"], record["subtype"]),
+            record["addr1"] or "-",
+            record["addr2"] or "-",
+            record["addr3"] or "-",
+            record["length"]
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+class TimerWheel():
+    """
+    Hierarchical timer wheel. Keys are scheduled to fire at a deadline and
+    advance hands back the ones whose deadline has passed.
+
+    Time is counted in ticks of tick seconds. The first level has a slot for
+    each of the next slots ticks, and each level after it has slots that are
+    slots times wider than the one before. A key goes in the lowest level
+    that reaches its deadline, and when the first level wraps around the next
+    slot of the level above is spread out over the levels below it. Scheduling
+    and firing a key are O(1), and advancing only touches the slots that were
+    passed, so the cost depends on how many keys expire rather than on how
+    many are scheduled.
+
+    Deadlines are rounded down to a tick, so keys can fire up to a tick
+    early. Keys aren't unscheduled or moved. Whoever gets a key back checks
+    whether it really expired and schedules it again if not, which makes
+    pushing a deadline back (the common case) free.
+
+    The wheel starts at the first time it is advanced to, so it should be
+    advanced before anything is scheduled. Like the StateStore it belongs
+    to, only one worker touches a wheel so it needs no lock.
+    """
+
+    def __init__(self, tick=1.0, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        # levels of slots of [(deadline tick, key), ...]
+        self._wheel = [[[] for _ in range(slots)] for _ in range(levels)]
+        # number of ticks one slot of each level covers
+        self._spans = [slots ** level for level in range(levels)]
+        # number of keys in each level, so empty stretches can be skipped
+        self._counts = [0] * levels
+        self._now = None
+        # keys scheduled with a deadline that had already passed
+        self._due = []
+        self.scheduled = 0
+
+    def __len__(self):
+        return self.scheduled
+
+    def schedule(self, key, deadline):
+        """
+        Schedules key to be returned by advance once deadline (in seconds)
+        has passed
+        """
+        when = int(deadline / self.tick)
+        if self._now is None:
+            self._now = when
+
+        self.scheduled += 1
+        if when <= self._now:
+            self._due.append(key)
+        else:
+            self._insert(when, key)
+
+    def _insert(self, when, key):
+        delta = when - self._now
+        if delta <= 0:
+            # Cascaded into the tick that is about to be looked at
+            self._wheel[0][self._now % self.slots].append((when, key))
+            self._counts[0] += 1
+            return
+
+        for level in range(self.levels):
+            if delta < self._spans[level] * self.slots or level == self.levels - 1:
+                span = self._spans[level]
+                # Anything beyond the last level waits in its furthest slot
+                # and is put back when that slot comes around
+                when_slot = min(when, self._now + span * (self.slots - 1))
+                self._wheel[level][(when_slot // span) % self.slots].append((when, key))
+                self._counts[level] += 1
+                return
+
+    def advance(self, now):
+        """
+        Moves the wheel on to now (in seconds) and returns the keys whose
+        deadline has passed
+        """
+        target = int(now / self.tick)
+        if self._now is None:
+            self._now = target
+
+        if target <= self._now and not self._due:
+            return []
+
+        expired = self._due
+        self._due = []
+
+        if target <= self._now or self.scheduled == len(expired):
+            self._now = max(self._now, target)
+            self.scheduled -= len(expired)
+            return expired
+
+        # A jump past everything the wheel can hold in one go (like a gap in
+        # a capture file) is cheaper to do by taking every key out
+        if target - self._now >= self._spans[-1] * self.slots:
+            self.scheduled -= len(expired)
+            return expired + self._reset(target)
+
+        while self._now < target:
+            self._skip(target)
+            self._now += 1
+            self._cascade()
+
+            slot = self._now % self.slots
+            entries = self._wheel[0][slot]
+            if entries:
+                self._wheel[0][slot] = []
+                self._counts[0] -= len(entries)
+                for when, key in entries:
+                    if when <= self._now:
+                        expired.append(key)
+                    else:
+                        # Cascaded early from a wide slot
+                        self._insert(when, key)
+
+        self.scheduled -= len(expired)
+        return expired
+
+    def _skip(self, target):
+        """
+        Jumps over ticks that can't fire or cascade anything: when the lowest
+        levels are empty nothing happens until the next slot of the first
+        level that isn't comes around
+        """
+        for level in range(self.levels):
+            if self._counts[level]:
+                break
+        else:
+            self._now = target - 1
+            return
+
+        if level:
+            span = self._spans[level]
+            self._now = max(self._now, min(target, (self._now // span + 1) * span) - 1)
+
+    def _cascade(self):
+        """
+        Spreads the slot of each higher level that the first level just
+        wrapped into over the levels below it
+        """
+        for level in range(1, self.levels):
+            span = self._spans[level]
+            if self._now % span:
+                return
+
+            slot = (self._now // span) % self.slots
+            entries = self._wheel[level][slot]
+            if entries:
+                self._wheel[level][slot] = []
+                self._counts[level] -= len(entries)
+                for when, key in entries:
+                    self._insert(when, key)
+
+    def _reset(self, target):
+        entries = [entry for level in self._wheel for slot in level for entry in slot]
+        self._wheel = [[[] for _ in range(self.slots)] for _ in range(self.levels)]
+        self._counts = [0] * self.levels
+        self._now = target
+
+        expired = []
+        for when, key in entries:
+            if when <= target:
+                expired.append(key)
+            else:
+                self._insert(when, key)
+
+        self.scheduled -= len(expired)
+        return expired
@@ -0,0 +1,273 @@
+"""
+Asyncio version of the server. Serves the page, /init and the socket.io
+stream from a single event loop instead of a thread per client, so a lot of
+browsers can watch the same sensor.
+
+Needs aiohttp, which the default threaded server doesn't.
+"""
+import asyncio
+import inspect
+import os
+import queue
+import threading
+import time
+
+from aiohttp import web
+import socketio
+
+from wmap_common import constants
+from wmap_common import metrics
+from wmap_common import trace
+from . import protocol
+from . import wire
+from .broadcast import ClientFormats, Coalescer, EmitStats, StateView, UpdateLog, broadcast_collector
+
+# Max number of updates moved from the update queue to the event loop at once
+FORWARD_BATCH_SIZE = 1000
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_server(update_queue, config=constants.DEFAULT_CONFIG):
+    """
+    Runs the server until the process exits
+    """
+    print("Client started on port {0}. Open 'http://localhost:{0}' in browser.".format(config["portno"]))
+
+    try:
+        asyncio.run(serve(update_queue, config))
+    except KeyboardInterrupt:
+        print("Shutting down...")
+
+
+async def serve(update_queue, config=constants.DEFAULT_CONFIG):
+    """
+    Sets up the server on the running event loop and serves forever
+    """
+    server = AsyncServer(update_queue, config)
+    runner = web.AppRunner(server.app)
+    await runner.setup()
+
+    site = web.TCPSite(runner, "localhost", config["portno"])
+    await site.start()
+
+    try:
+        await server.emit_updates()
+    finally:
+        await runner.cleanup()
+
+
+class AsyncServer():
+    """
+    The web app and socket.io server along with the state they serve.
+
+    Updates are moved from the update queue (filled by the worker threads or
+    processes) into the coalescer by a thread, so nothing on the event loop
+    ever waits on the queue.
+    """
+
+    def __init__(self, update_queue, config=constants.DEFAULT_CONFIG):
+        self.interval = config.get("emit_interval", constants.DEFAULT_EMIT_INTERVAL)
+        self.max_changes = config.get("emit_max_changes", constants.DEFAULT_EMIT_MAX_CHANGES)
+
+        self.view = StateView()
+        self.update_log = UpdateLog(config.get("update_log_size", constants.DEFAULT_UPDATE_LOG_SIZE))
+        # Each format has a room with the clients that use it
+        self.client_formats = ClientFormats(wire.FORMATS)
+        self.coalescer = Coalescer()
+        # Set when the coalescer has something to send
+        self.pending = asyncio.Event()
+
+        self.emit_stats = EmitStats()
+        self.trace_writer = trace.get_writer(config)
+        self.metrics_enabled = config.get("metrics", constants.DEFAULT_METRICS)
+        if self.metrics_enabled:
+            metrics.REGISTRY.register(broadcast_collector(
+                self.emit_stats, update_queue, self.coalescer, self.view, self.update_log, self.client_formats
+            ))
+
+        self.sio = socketio.AsyncServer(async_mode="aiohttp")
+        self.sio.on("connect", self.connect)
+        self.sio.on("disconnect", self.disconnect)
+        self.sio.on("hello", self.hello)
+        self.sio.on("resync", self.resync)
+
+        self.app = web.Application()
+        self.app.router.add_get("/", self.index)
+        self.app.router.add_get("/init", self.init)
+        self.app.router.add_get("/metrics", self.metrics_text)
+        self.app.router.add_get("/metrics.json", self.metrics_json)
+        self.app.router.add_static("/static", os.path.join(SERVER_DIR, "static"))
+        self.sio.attach(self.app)
+
+        forwarder = threading.Thread(
+            target=forward_updates,
+            args=(update_queue, asyncio.get_running_loop(), self.add_updates),
+            daemon=True
+        )
+        forwarder.start()
+
+    async def add_updates(self, updates):
+        """
+        Called on the event loop with updates pulled off the update queue
+        """
+        for update in updates:
+            self.coalescer.add(update)
+
+        self.emit_stats.updates += len(updates)
+        self.pending.set()
+
+    async def emit_updates(self):
+        """
+        Emits updates to clients. Updates are collected for emit_interval
+        seconds after the first one arrives and merged so each object is only
+        sent once per interval.
+        """
+        while True:
+            await self.pending.wait()
+            await asyncio.sleep(self.interval)
+            self.pending.clear()
+
+            started = time.perf_counter()
+            messages = self.emit_stats.messages
+            changes = self.emit_stats.changes
+            for update in self.coalescer.drain(self.max_changes):
+                generation = self.view.apply(update)
+                self.update_log.append(generation, update)
+                self.emit_stats.record_message(update)
+
+                # Only encode for formats somebody is listening with
+                for fmt in self.client_formats.active():
+                    message = wire.encode_message(fmt, generation, update)
+                    self.emit_stats.bytes[fmt] += len(message)
+                    await self.sio.emit("update", message, room=fmt)
+
+            seconds = time.perf_counter() - started
+            self.emit_stats.emit_seconds.record(seconds)
+            if self.trace_writer is not None:
+                self.trace_writer.write([trace.emit_record(
+                    self.emit_stats.messages - messages, self.emit_stats.changes - changes, seconds
+                )])
+
+    async def set_client_format(self, sid, fmt):
+        """
+        Moves a client to the room of the format it wants updates in
+        """
+        previous = self.client_formats.set(sid, fmt)
+        if previous != fmt:
+            # These are plain methods in the pinned python-socketio and only
+            # became coroutines in 5.x
+            if previous is not None:
+                await maybe_await(self.sio.leave_room(sid, previous))
+
+            await maybe_await(self.sio.enter_room(sid, fmt))
+
+    async def connect(self, sid, environ):
+        await self.set_client_format(sid, wire.FORMAT_JSON)
+
+    async def disconnect(self, sid):
+        self.client_formats.discard(sid)
+
+    async def hello(self, sid, data):
+        """
+        Sent by clients when they connect with the formats they can decode
+        """
+        fmt, reply = protocol.hello_reply(data)
+        await self.set_client_format(sid, fmt)
+        return reply
+
+    async def resync(self, sid, data):
+        """
+        Sent by clients that noticed a gap in the generations they recieved
+        """
+        return protocol.resync_reply(data, self.view, self.update_log)
+
+    async def index(self, request):
+        return web.FileResponse(os.path.join(SERVER_DIR, "templates", "index.html"))
+
+    async def init(self, request):
+        """
+        Returns the current map state, or what changed since the generation
+        the client already has
+        """
+        try:
+            since = int(request.query["since"])
+        except (KeyError, ValueError):
+            since = None
+
+        etag, body, gzipped = protocol.init_state(self.view, since, request.query.get("instance"))
+        if etag is None:
+            return json_response(request, body)
+
+        # request.if_none_match and response.etag need aiohttp 3.8
+        if protocol.etag_matches(request.headers.get("If-None-Match"), etag):
+            response = web.Response(status=304)
+        else:
+            response = json_response(request, body, gzipped)
+
+        response.headers["ETag"] = protocol.quote_etag(etag)
+        # Browsers have to check back every time but can reuse the body if
+        # nothing changed
+        response.headers["Cache-Control"] = "no-cache"
+
+        return response
+
+    async def metrics_text(self, request):
+        """
+        Pipeline metrics in the Prometheus text format
+        """
+        if not self.metrics_enabled:
+            raise web.HTTPNotFound(text="Metrics are off. Run wifi_map with --metrics.\n")
+
+        return web.Response(
+            text=metrics.REGISTRY.prometheus(),
+            headers={"Content-Type": metrics.PROMETHEUS_CONTENT_TYPE}
+        )
+
+    async def metrics_json(self, request):
+        """
+        Pipeline metrics as JSON, with histograms summarized
+        """
+        if not self.metrics_enabled:
+            raise web.HTTPNotFound(text="Metrics are off. Run wifi_map with --metrics.\n")
+
+        return web.Response(text=metrics.REGISTRY.json(), content_type="application/json")
+
+
+def json_response(request, body, gzipped=None):
+    """
+    Builds a JSON response, gzipped if protocol.compress says so
+    """
+    response = web.Response(body=body, content_type="application/json")
+    response.headers["Vary"] = "Accept-Encoding"
+
+    compressed = protocol.compress(body, gzipped, "gzip" in request.headers.get("Accept-Encoding", ""))
+    if compressed is not None:
+        response.body = compressed
+        response.headers["Content-Encoding"] = "gzip"
+
+    return response
+
+
+async def maybe_await(result):
+    """
+    Awaits result if it is awaitable
+    """
+    if inspect.isawaitable(result):
+        await result
+
+
+def forward_updates(update_queue, loop, callback):
+    """
+    Moves updates from the update queue to the event loop in batches. Waits
+    for each batch to be taken so they can't pile up on the loop.
+    """
+    while True:
+        updates = [update_queue.get()]
+        while len(updates) < FORWARD_BATCH_SIZE:
+            try:
+                updates.append(update_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        asyncio.run_coroutine_threadsafe(callback(updates), loop).result()
@@ -0,0 +1,379 @@
+import collections
+import gzip
+import json
+import threading
+import uuid
+
+from wmap_common import metrics
+from wmap_common import models
+from wmap_common import state
+
+# Clients have to see networks before the stations on them and stations
+# before the connections between them.
+CLASS_ORDER = [
+    models.Network.class_name,
+    models.Station.class_name,
+    models.Connection.class_name
+]
+
+# Deleted objects remembered so clients catching up can be told about them.
+# Clients further behind than the oldest one get the full state instead.
+MAX_TOMBSTONES = 10000
+
+# The field that identifies an object of each type
+OBJECT_KEYS = {
+    model.class_name: model._meta.primary_key.name
+    for model in (models.Network, models.Station, models.Connection)
+}
+
+
+class Coalescer():
+    """
+    Collects updates from the workers and merges the changes to each object so
+    that only its latest state is sent to clients.
+
+    A create followed by updates stays a create (with the latest object) and
+    consecutive updates are merged into one update listing every changed key.
+    A delete replaces whatever came before it.
+    """
+
+    def __init__(self):
+        # class name -> object id -> change dict
+        self.pending = {class_name: {} for class_name in CLASS_ORDER}
+        self.changes_in = 0
+
+    def __len__(self):
+        return sum(len(changes) for changes in self.pending.values())
+
+    def add(self, update):
+        """
+        Adds an update (a dict of change dicts by class name) from a worker
+        """
+        for class_name, changes in update.items():
+            pending = self.pending[class_name]
+            key_field = OBJECT_KEYS[class_name]
+
+            for change in changes:
+                self.changes_in += 1
+                obj_id = change["obj"][key_field]
+                previous = pending.get(obj_id)
+
+                if previous is not None:
+                    change = merge_changes(previous, change)
+
+                pending[obj_id] = change
+
+    def drain(self, max_changes):
+        """
+        Returns everything collected so far as a list of updates with at most
+        max_changes changes each, and starts collecting again.
+        """
+        updates = []
+        update = {}
+        count = 0
+
+        for class_name in CLASS_ORDER:
+            for change in self.pending[class_name].values():
+                if count >= max_changes:
+                    updates.append(update)
+                    update = {}
+                    count = 0
+
+                update.setdefault(class_name, []).append(change)
+                count += 1
+
+            self.pending[class_name] = {}
+
+        if update:
+            updates.append(update)
+
+        return updates
+
+
+def merge_changes(previous, change):
+    """
+    Merges two changes to the same object into one
+    """
+    if change["action"] == state.ACTION_DELETE:
+        return change
+
+    if previous["action"] == state.ACTION_CREATE or change["action"] == state.ACTION_CREATE \
+            or previous["action"] == state.ACTION_DELETE:
+        action = state.ACTION_CREATE
+        updates = []
+    else:
+        action = state.ACTION_UPDATE
+        updates = list(previous["updates"])
+        updates.extend(key for key in change["updates"] if key not in updates)
+
+    return {
+        "action": action,
+        "objtype": change["objtype"],
+        "obj": change["obj"],
+        "updates": updates
+    }
+
+
+class UpdateLog():
+    """
+    Bounded buffer of the most recent updates sent to clients, by generation,
+    so that a client that missed a few can get just those again.
+    """
+
+    def __init__(self, size):
+        self.updates = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def append(self, generation, update):
+        """
+        Records an update that was sent to clients
+        """
+        with self._lock:
+            self.updates.append((generation, update))
+
+    def since(self, generation):
+        """
+        Returns (generation, update) for the updates sent after generation,
+        oldest first. Returns None if some of them are no longer in the buffer.
+        """
+        with self._lock:
+            if not self.updates:
+                return []
+
+            oldest = self.updates[0][0]
+            if generation < oldest - 1:
+                return None
+
+            return [(gen, update) for gen, update in self.updates if gen > generation]
+
+
+class ClientFormats():
+    """
+    Keeps track of which format each connected client wants updates in
+    """
+
+    def __init__(self, formats):
+        # format -> sids of the clients using it
+        self.clients = {fmt: set() for fmt in formats}
+        self._lock = threading.Lock()
+
+    def set(self, sid, fmt):
+        """
+        Records the format a client wants. Returns the format it used before,
+        or None if it is new.
+        """
+        with self._lock:
+            previous = None
+            for other, sids in self.clients.items():
+                if sid in sids:
+                    previous = other
+                    sids.discard(sid)
+
+            self.clients[fmt].add(sid)
+            return previous
+
+    def discard(self, sid):
+        """
+        Forgets a client that disconnected
+        """
+        with self._lock:
+            for sids in self.clients.values():
+                sids.discard(sid)
+
+    def active(self):
+        """
+        Returns the formats at least one client is using
+        """
+        with self._lock:
+            return [fmt for fmt, sids in self.clients.items() if sids]
+
+
+class EmitStats():
+    """
+    Counters kept by the emit loop of either server, for metrics
+    """
+
+    def __init__(self):
+        # Updates recieved from the workers
+        self.updates = 0
+        # Messages and object changes sent to clients (once for every format)
+        self.messages = 0
+        self.changes = 0
+        # format -> bytes sent to its room
+        self.bytes = collections.Counter()
+        # How long each round of applying, encoding and emitting took
+        self.emit_seconds = metrics.LatencyHistogram()
+
+    def record_message(self, update):
+        self.messages += 1
+        self.changes += sum(len(changes) for changes in update.values())
+
+
+def broadcast_collector(stats, update_queue, coalescer, view, update_log, client_formats):
+    """
+    Returns a metrics collector for a server's emit loop and the state it
+    serves
+    """
+    def collect():
+        samples = [
+            metrics.counter("wifi_map_updates_recieved_total", "Updates taken off of the update queue",
+                            stats.updates),
+            metrics.counter("wifi_map_changes_recieved_total", "Object changes in the updates recieved",
+                            coalescer.changes_in),
+            metrics.counter("wifi_map_messages_emitted_total", "Update messages sent to clients",
+                            stats.messages),
+            metrics.counter("wifi_map_changes_emitted_total", "Object changes sent to clients",
+                            stats.changes),
+            metrics.histogram("wifi_map_emit_seconds", "Time taken to apply, encode and emit a round of updates",
+                              stats.emit_seconds),
+            metrics.gauge("wifi_map_update_queue_updates", "Updates waiting for the server",
+                          update_queue.qsize()),
+            metrics.gauge("wifi_map_coalescer_changes", "Object changes waiting to be emitted",
+                          len(coalescer)),
+            metrics.gauge("wifi_map_generation", "Generation of the state sent to clients",
+                          view.generation),
+            metrics.gauge("wifi_map_objects", "Objects in the state sent to clients",
+                          len(view.objects)),
+            metrics.gauge("wifi_map_tombstones", "Deleted objects remembered for clients catching up",
+                          len(view.tombstones)),
+            metrics.gauge("wifi_map_update_log_messages", "Messages kept for clients that missed some",
+                          len(update_log.updates))
+        ]
+
+        for fmt, sids in client_formats.clients.items():
+            samples.append(metrics.gauge("wifi_map_clients", "Connected clients by update format",
+                                         len(sids), format=fmt))
+            samples.append(metrics.counter("wifi_map_emitted_bytes_total", "Bytes of updates emitted by format",
+                                           stats.bytes[fmt], format=fmt))
+
+        return samples
+
+    return collect
+
+
+class StateView():
+    """
+    The latest state of every object, built from the updates sent to clients.
+
+    Every update sent to clients bumps the generation. The serialized full
+    snapshot is cached until the next generation, and clients that already
+    have the state as of some generation can ask for just the objects that
+    changed after it.
+
+    Deleted objects leave a tombstone behind so that clients catching up
+    hear about them, and the snapshot only has what is left. At most
+    max_tombstones are kept. Clients that are further behind than the
+    oldest one get the full state instead of a delta.
+    """
+
+    def __init__(self, max_tombstones=MAX_TOMBSTONES):
+        # Identifies this run of the server so clients can tell that
+        # generations from a previous run mean nothing now
+        self.instance = uuid.uuid4().hex
+        self.generation = 0
+
+        # (class name, object id) -> (generation, obj), oldest change first
+        self.objects = collections.OrderedDict()
+        # (class name, object id) -> generation it was deleted in, oldest first
+        self.tombstones = collections.OrderedDict()
+        self.max_tombstones = max_tombstones
+        # Oldest generation deltas can be worked out since
+        self.horizon = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def apply(self, update):
+        """
+        Applies an update that is about to be sent to clients. Returns the new
+        generation.
+        """
+        with self._lock:
+            self.generation += 1
+            for class_name, changes in update.items():
+                key_field = OBJECT_KEYS[class_name]
+                for change in changes:
+                    key = (class_name, change["obj"][key_field])
+                    if change["action"] == state.ACTION_DELETE:
+                        self.objects.pop(key, None)
+                        self.tombstones[key] = self.generation
+                        self.tombstones.move_to_end(key)
+                    else:
+                        self.tombstones.pop(key, None)
+                        self.objects[key] = (self.generation, change["obj"])
+                        self.objects.move_to_end(key)
+
+            while len(self.tombstones) > self.max_tombstones:
+                _, self.horizon = self.tombstones.popitem(last=False)
+
+            return self.generation
+
+    def snapshot(self):
+        """
+        Returns (generation, json, gzipped json) for the full state. The
+        serialized versions are cached until the next generation.
+        """
+        with self._lock:
+            return self._full_snapshot()
+
+    def _full_snapshot(self):
+        if self._snapshot is None or self._snapshot[0] != self.generation:
+            entries = ((key[0], state.ACTION_CREATE, obj) for key, (generation, obj) in self.objects.items())
+            update = self._build_update(entries)
+            body = self._serialize(update, full=True)
+            self._snapshot = (self.generation, body, gzip.compress(body))
+
+        return self._snapshot
+
+    def delta(self, since):
+        """
+        Returns (generation, json) for the objects that changed after
+        generation since. Changes are sent as updates of every key, which
+        clients treat as creates for objects they don't have yet, and deletes
+        with just the key of each object deleted since.
+        """
+        with self._lock:
+            if since < self.horizon:
+                generation, body, _ = self._full_snapshot()
+                return generation, body
+
+            changed = []
+            for key, (generation, obj) in reversed(self.objects.items()):
+                if generation <= since:
+                    break
+
+                changed.append((key[0], state.ACTION_UPDATE, obj))
+
+            changed.reverse()
+
+            deleted = []
+            for key, generation in reversed(self.tombstones.items()):
+                if generation <= since:
+                    break
+
+                deleted.append((key[0], state.ACTION_DELETE, {OBJECT_KEYS[key[0]]: key[1]}))
+
+            changed.extend(reversed(deleted))
+
+            update = self._build_update(changed)
+            return self.generation, self._serialize(update, full=False)
+
+    def _build_update(self, entries):
+        update = {class_name: [] for class_name in CLASS_ORDER}
+        for class_name, action, obj in entries:
+            update[class_name].append({
+                "action": action,
+                "objtype": class_name,
+                "obj": obj,
+                "updates": list(obj.keys()) if action == state.ACTION_UPDATE else []
+            })
+
+        return {class_name: changes for class_name, changes in update.items() if changes}
+
+    def _serialize(self, update, full):
+        return json.dumps({
+            "instance": self.instance,
+            "generation": self.generation,
+            "full": full,
+            "update": update
+        }).encode("utf-8")
+
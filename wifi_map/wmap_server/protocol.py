@@ -0,0 +1,108 @@
+"""
+What the threaded and the asyncio servers say to clients, independent of the
+web framework each of them runs on. The servers only move clients between
+rooms and wrap the results in their own responses.
+"""
+import gzip
+
+from . import wire
+
+# Responses smaller than this aren't worth compressing
+GZIP_MIN_SIZE = 1024
+
+
+def hello_reply(data):
+    """
+    Works out the format a client gets updates in from its hello message.
+    Returns (format, reply). Clients that can decode binary updates get
+    them along with the schema needed to decode them. Anything that isn't a
+    proper hello gets JSON.
+    """
+    formats = data.get("formats") if isinstance(data, dict) else None
+    if isinstance(formats, list) and wire.FORMAT_BINARY in formats:
+        return wire.FORMAT_BINARY, {"format": wire.FORMAT_BINARY, "schema": wire.SCHEMA}
+
+    return wire.FORMAT_JSON, {"format": wire.FORMAT_JSON}
+
+
+def resync_reply(data, view, update_log):
+    """
+    Replies to a client that noticed a gap in the generations it recieved
+    with the messages it missed, or None for messages if those are no longer
+    buffered and the client has to get the changes from /init. A resync that
+    can't be made sense of gets an error along with None for messages.
+    """
+    if not isinstance(data, dict):
+        return {"error": "resync takes an object", "messages": None}
+
+    if data.get("instance") != view.instance:
+        return {"restarted": True}
+
+    try:
+        since = int(data.get("generation", 0))
+    except (TypeError, ValueError):
+        return {"error": "generation has to be a number", "messages": None}
+
+    missed = update_log.since(since)
+    if missed is None:
+        return {"messages": None}
+
+    fmt = data.get("format", wire.FORMAT_JSON)
+    if fmt not in wire.FORMATS:
+        fmt = wire.FORMAT_JSON
+
+    return {"messages": [wire.encode_message(fmt, generation, update) for generation, update in missed]}
+
+
+def init_state(view, since, instance):
+    """
+    Returns (etag, json, gzipped json) for /init. If the client passes the
+    generation it already has (and the instance it got it from) only the
+    objects that changed since then are returned, with no etag and no
+    gzipped copy. Otherwise it is the full state, cached by the view.
+    """
+    if since is not None and instance == view.instance:
+        _, body = view.delta(since)
+        return None, body, None
+
+    generation, body, gzipped = view.snapshot()
+    return "{}-{}".format(view.instance, generation), body, gzipped
+
+
+def compress(body, gzipped, accepts_gzip):
+    """
+    Returns the gzipped body of a JSON response if the client supports it and
+    the body is big enough to be worth it, otherwise None
+    """
+    if len(body) < GZIP_MIN_SIZE or not accepts_gzip:
+        return None
+
+    return gzipped if gzipped is not None else gzip.compress(body)
+
+
+def quote_etag(etag):
+    """
+    Returns an etag as it goes in the ETag header
+    """
+    return "\"{}\"".format(etag)
+
+
+def etag_matches(if_none_match, etag):
+    """
+    True if an If-None-Match header (None if there wasn't one) lists etag
+    """
+    if not if_none_match:
+        return False
+
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+
+        if tag.startswith("W/"):
+            tag = tag[2:]
+
+        if tag.strip("\"") == etag:
+            return True
+
+    return False
@@ -1,20 +1,42 @@
-import json
-import itertools
+import queue
+import time
 
-from flask import Flask, render_template, jsonify
+from flask import Flask, Response, render_template, request
 import socketio
 # from flask_socketio import SocketIO
 
 from wmap_common import constants
-from wmap_common import models
-from wmap_common import state
+from wmap_common import metrics
+from wmap_common import trace
+from . import protocol
+from . import wire
+from .broadcast import ClientFormats, Coalescer, EmitStats, StateView, UpdateLog, broadcast_collector
 
 sio = socketio.Server(async_mode="threading")
 app = Flask(__name__)
 app.wsgi_app = socketio.Middleware(sio, app.wsgi_app)
+view = StateView()
+update_log = UpdateLog(constants.DEFAULT_UPDATE_LOG_SIZE)
+
+# Each format has a room with the clients that use it
+client_formats = ClientFormats(wire.FORMATS)
+
+emit_stats = EmitStats()
+metrics_enabled = False
 
 def start_server(update_queue, config=constants.DEFAULT_CONFIG):
-    sio.start_background_task(queue_listen, update_queue)
+    global update_log, metrics_enabled
+
+    if config.get("server_mode", constants.DEFAULT_SERVER_MODE) == constants.SERVER_MODE_ASYNC:
+        # aiohttp is only needed in this mode
+        from . import async_server
+        async_server.start_server(update_queue, config)
+        return
+
+    update_log = UpdateLog(config.get("update_log_size", constants.DEFAULT_UPDATE_LOG_SIZE))
+    metrics_enabled = config.get("metrics", constants.DEFAULT_METRICS)
+
+    sio.start_background_task(queue_listen, update_queue, config)
     print("Client started on port {0}. Open 'http://localhost:{0}' in browser.".format(config["portno"]))
 
     try:
@@ -24,10 +46,58 @@ def start_server(update_queue, config=constants.DEFAULT_CONFIG):
         print("Shutting down...")
 
 
-def queue_listen(update_queue):
+def queue_listen(update_queue, config=constants.DEFAULT_CONFIG):
+    """
+    Pulls updates off of the update queue and emits them to clients. Updates
+    are collected for emit_interval seconds after the first one arrives and
+    merged so each object is only sent once per interval.
+    """
+    interval = config.get("emit_interval", constants.DEFAULT_EMIT_INTERVAL)
+    max_changes = config.get("emit_max_changes", constants.DEFAULT_EMIT_MAX_CHANGES)
+    coalescer = Coalescer()
+    trace_writer = trace.get_writer(config)
+
+    if metrics_enabled:
+        metrics.REGISTRY.register(
+            broadcast_collector(emit_stats, update_queue, coalescer, view, update_log, client_formats)
+        )
+
     while True:
-        update = update_queue.get()
-        sio.emit("update", json.dumps(update), broadcast=True)
+        coalescer.add(update_queue.get())
+        emit_stats.updates += 1
+        window_end = time.monotonic() + interval
+
+        while True:
+            remaining = window_end - time.monotonic()
+            if remaining <= 0:
+                break
+
+            try:
+                coalescer.add(update_queue.get(timeout=remaining))
+                emit_stats.updates += 1
+            except queue.Empty:
+                break
+
+        started = time.perf_counter()
+        messages = emit_stats.messages
+        changes = emit_stats.changes
+        for update in coalescer.drain(max_changes):
+            generation = view.apply(update)
+            update_log.append(generation, update)
+            emit_stats.record_message(update)
+
+            # Only encode for formats somebody is listening with
+            for fmt in client_formats.active():
+                message = wire.encode_message(fmt, generation, update)
+                emit_stats.bytes[fmt] += len(message)
+                sio.emit("update", message, room=fmt)
+
+        seconds = time.perf_counter() - started
+        emit_stats.emit_seconds.record(seconds)
+        if trace_writer is not None:
+            trace_writer.write([trace.emit_record(
+                emit_stats.messages - messages, emit_stats.changes - changes, seconds
+            )])
 
     # def target(update_queue):
     #     while True:
@@ -39,6 +109,46 @@ def queue_listen(update_queue):
     # proc.start()
 
 
+def set_client_format(sid, fmt):
+    """
+    Moves a client to the room of the format it wants updates in
+    """
+    previous = client_formats.set(sid, fmt)
+    if previous != fmt:
+        if previous is not None:
+            sio.leave_room(sid, previous)
+
+        sio.enter_room(sid, fmt)
+
+
+@sio.on("connect")
+def connect(sid, environ):
+    set_client_format(sid, wire.FORMAT_JSON)
+
+
+@sio.on("disconnect")
+def disconnect(sid):
+    client_formats.discard(sid)
+
+
+@sio.on("hello")
+def hello(sid, data):
+    """
+    Sent by clients when they connect with the formats they can decode
+    """
+    fmt, reply = protocol.hello_reply(data)
+    set_client_format(sid, fmt)
+    return reply
+
+
+@sio.on("resync")
+def resync(sid, data):
+    """
+    Sent by clients that noticed a gap in the generations they recieved
+    """
+    return protocol.resync_reply(data, view, update_log)
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -47,26 +157,60 @@ def index():
 @app.route("/init")
 def init():
     """
-    Retrieves the current map state and returns it as an update
+    Returns the current map state, or what changed since the generation the
+    client already has
     """
-    print("Got client request")
-    stations = models.Station.select().execute()
-    connections = models.Connection.select().execute()
-    networks = models.Network.select().execute()
+    etag, body, gzipped = protocol.init_state(
+        view, request.args.get("since", type=int), request.args.get("instance")
+    )
+    if etag is None:
+        return json_response(body)
 
-    all_models = itertools.chain(stations, connections, networks)
-    update = {}
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = json_response(body, gzipped)
 
-    for model in all_models:
-        if model.class_name not in update:
-            update[model.class_name] = []
+    response.set_etag(etag)
+    # Browsers have to check back every time but can reuse the body if
+    # nothing changed
+    response.headers["Cache-Control"] = "no-cache"
 
-        change = state.StateChange(
-            state.ACTION_CREATE,
-            type(model),
-            model
-        )
+    return response
+
+
+@app.route("/metrics")
+def metrics_text():
+    """
+    Pipeline metrics in the Prometheus text format
+    """
+    if not metrics_enabled:
+        return Response("Metrics are off. Run wifi_map with --metrics.\n", status=404, mimetype="text/plain")
+
+    return Response(metrics.REGISTRY.prometheus(), mimetype=metrics.PROMETHEUS_CONTENT_TYPE)
+
+
+@app.route("/metrics.json")
+def metrics_json():
+    """
+    Pipeline metrics as JSON, with histograms summarized
+    """
+    if not metrics_enabled:
+        return Response("Metrics are off. Run wifi_map with --metrics.\n", status=404, mimetype="text/plain")
+
+    return Response(metrics.REGISTRY.json(), mimetype="application/json")
+
+
+def json_response(body, gzipped=None):
+    """
+    Builds a JSON response, gzipped if protocol.compress says so
+    """
+    response = Response(body, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
 
-        update[model.class_name].append(change.to_dict())
+    compressed = protocol.compress(body, gzipped, "gzip" in request.accept_encodings)
+    if compressed is not None:
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = "gzip"
 
-    return jsonify(update)
+    return response
@@ -130,7 +130,8 @@ class NetworkGraph {
             .enter()
             .append("line")
             .attr("class", "link")
-            .merge(this.link);
+            .merge(this.link)
+            .classed("disconnected", d => { return !d.connected; });
 
         // Update and restart the simulation.
         this.simulation.nodes(this.nodes);
@@ -186,12 +187,16 @@ class NetworkGraph {
 
     removeNode(id) {
         const nodeIndex = this.findNodeIndex(id);
+        if (nodeIndex === undefined) {
+            return;
+        }
+
         const nodeId = this.nodes[nodeIndex].id;
 
         // Need to remove any links attached to the node
         let i = 0;
         while (i < this.links.length) {
-            if ((this.links[i].source == nodeId) || (this.links[i].source == nodeId)) {
+            if ((this.links[i].source.id == nodeId) || (this.links[i].target.id == nodeId)) {
                 this.links.splice(i, 1);
             }
             else i++;
@@ -204,6 +209,10 @@ class NetworkGraph {
 
     removeLink(id) {
         const linkIndex = this.findLinkIndex(id);
+        if (linkIndex === undefined) {
+            return;
+        }
+
         this.links.splice(linkIndex, 1);
         this.reset();
     }
@@ -212,6 +221,12 @@ class NetworkGraph {
         this.reset();
     }
 
+    // Restyles links after their connected state changed. Nothing moves so
+    // the simulation is left alone.
+    updateLinks() {
+        this.link.classed("disconnected", d => { return !d.connected; });
+    }
+
     dragstarted(obj) {
         if (!d3.event.active) this.simulation.alphaTarget(0.3).restart();
         obj.fx = obj.x;
@@ -317,8 +332,8 @@ function handleUpdate(state, graph, update) {
                 continue;
             }
 
-            if (change.action === "update") {
-                let curr_net = state.network[change.obj.ssid];
+            let curr_net = state.network[change.obj.ssid];
+            if (change.action === "update" && curr_net) {
                 for (let key of change.updates) {
                     curr_net[key] = change.obj[key];
                 }
@@ -339,8 +354,16 @@ function handleUpdate(state, graph, update) {
                 continue;
             }
 
-            if (change.action === "update") {
-                let curr_sta = state.station[change.obj.mac];
+            if (change.action === "delete") {
+                // The graph drops its links too, and the server sends a
+                // delete for each of its connections
+                delete state.station[change.obj.mac];
+                graph.removeNode(change.obj.mac);
+                continue;
+            }
+
+            let curr_sta = state.station[change.obj.mac];
+            if (change.action === "update" && curr_sta) {
                 for (let key of change.updates) {
                     curr_sta[key] = change.obj[key];
                 }
@@ -357,20 +380,35 @@ function handleUpdate(state, graph, update) {
 
     if (update.hasOwnProperty("connection")) {
         for (let change of update["connection"]) {
+            if (change.action === "delete") {
+                delete state.connection[change.obj.conn_id];
+                graph.removeLink(change.obj.conn_id);
+                continue;
+            }
+
             if (!change.obj.station1 || !change.obj.station2) {
                 console.error("Got a bad connection object", change.obj);
                 continue;
             }
 
-            if (change.action === "update") {
-                let curr_conn = state.station[change.obj.conn_id];
-
+            let curr_conn = state.connection[change.obj.conn_id];
+            if (change.action === "update" && curr_conn) {
                 // TODO need to handle creation/deletion of connections for 'updates'
                 for (let key of change.updates) {
                     curr_conn[key] = change.obj[key];
                 }
 
-            } else {
+                if (change.updates.includes("connected")) {
+                    graph.updateLinks();
+                }
+
+            } else if (!curr_conn) {
+                if (!state.station[change.obj.station1] || !state.station[change.obj.station2]) {
+                    // One of them was just evicted and the connection's
+                    // delete is on its way
+                    continue;
+                }
+
                 change.obj.id = change.obj.conn_id;
                 change.obj.type = "connection";
                 change.obj.source = state.station[change.obj.station1];
@@ -382,6 +420,239 @@ function handleUpdate(state, graph, update) {
     }
 }
 
+function loadState(state, graph, sync) {
+    // If we already have some state only ask for what changed since
+    let url = "/init";
+    if (sync.instance !== null) {
+        url += "?since=" + sync.generation + "&instance=" + sync.instance;
+    }
+
+    return fetch(url).then(response => {
+        return response.json();
+    }).then((snapshot) => {
+        if (snapshot.full && sync.instance !== null) {
+            // The server restarted so everything we have is stale
+            window.location.reload();
+            return;
+        }
+
+        sync.instance = snapshot.instance;
+        handleUpdate(state, graph, snapshot.update);
+        sync.generation = Math.max(sync.generation, snapshot.generation);
+    }).catch(error => {
+        console.error(error);
+    });
+}
+
+// Column encodings used by binary updates. See wmap_server/wire.py
+const ENCODING_MAC = 1;
+const ENCODING_STR16 = 2;
+const ENCODING_STR32 = 3;
+const ENCODING_BOOL = 4;
+const ENCODING_INT32 = 5;
+const ENCODING_FLOAT64 = 6;
+const ENCODING_JSON = 7;
+
+const utf8Decoder = new TextDecoder("utf-8");
+const HEX_OCTETS = Array.from({length: 256}, (_, i) => i.toString(16).padStart(2, "0"));
+
+function decodeColumn(view, offset, count) {
+    const encoding = view.getUint8(offset);
+    offset += 1;
+
+    const values = new Array(count);
+    if (encoding === ENCODING_MAC) {
+        for (let i = 0; i < count; i++) {
+            values[i] = HEX_OCTETS[view.getUint8(offset)] + ":" +
+                HEX_OCTETS[view.getUint8(offset + 1)] + ":" +
+                HEX_OCTETS[view.getUint8(offset + 2)] + ":" +
+                HEX_OCTETS[view.getUint8(offset + 3)] + ":" +
+                HEX_OCTETS[view.getUint8(offset + 4)] + ":" +
+                HEX_OCTETS[view.getUint8(offset + 5)];
+            offset += 6;
+        }
+    } else if (encoding === ENCODING_STR16 || encoding === ENCODING_STR32) {
+        const size = encoding === ENCODING_STR16 ? 2 : 4;
+        const nullLength = encoding === ENCODING_STR16 ? 0xffff : 0xffffffff;
+        let data = offset + size * count;
+        for (let i = 0; i < count; i++) {
+            const length = size === 2 ? view.getUint16(offset, true) : view.getUint32(offset, true);
+            offset += size;
+            if (length === nullLength) {
+                values[i] = null;
+            } else {
+                values[i] = utf8Decoder.decode(
+                    new Uint8Array(view.buffer, view.byteOffset + data, length));
+                data += length;
+            }
+        }
+        offset = data;
+    } else if (encoding === ENCODING_BOOL) {
+        for (let i = 0; i < count; i++) {
+            const value = view.getUint8(offset + i);
+            values[i] = value === 2 ? null : value === 1;
+        }
+        offset += count;
+    } else if (encoding === ENCODING_INT32) {
+        for (let i = 0; i < count; i++) {
+            const value = view.getInt32(offset + 4 * i, true);
+            values[i] = value === -2147483648 ? null : value;
+        }
+        offset += 4 * count;
+    } else if (encoding === ENCODING_FLOAT64) {
+        for (let i = 0; i < count; i++) {
+            const value = view.getFloat64(offset + 8 * i, true);
+            values[i] = isNaN(value) ? null : value;
+        }
+        offset += 8 * count;
+    } else if (encoding === ENCODING_JSON) {
+        const length = view.getUint32(offset, true);
+        offset += 4;
+        const parsed = JSON.parse(utf8Decoder.decode(
+            new Uint8Array(view.buffer, view.byteOffset + offset, length)));
+        values.splice(0, count, ...parsed);
+        offset += length;
+    } else {
+        throw new Error("Unknown column encoding " + encoding);
+    }
+
+    return [values, offset];
+}
+
+function decodeBinary(schema, data) {
+    // Binary updates are sent column by column. The schema has the field
+    // names of each object type in column order.
+    const view = data instanceof ArrayBuffer ?
+        new DataView(data) : new DataView(data.buffer, data.byteOffset, data.byteLength);
+
+    if (view.getUint8(0) !== 0x57 || view.getUint8(1) !== 0x4d || view.getUint8(2) !== schema.version) {
+        throw new Error("Unexpected binary update format");
+    }
+
+    const message = {
+        generation: view.getUint32(3, true),
+        update: {}
+    };
+
+    const numSections = view.getUint8(7);
+    let offset = 8;
+    for (let s = 0; s < numSections; s++) {
+        const objtype = schema.types[view.getUint8(offset)];
+        const count = view.getUint32(offset + 1, true);
+        const fields = schema.fields[objtype];
+        offset += 5;
+
+        const changes = [];
+        for (let i = 0; i < count; i++) {
+            changes.push({
+                action: schema.actions[view.getUint8(offset + i)],
+                objtype: objtype,
+                obj: {},
+                updates: []
+            });
+        }
+        offset += count;
+
+        for (let i = 0; i < count; i++) {
+            const mask = view.getUint16(offset + 2 * i, true);
+            for (let f = 0; f < fields.length; f++) {
+                if (mask & (1 << f)) {
+                    changes[i].updates.push(fields[f]);
+                }
+            }
+        }
+        offset += 2 * count;
+
+        for (let field of fields) {
+            let values;
+            [values, offset] = decodeColumn(view, offset, count);
+            for (let i = 0; i < count; i++) {
+                changes[i].obj[field] = values[i];
+            }
+        }
+
+        message.update[objtype] = changes;
+    }
+
+    return message;
+}
+
+function parseMessage(sync, data) {
+    if (typeof data === "string") {
+        return JSON.parse(data);
+    }
+
+    return decodeBinary(sync.schema, data);
+}
+
+function receiveMessage(state, graph, sync, socket, message) {
+    if (sync.catchingUp) {
+        sync.pending.push(message);
+        return;
+    }
+
+    if (message.generation <= sync.generation) {
+        return;
+    }
+
+    if (message.generation > sync.generation + 1) {
+        // Missed at least one message
+        sync.pending.push(message);
+        catchUp(state, graph, sync, socket);
+        return;
+    }
+
+    handleUpdate(state, graph, message.update);
+    sync.generation = message.generation;
+}
+
+function catchUp(state, graph, sync, socket) {
+    // Asks the server for just the messages we missed. If it doesn't have
+    // them anymore the objects that changed since are fetched from /init.
+    sync.catchingUp = true;
+
+    const request = {
+        instance: sync.instance,
+        generation: sync.generation,
+        format: sync.schema === null ? "json" : "binary"
+    };
+
+    socket.emit("resync", request, (reply) => {
+        if (reply.restarted) {
+            // The server restarted so everything we have is stale
+            window.location.reload();
+            return;
+        }
+
+        if (reply.messages === null) {
+            loadState(state, graph, sync).then(() => {
+                finishCatchUp(state, graph, sync, socket);
+            });
+            return;
+        }
+
+        for (let message of reply.messages) {
+            message = parseMessage(sync, message);
+            if (message.generation > sync.generation) {
+                handleUpdate(state, graph, message.update);
+                sync.generation = message.generation;
+            }
+        }
+
+        finishCatchUp(state, graph, sync, socket);
+    });
+}
+
+function finishCatchUp(state, graph, sync, socket) {
+    const pending = sync.pending.sort((a, b) => a.generation - b.generation);
+    sync.pending = [];
+    sync.catchingUp = false;
+
+    for (let message of pending) {
+        receiveMessage(state, graph, sync, socket, message);
+    }
+}
+
 // Main function
 (function() {
     // Keeping a table of objs by id for easy reference
@@ -401,23 +672,56 @@ function handleUpdate(state, graph, update) {
         (obj) => { onClick(state, obj); }
     );
 
-    const initRequest = new Request("/init", {
-        mode: "no-cors",
-        method: "GET"
-    });
+    // Which run of the server and which generation of its state we have.
+    // Messages that arrive while catching up are held in pending. Binary
+    // messages that arrive before we have the schema to decode them are held
+    // in undecoded.
+    const sync = {
+        instance: null,
+        generation: 0,
+        catchingUp: true,
+        pending: [],
+        schema: null,
+        undecoded: []
+    };
 
-    fetch(initRequest).then(response => {
-        return response.json();
-    }).then((update) => {
-        handleUpdate(state, netGraph, update);
+    const socket = io.connect("http://" + document.domain + ":" + location.port);
+
+    loadState(state, netGraph, sync).then(() => {
         console.log("Intial state: ", state);
-    }).catch(error => {
-        console.error(error);
+        finishCatchUp(state, netGraph, sync, socket);
+    });
+
+    // Ask for compact binary updates. Servers that don't know about them
+    // keep sending json.
+    socket.on("connect", function() {
+        socket.emit("hello", {formats: ["binary", "json"]}, (reply) => {
+            if (reply.format === "binary") {
+                sync.schema = reply.schema;
+            }
+
+            const undecoded = sync.undecoded;
+            sync.undecoded = [];
+            for (let data of undecoded) {
+                receiveMessage(state, netGraph, sync, socket, parseMessage(sync, data));
+            }
+        });
     });
 
-    const socket = io.connect("http://" + document.domain + ":" + location.port);
     // this is a callback that triggers when the "my response" event is emitted by the server.
-    socket.on("update", function(update) {
-        handleUpdate(state, netGraph, JSON.parse(update));
+    socket.on("update", function(data) {
+        if (typeof data !== "string" && sync.schema === null) {
+            sync.undecoded.push(data);
+            return;
+        }
+
+        receiveMessage(state, netGraph, sync, socket, parseMessage(sync, data));
+    });
+
+    // Anything sent while we were disconnected was missed
+    socket.on("reconnect", function() {
+        if (!sync.catchingUp) {
+            catchUp(state, netGraph, sync, socket);
+        }
     });
 })();
@@ -0,0 +1,281 @@
+"""
+Encodings of the updates sent to clients, and a compact binary one in
+particular.
+
+An update is encoded column by column instead of object by object. Every
+object type has a schema (the names of its fields) that clients get once when
+they connect, so field names are never sent with the updates themselves.
+
+Layout (little endian):
+
+    header:  "WM", u8 version, u32 generation, u8 number of sections
+    section: u8 object type (index into CLASS_ORDER), u32 number of changes,
+             u8 action per change, u16 bitmask of updated fields per change,
+             then one column per field in schema order
+    column:  u8 encoding followed by the values of every change
+
+Column encodings:
+
+    MAC      6 bytes per value
+    STR16    u16 length per value (0xffff for null) then the utf-8 bytes
+    STR32    same as STR16 with u32 lengths
+    BOOL     u8 per value, 0 false, 1 true, 2 null
+    INT32    i32 per value, -2**31 for null
+    FLOAT64  f64 per value, NaN for null
+    JSON     u32 length then a json array of the values
+
+Each column is written with the encoding that fits its schema type, and
+falls back to JSON if any of its values doesn't fit.
+"""
+import json
+import math
+import struct
+
+import peewee
+
+from wmap_common import models
+from wmap_common import state
+from .broadcast import CLASS_ORDER
+
+# Formats updates can be sent to clients in. Clients get json until they ask
+# for something else.
+FORMAT_JSON = "json"
+FORMAT_BINARY = "binary"
+FORMATS = [FORMAT_JSON, FORMAT_BINARY]
+
+MAGIC = b"WM"
+VERSION = 1
+
+ENCODING_MAC = 1
+ENCODING_STR16 = 2
+ENCODING_STR32 = 3
+ENCODING_BOOL = 4
+ENCODING_INT32 = 5
+ENCODING_FLOAT64 = 6
+ENCODING_JSON = 7
+
+ACTIONS = [state.ACTION_CREATE, state.ACTION_UPDATE, state.ACTION_DELETE]
+
+# Text fields that always hold a mac address
+MAC_FIELDS = ("mac", "station1", "station2")
+
+INT32_NULL = -2 ** 31
+STR16_NULL = 0xffff
+STR32_NULL = 0xffffffff
+
+_header = struct.Struct("<2sBIB")
+_section = struct.Struct("<BI")
+
+
+def _field_encoding(field):
+    if isinstance(field, (peewee.AutoField, peewee.IntegerField)):
+        return ENCODING_INT32
+    elif isinstance(field, peewee.BooleanField):
+        return ENCODING_BOOL
+    elif isinstance(field, peewee.DateTimeField):
+        # last_update holds a unix timestamp
+        return ENCODING_FLOAT64
+    elif field.name in MAC_FIELDS:
+        return ENCODING_MAC
+
+    return ENCODING_STR16
+
+
+# class name -> [(field name, encoding)]
+FIELDS = {
+    model.class_name: [(field.name, _field_encoding(field)) for field in model._meta.sorted_fields]
+    for model in (models.Network, models.Station, models.Connection)
+}
+
+# class name -> field name -> its bit in the updated fields bitmask
+FIELD_BITS = {
+    class_name: {name: 1 << i for i, (name, _) in enumerate(fields)}
+    for class_name, fields in FIELDS.items()
+}
+
+# What clients need to decode messages: the field names of each object type
+# in column order, and the order of the object types.
+SCHEMA = {
+    "version": VERSION,
+    "types": CLASS_ORDER,
+    "actions": ACTIONS,
+    "fields": {class_name: [name for name, _ in fields] for class_name, fields in FIELDS.items()}
+}
+
+
+def encode_message(fmt, generation, update):
+    """
+    Encodes an update sent to clients in the given format
+    """
+    if fmt == FORMAT_BINARY:
+        return encode(generation, update)
+
+    return json.dumps({
+        "generation": generation,
+        "update": update
+    })
+
+
+def encode(generation, update):
+    """
+    Encodes an update (a dict of change dicts by class name) as bytes
+    """
+    sections = [(CLASS_ORDER.index(class_name), changes)
+                for class_name, changes in update.items() if changes]
+
+    parts = [_header.pack(MAGIC, VERSION, generation, len(sections))]
+    for type_index, changes in sections:
+        class_name = CLASS_ORDER[type_index]
+        count = len(changes)
+
+        parts.append(_section.pack(type_index, count))
+        parts.append(bytes(ACTIONS.index(change["action"]) for change in changes))
+
+        bits = FIELD_BITS[class_name]
+        parts.append(struct.pack(
+            "<{}H".format(count),
+            *(sum(bits.get(key, 0) for key in change["updates"]) for change in changes)
+        ))
+
+        objs = [change["obj"] for change in changes]
+        for name, encoding in FIELDS[class_name]:
+            values = [obj.get(name) for obj in objs]
+            parts.append(_encode_column(values, encoding))
+
+    return b"".join(parts)
+
+
+def _encode_column(values, encoding):
+    try:
+        if encoding == ENCODING_MAC:
+            return bytes([ENCODING_MAC]) + _mac_bytes(values)
+        elif encoding == ENCODING_STR16:
+            return _encode_strings(values)
+        elif encoding == ENCODING_BOOL:
+            return bytes([ENCODING_BOOL]) + bytes(2 if value is None else int(value) for value in values)
+        elif encoding == ENCODING_INT32:
+            return bytes([ENCODING_INT32]) + struct.pack(
+                "<{}i".format(len(values)),
+                *(INT32_NULL if value is None else value for value in values)
+            )
+        elif encoding == ENCODING_FLOAT64:
+            return bytes([ENCODING_FLOAT64]) + struct.pack(
+                "<{}d".format(len(values)),
+                *(math.nan if value is None else value for value in values)
+            )
+    except (TypeError, ValueError, struct.error):
+        # Something that doesn't fit the column's type. Send it as is.
+        pass
+
+    body = json.dumps(values).encode("utf-8")
+    return struct.pack("<BI", ENCODING_JSON, len(body)) + body
+
+
+def _mac_bytes(values):
+    # Every value has to be a 17 character xx:xx:xx:xx:xx:xx string for the
+    # joined hex to line up
+    if not all(len(value) == 17 for value in values):
+        raise ValueError("Not a mac address")
+
+    raw = bytes.fromhex("".join(values).replace(":", ""))
+    if len(raw) != 6 * len(values):
+        raise ValueError("Not a mac address")
+
+    return raw
+
+
+def _encode_strings(values):
+    encoded = [None if value is None else value.encode("utf-8") for value in values]
+    longest = max((len(value) for value in encoded if value is not None), default=0)
+
+    if longest < STR16_NULL:
+        encoding, length_format, null = ENCODING_STR16, "H", STR16_NULL
+    else:
+        encoding, length_format, null = ENCODING_STR32, "I", STR32_NULL
+
+    lengths = struct.pack(
+        "<{}{}".format(len(encoded), length_format),
+        *(null if value is None else len(value) for value in encoded)
+    )
+
+    return bytes([encoding]) + lengths + b"".join(value for value in encoded if value is not None)
+
+
+def decode(data):
+    """
+    Decodes bytes made by encode. Returns (generation, update).
+    """
+    magic, version, generation, num_sections = _header.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a version {} update".format(VERSION))
+
+    offset = _header.size
+    update = {}
+    for _ in range(num_sections):
+        type_index, count = _section.unpack_from(data, offset)
+        offset += _section.size
+        class_name = CLASS_ORDER[type_index]
+        fields = FIELDS[class_name]
+
+        actions = [ACTIONS[action] for action in data[offset:offset + count]]
+        offset += count
+        masks = struct.unpack_from("<{}H".format(count), data, offset)
+        offset += 2 * count
+
+        objs = [{} for _ in range(count)]
+        for name, _ in fields:
+            values, offset = _decode_column(data, offset, count)
+            for obj, value in zip(objs, values):
+                obj[name] = value
+
+        update[class_name] = [
+            {
+                "action": action,
+                "objtype": class_name,
+                "obj": obj,
+                "updates": [name for i, (name, _) in enumerate(fields) if mask & (1 << i)]
+            }
+            for action, mask, obj in zip(actions, masks, objs)
+        ]
+
+    return generation, update
+
+
+def _decode_column(data, offset, count):
+    encoding = data[offset]
+    offset += 1
+
+    if encoding == ENCODING_MAC:
+        values = [data[i:i + 6].hex(":") for i in range(offset, offset + 6 * count, 6)]
+        return values, offset + 6 * count
+    elif encoding in (ENCODING_STR16, ENCODING_STR32):
+        length_format, null = ("H", STR16_NULL) if encoding == ENCODING_STR16 else ("I", STR32_NULL)
+        lengths = struct.unpack_from("<{}{}".format(count, length_format), data, offset)
+        offset += struct.calcsize(length_format) * count
+
+        values = []
+        for length in lengths:
+            if length == null:
+                values.append(None)
+            else:
+                values.append(data[offset:offset + length].decode("utf-8"))
+                offset += length
+
+        return values, offset
+    elif encoding == ENCODING_BOOL:
+        values = [None if value == 2 else bool(value) for value in data[offset:offset + count]]
+        return values, offset + count
+    elif encoding == ENCODING_INT32:
+        values = [None if value == INT32_NULL else value
+                  for value in struct.unpack_from("<{}i".format(count), data, offset)]
+        return values, offset + 4 * count
+    elif encoding == ENCODING_FLOAT64:
+        values = [None if math.isnan(value) else value
+                  for value in struct.unpack_from("<{}d".format(count), data, offset)]
+        return values, offset + 8 * count
+    elif encoding == ENCODING_JSON:
+        length, = struct.unpack_from("<I", data, offset)
+        offset += 4
+        return json.loads(data[offset:offset + length].decode("utf-8")), offset + length
+
+    raise ValueError("Unknown column encoding {}".format(encoding))
@@ -0,0 +1,297 @@
+"""
+Live capture from a raw AF_PACKET socket (Linux only).
+
+Frames are read straight off of the socket instead of going through scapy. By
+default the kernel writes them into a PACKET_MMAP (TPACKET_V2) ring that is
+shared with this process, so there is no system call per frame. A classic BPF
+filter attached to the socket drops control frames in the kernel since
+nothing is done with them.
+"""
+import ctypes
+import mmap
+import select
+import socket
+import struct
+import time
+
+from wmap_common.constants import DEFAULT_RING_FRAMES
+from . import pcap
+
+ETH_P_ALL = 0x0003
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V2 = 1
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# sll_pkttype of frames this host sent
+PACKET_OUTGOING = 4
+
+SO_ATTACH_FILTER = 26
+
+# Interface hardware types (/sys/class/net/<iface>/type) and the link types
+# of the frames read from them
+ARPHRD_IEEE80211 = 801
+ARPHRD_IEEE80211_PRISM = 802
+ARPHRD_IEEE80211_RADIOTAP = 803
+
+ARPHRD_LINKTYPES = {
+    ARPHRD_IEEE80211: pcap.LINKTYPE_IEEE802_11,
+    ARPHRD_IEEE80211_PRISM: pcap.LINKTYPE_PRISM,
+    ARPHRD_IEEE80211_RADIOTAP: pcap.LINKTYPE_RADIOTAP
+}
+
+# struct tpacket2_hdr, followed by a struct sockaddr_ll at TPACKET2_HDRLEN
+TPACKET2_HDR = struct.Struct("IIIHHIIHH4x")
+TPACKET2_HDRLEN = 32
+SLL_PKTTYPE_OFFSET = TPACKET2_HDRLEN + 10
+
+TPACKET_STATS = struct.Struct("II")
+
+# Ring geometry. Frames bigger than a ring slot are truncated, which only
+# loses the end of large data frame bodies.
+RING_FRAME_SIZE = 4096
+RING_BLOCK_SIZE = 64 * RING_FRAME_SIZE
+
+# Socket receive buffer size when not using the ring. The kernel caps it at
+# net.core.rmem_max.
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Max bytes the filter keeps of each frame
+SNAP_LEN = 0xffff
+
+# Milliseconds to wait for frames before checking whether to stop
+POLL_TIMEOUT = 100
+
+# Classic BPF opcodes used by the filters below
+BPF_LD_B_ABS = 0x30
+BPF_LD_B_IND = 0x50
+BPF_ALU_LSH_K = 0x64
+BPF_ALU_OR_X = 0x4c
+BPF_ALU_AND_K = 0x54
+BPF_JMP_JEQ_K = 0x15
+BPF_MISC_TAX = 0x07
+BPF_RET_K = 0x06
+
+# Type bits of the first frame control byte
+FC_TYPE_MASK = 0x0c
+FC_TYPE_CTRL = 0x04
+
+# A radiotap header with nothing in it, for replay
+EMPTY_RADIOTAP = struct.pack("<BBHI", 0, 0, 8, 0)
+
+
+class CaptureError(Exception):
+    """
+    Raised when an interface can't be captured from
+    """
+    pass
+
+
+def interface_linktype(interface):
+    """
+    Returns the link type of the frames captured on an interface. Raises
+    CaptureError if it isn't an 802.11 monitor interface.
+    """
+    try:
+        with open("/sys/class/net/{}/type".format(interface)) as f:
+            hardware_type = int(f.read())
+    except (OSError, ValueError) as err:
+        raise CaptureError("Can't get the type of {}: {}".format(interface, err))
+
+    linktype = ARPHRD_LINKTYPES.get(hardware_type)
+    if linktype is None:
+        raise CaptureError(
+            "{} isn't a monitor mode interface (hardware type {})".format(interface, hardware_type)
+        )
+
+    return linktype
+
+
+def ctrl_filter(linktype):
+    """
+    Returns the classic BPF program (a list of (code, jt, jf, k) tuples) that
+    drops control frames for the given link type, or None if there isn't one
+    for it
+    """
+    accept = (BPF_RET_K, 0, 0, SNAP_LEN)
+    drop = (BPF_RET_K, 0, 0, 0)
+
+    if linktype == pcap.LINKTYPE_RADIOTAP:
+        return [
+            # X = the radiotap length, which is little endian
+            (BPF_LD_B_ABS, 0, 0, 3),
+            (BPF_ALU_LSH_K, 0, 0, 8),
+            (BPF_MISC_TAX, 0, 0, 0),
+            (BPF_LD_B_ABS, 0, 0, 2),
+            (BPF_ALU_OR_X, 0, 0, 0),
+            (BPF_MISC_TAX, 0, 0, 0),
+            # A = the frame control type bits
+            (BPF_LD_B_IND, 0, 0, 0),
+            (BPF_ALU_AND_K, 0, 0, FC_TYPE_MASK),
+            (BPF_JMP_JEQ_K, 1, 0, FC_TYPE_CTRL),
+            accept,
+            drop
+        ]
+    elif linktype == pcap.LINKTYPE_IEEE802_11:
+        return [
+            (BPF_LD_B_ABS, 0, 0, 0),
+            (BPF_ALU_AND_K, 0, 0, FC_TYPE_MASK),
+            (BPF_JMP_JEQ_K, 1, 0, FC_TYPE_CTRL),
+            accept,
+            drop
+        ]
+
+    return None
+
+
+def attach_filter(sock, program):
+    """
+    Attaches a classic BPF program to a socket
+    """
+    instructions = b"".join(struct.pack("HBBI", *instruction) for instruction in program)
+    buf = ctypes.create_string_buffer(instructions)
+    # struct sock_fprog. buf has to stay alive until setsockopt returns.
+    fprog = struct.pack("HP", len(program), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+class LiveCapture():
+    """
+    Captures 802.11 frames from an interface with a raw socket.
+
+    linktype is normally worked out from the interface. Passing it lets
+    frames be captured from interfaces that aren't 802.11 at all, such as lo
+    with frames sent to it by replay(), which is how this can be tried out
+    without a radio.
+    """
+
+    def __init__(self, interface, linktype=None, ring_frames=DEFAULT_RING_FRAMES):
+        self.interface = interface
+        self.linktype = linktype if linktype is not None else interface_linktype(interface)
+        self.ring = None
+        self.ring_frames = 0
+
+        try:
+            self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        except (AttributeError, OSError) as err:
+            raise CaptureError("Can't open a raw socket: {}".format(err))
+
+        try:
+            program = ctrl_filter(self.linktype)
+            if program is not None:
+                attach_filter(self.sock, program)
+
+            if ring_frames:
+                self._setup_ring(ring_frames)
+            else:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+
+            self.sock.bind((interface, 0))
+        except OSError as err:
+            self.close()
+            raise CaptureError("Can't capture on {}: {}".format(interface, err))
+
+    def _setup_ring(self, ring_frames):
+        frames_per_block = RING_BLOCK_SIZE // RING_FRAME_SIZE
+        block_nr = max(1, ring_frames // frames_per_block)
+
+        self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V2)
+        self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack(
+            "IIII",
+            RING_BLOCK_SIZE,
+            block_nr,
+            RING_FRAME_SIZE,
+            block_nr * frames_per_block
+        ))
+
+        self.ring_frames = block_nr * frames_per_block
+        self.ring = mmap.mmap(self.sock.fileno(), RING_BLOCK_SIZE * block_nr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+        self.sock.close()
+
+    def frames(self):
+        """
+        Generator that yields (frame, timestamp) tuples for captured frames,
+        same as pcap.read_frames. Runs until interrupted.
+        """
+        if self.ring is not None:
+            return self._read_ring()
+
+        return self._read_socket()
+
+    def _read_ring(self):
+        ring = self.ring
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN | select.POLLERR)
+        index = 0
+
+        while True:
+            offset = index * RING_FRAME_SIZE
+            status, _, snaplen, mac, _, sec, nsec, _, _ = TPACKET2_HDR.unpack_from(ring, offset)
+
+            if not status & TP_STATUS_USER:
+                poller.poll(POLL_TIMEOUT)
+                continue
+
+            frame = None
+            if ring[offset + SLL_PKTTYPE_OFFSET] != PACKET_OUTGOING:
+                frame = pcap.strip_link_header(
+                    self.linktype,
+                    ring[offset + mac:offset + mac + snaplen]
+                )
+
+            # The frame has been copied out so the slot can go back to the
+            # kernel
+            struct.pack_into("I", ring, offset, TP_STATUS_KERNEL)
+            index = (index + 1) % self.ring_frames
+
+            if frame is not None:
+                yield frame, sec + nsec / 1e9
+
+    def _read_socket(self):
+        while True:
+            data, address = self.sock.recvfrom(SNAP_LEN)
+            if address[2] == PACKET_OUTGOING:
+                continue
+
+            frame = pcap.strip_link_header(self.linktype, data)
+            if frame is not None:
+                yield frame, time.time()
+
+    def stats(self):
+        """
+        Returns (received, dropped) frame counts since the last call. Frames
+        the filter dropped aren't counted.
+        """
+        received, dropped = TPACKET_STATS.unpack(
+            self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, TPACKET_STATS.size)
+        )
+        return received, dropped
+
+
+def replay(fname, interface):
+    """
+    Sends the frames of a capture file out of an interface wrapped in an empty
+    radiotap header. Capturing from lo with linktype LINKTYPE_RADIOTAP while
+    this runs stands in for a monitor mode interface.
+    """
+    with socket.socket(socket.AF_PACKET, socket.SOCK_RAW) as sock:
+        sock.bind((interface, 0))
+        for frame, _ in pcap.read_frames(fname):
+            sock.send(EMPTY_RADIOTAP + frame)
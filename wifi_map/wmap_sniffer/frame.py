@@ -0,0 +1,186 @@
+import struct
+
+from wmap_common import constants
+from wmap_common import macs
+
+# frame control (2 bytes) + duration (2 bytes)
+HEADER_START = struct.Struct("<BBH")
+# addr1, addr2 and addr3 right after it, each as a u16 and a u32
+HEADER_ADDRS = struct.Struct(">HIHIHI")
+
+FC_FLAG_ORDER = 0x80
+
+CTRL_SUBTYPE_CTS = 0xC
+CTRL_SUBTYPE_ACK = 0xD
+DATA_SUBTYPE_QOS = 0x8
+
+ADDR1_OFFSET = 4
+ADDR2_OFFSET = 10
+ADDR3_OFFSET = 16
+ADDR4_OFFSET = 24
+MGMT_HEADER_LEN = 24
+DS_FLAGS = constants.FC_FLAG_TO_DS | constants.FC_FLAG_FROM_DS
+ADDR_LEN = 6
+QOS_CTRL_LEN = 2
+HT_CTRL_LEN = 4
+
+# Where to look for the BSSID (then the transmitter) of a frame, by
+# to-DS/from-DS flags for data frames.
+MGMT_OWNER_OFFSETS = (ADDR3_OFFSET, ADDR2_OFFSET)
+DATA_OWNER_OFFSETS = {
+    0: (ADDR3_OFFSET, ADDR2_OFFSET),
+    constants.FC_FLAG_TO_DS: (ADDR1_OFFSET, ADDR2_OFFSET),
+    constants.FC_FLAG_FROM_DS: (ADDR2_OFFSET,),
+    DS_FLAGS: (ADDR2_OFFSET,)
+}
+
+
+class Frame():
+    """
+    The parts of a raw 802.11 frame that the handlers care about. Decoding
+    this is a lot cheaper than having scapy dissect the whole frame so scapy
+    should only be used (through dissect) when a handler needs to dig
+    into the frame body. Addresses are integers (see wmap_common.macs).
+    """
+    __slots__ = (
+        "raw",
+        "type",
+        "subtype",
+        "flags",
+        "to_ds",
+        "from_ds",
+        "addr1",
+        "addr2",
+        "addr3",
+        "addr4",
+        "body_offset",
+    )
+
+    def __init__(self, raw):
+        if len(raw) < ADDR2_OFFSET:
+            raise ValueError("Frame is too short ({} bytes)".format(len(raw)))
+
+        fc, flags, _ = HEADER_START.unpack_from(raw)
+
+        self.raw = raw
+        self.type = (fc >> 2) & 0x3
+        self.subtype = fc >> 4
+        self.flags = flags
+        self.to_ds = bool(flags & constants.FC_FLAG_TO_DS)
+        self.from_ds = bool(flags & constants.FC_FLAG_FROM_DS)
+        self.addr4 = None
+
+        if self.type == constants.FRAME_TYPE_CTRL:
+            self.addr1 = macs.from_raw(raw, ADDR1_OFFSET)
+            self.addr2 = None
+            self.addr3 = None
+            if self.subtype not in (CTRL_SUBTYPE_CTS, CTRL_SUBTYPE_ACK) \
+                    and len(raw) >= ADDR3_OFFSET:
+                self.addr2 = macs.from_raw(raw, ADDR2_OFFSET)
+
+            self.body_offset = len(raw)
+            return
+
+        if len(raw) < MGMT_HEADER_LEN:
+            raise ValueError("Frame is too short ({} bytes)".format(len(raw)))
+
+        high1, low1, high2, low2, high3, low3 = HEADER_ADDRS.unpack_from(raw, ADDR1_OFFSET)
+        self.addr1 = high1 << 32 | low1
+        self.addr2 = high2 << 32 | low2
+        self.addr3 = high3 << 32 | low3
+        offset = MGMT_HEADER_LEN
+
+        if self.type == constants.FRAME_TYPE_DATA:
+            if self.to_ds and self.from_ds:
+                if len(raw) < ADDR4_OFFSET + ADDR_LEN:
+                    raise ValueError("WDS frame is missing addr4")
+
+                self.addr4 = macs.from_raw(raw, ADDR4_OFFSET)
+                offset += ADDR_LEN
+
+            if self.subtype & DATA_SUBTYPE_QOS:
+                offset += QOS_CTRL_LEN
+                if flags & FC_FLAG_ORDER:
+                    offset += HT_CTRL_LEN
+        elif self.type == constants.FRAME_TYPE_MGMT and flags & FC_FLAG_ORDER:
+            offset += HT_CTRL_LEN
+
+        self.body_offset = offset
+
+    @property
+    def body(self):
+        """
+        The frame body (everything after the MAC header) as a memoryview
+        """
+        return memoryview(self.raw)[self.body_offset:]
+
+    def dissect(self):
+        """
+        Returns the frame fully dissected by scapy. This is slow, only use it
+        when the frame body actually needs to be parsed.
+        """
+        # Imported here so that workers that never need it don't pay for it
+        import scapy.layers.dot11 as dot11
+
+        return dot11.Dot11(bytes(self.raw))
+
+
+def decode(raw):
+    """
+    Decodes the header of a raw 802.11 frame. Raises ValueError if the frame
+    is malformed.
+    """
+    return Frame(raw)
+
+
+def flow_key(raw):
+    """
+    Returns (addresses, frame control) for a data frame: its addresses as
+    bytes, one after the other, and its type, subtype and to-DS/from-DS flags
+    as an integer. That is everything its handler looks at, so data frames
+    with the same flow key change the same records. Returns None for other frames and ones that are
+    too short. It only slices the header so it is cheaper than a full decode.
+    """
+    if len(raw) < MGMT_HEADER_LEN or (raw[0] >> 2) & 0x3 != constants.FRAME_TYPE_DATA:
+        return None
+
+    ds = raw[1] & DS_FLAGS
+    if ds == DS_FLAGS:
+        if len(raw) < ADDR4_OFFSET + ADDR_LEN:
+            return None
+
+        # Sequence control sits between the third and fourth address. It is
+        # different in every frame so it has to stay out of the key.
+        addresses = bytes(raw[ADDR1_OFFSET:ADDR3_OFFSET + ADDR_LEN]) + bytes(raw[ADDR4_OFFSET:ADDR4_OFFSET + ADDR_LEN])
+        return addresses, raw[0] | ds << 8
+
+    return bytes(raw[ADDR1_OFFSET:ADDR3_OFFSET + ADDR_LEN]), raw[0] | ds << 8
+
+
+def owner_address(raw):
+    """
+    Returns the address that decides which worker owns a frame, as an
+    integer. This is the BSSID when the frame has a usable one and the
+    transmitter otherwise (the receiver for control frames). It only looks at
+    the header so it is cheaper than a full decode. Raises ValueError if the
+    frame is too short.
+    """
+    if len(raw) < ADDR2_OFFSET:
+        raise ValueError("Frame is too short ({} bytes)".format(len(raw)))
+
+    frame_type = (raw[0] >> 2) & 0x3
+    if frame_type == constants.FRAME_TYPE_CTRL or len(raw) < MGMT_HEADER_LEN:
+        return macs.from_raw(raw, ADDR1_OFFSET)
+
+    if frame_type == constants.FRAME_TYPE_DATA:
+        candidates = DATA_OWNER_OFFSETS[raw[1] & DS_FLAGS]
+    else:
+        candidates = MGMT_OWNER_OFFSETS
+
+    for offset in candidates:
+        # skip group (broadcast/multicast) and empty addresses
+        mac = macs.from_raw(raw, offset)
+        if macs.is_station(mac):
+            return mac
+
+    return macs.from_raw(raw, ADDR2_OFFSET)
@@ -1,13 +1,14 @@
-import copy
-
-import peewee
-import scapy.layers.dot11 as dot11
+import struct
 
 from wmap_common import constants
-from wmap_common import state
-from wmap_common import db_utils
-from wmap_common.models import Station, Connection, Network
-from wmap_common.models import to_dict as model_to_dict
+from wmap_common import macs
+
+from . import ies
+
+# The status code of an association response comes after its capability
+# information
+ASSOC_RES_STATUS_OFFSET = 2
+STATUS_CODE = struct.Struct("<H")
 
 
 def get_handler(frame_type, frame_subtype):
@@ -39,7 +40,8 @@ def get_mgmt_handler(subtype):
     if subtype == constants.FRAME_SUBTYPE_PROBE_RES \
             or subtype == constants.FRAME_SUBTYPE_BEACON:
         return beacon_handler
-    elif subtype in [constants.FRAME_SUBTYPE_REASSOC_RES, constants.FRAME_SUBTYPE_REASSOC_REQ]:
+    elif subtype in [constants.FRAME_SUBTYPE_REASSOC_RES, constants.FRAME_SUBTYPE_REASSOC_REQ,
+                     constants.FRAME_SUBTYPE_ASSOC_RES, constants.FRAME_SUBTYPE_ASSOC_REQ]:
         return reassoc_handler
     elif subtype == constants.FRAME_SUBTYPE_AUTH:
         return auth_handler
@@ -56,268 +58,177 @@ def get_ctrl_handler(subtype):
     return default_ctrl_handler
 
 
-def default_data_handler(pkt, time_recieved, locks):
+def default_data_handler(frame, time_recieved, store):
     """
     Default packet handler for data frames
     """
     state_changes = []
 
-    to_ds = pkt.FCfield.__getattr__("to-DS")
-    from_ds = pkt.FCfield.__getattr__("from-DS")
+    to_ds = frame.to_ds
+    from_ds = frame.from_ds
 
     addresses = {}
 
     if to_ds and from_ds:
-        addresses[constants.ADDRESS_RCV] = pkt.addr1
-        addresses[constants.ADDRESS_TRNSMT] = pkt.addr2
-        addresses[constants.ADDRESS_DST] = pkt.addr3
-        addresses[constants.ADDRESS_SRC] = pkt.addr4
+        addresses[constants.ADDRESS_RCV] = frame.addr1
+        addresses[constants.ADDRESS_TRNSMT] = frame.addr2
+        addresses[constants.ADDRESS_DST] = frame.addr3
+        addresses[constants.ADDRESS_SRC] = frame.addr4
     elif to_ds and not from_ds:
-        addresses[constants.ADDRESS_BSSID] = pkt.addr1
-        addresses[constants.ADDRESS_SRC] = pkt.addr2
-        addresses[constants.ADDRESS_DST] = pkt.addr3
+        addresses[constants.ADDRESS_BSSID] = frame.addr1
+        addresses[constants.ADDRESS_SRC] = frame.addr2
+        addresses[constants.ADDRESS_DST] = frame.addr3
     elif not to_ds and from_ds:
-        addresses[constants.ADDRESS_DST] = pkt.addr1
-        addresses[constants.ADDRESS_BSSID] = pkt.addr2
-        addresses[constants.ADDRESS_SRC] = pkt.addr3
+        addresses[constants.ADDRESS_DST] = frame.addr1
+        addresses[constants.ADDRESS_BSSID] = frame.addr2
+        addresses[constants.ADDRESS_SRC] = frame.addr3
     else:
-        addresses[constants.ADDRESS_DST] = pkt.addr1
-        addresses[constants.ADDRESS_SRC] = pkt.addr2
-        addresses[constants.ADDRESS_BSSID] = pkt.addr3
+        addresses[constants.ADDRESS_DST] = frame.addr1
+        addresses[constants.ADDRESS_SRC] = frame.addr2
+        addresses[constants.ADDRESS_BSSID] = frame.addr3
 
     # clear out bad addresses
-    addrs_copy = copy.copy(addresses)
+    addresses = {
+        addr_type: mac
+        for addr_type, mac in addresses.items()
+        if mac is not None and macs.is_station(mac)
+    }
+
     for addr_type, mac in addresses.items():
-        if not safe_mac(mac) or mac is None:
-            del addrs_copy[addr_type]
-    addresses = addrs_copy
-
-    with locks["station"]:
-        existing_stations = Station.select().where(Station.mac in addresses.values()).execute()
-        existing_macs = [station.mac for station in existing_stations]
-
-        new_stations = []
-        updated_macs = []
-        new_macs = []
-        for addr_type, mac in addresses.items():
-            is_ap = addr_type == constants.ADDRESS_BSSID
-            if mac in existing_macs:
-                for sta in existing_stations:
-                    # we've got an existing AP that hasn't been marked as one yet.
-                    if sta.mac == mac and not sta.is_ap and is_ap:
-                        sta.is_ap = True
-                        updated_macs.append(mac)
-
-                        state_changes.append(state.StateChange(
-                            state.ACTION_UPDATE,
-                            Station,
-                            sta,
-                            updates=["is_ap"],
-                        ))
-                    break
-
-            elif mac not in new_macs:
-                new_macs.append(mac)
-                new_station = Station(mac=mac, is_ap=is_ap)
-                new_stations.append(new_station)
-
-                state_changes.append(state.StateChange(
-                    state.ACTION_CREATE,
-                    Station,
-                    new_station
-                ))
-
-        if len(new_stations) > 0:
-            station_dicts = [model_to_dict(station) for station in new_stations]
-            Station.insert_many(station_dicts).execute()
-
-        if len(updated_macs) > 0:
-            Station.update(is_ap=True).where(Station.mac in updated_macs).execute()
-
-    poss_cons = []
+        is_ap = addr_type == constants.ADDRESS_BSSID
+        state_changes.extend(store.observe_station(mac, time_recieved, is_ap=is_ap))
+
     poss_con_pairs = []
 
     # Determining what connections I should have:
     if constants.ADDRESS_BSSID in addresses:  # normal AP to client connection
         for addr_type, addr in addresses.items():
             if not addr_type == constants.ADDRESS_BSSID and addr != addresses[constants.ADDRESS_BSSID]:
-                # connection.station1 and connection.station2 are sorted alphabetically
-                sorted_addrs = sorted((addr, addresses[constants.ADDRESS_BSSID]))
-                poss_con_pairs.append(sorted_addrs)
+                # The BSSID goes first. It anchors the connection to the
+                # partition that owns the AP.
+                poss_con_pairs.append((addresses[constants.ADDRESS_BSSID], addr))
     elif constants.ADDRESS_BSSID not in addresses and constants.ADDRESS_TRNSMT not in addresses \
             and constants.ADDRESS_DST in addresses and constants.ADDRESS_RCV in addresses:  # ad hoc connection
-        sorted_addrs = sorted((addresses[constants.ADDRESS_DST], addresses[constants.ADDRESS_SRC]))
-        poss_con_pairs.append(sorted_addrs)
+        poss_con_pairs.append((addresses[constants.ADDRESS_DST], addresses[constants.ADDRESS_SRC]))
     elif constants.ADDRESS_TRNSMT in addresses:  # WDS connection
         # if one of the devices is an access point then create connections to it.
         # TODO implement this
         pass
 
     for pair in poss_con_pairs:
-        poss_cons.append(Connection(
-            station1=pair[0],
-            station2=pair[1],
-            connected=True,
-            last_update=time_recieved
-        ))
-
-    # TODO this lock essenatially makes having multiple workers useless
-    with locks["connection"]:
-        existing_cons_query = Connection.select().where(
-            Connection.station1 in addresses.values() or
-            Connection.station2 in addresses.values()
-        )
-
-        existing_cons = existing_cons_query.execute()
-
-        # TODO this is bad... so bad...
-        new_cons = []
-        for poss_con in poss_cons:
-            needs_created = True
-            for con in existing_cons:
-                if poss_con.station1 == con.station1 and \
-                        poss_con.station2 == con.station2:
-
-                    needs_created = False
-
-            if needs_created:
-                new_cons.append(poss_con)
-                state_changes.append(state.StateChange(
-                    state.ACTION_CREATE,
-                    Connection,
-                    poss_con
-                ))
-
-        # Need to create a state change if the con wasn't already connected
-        for con in existing_cons:
-            if con.last_update < time_recieved and not con.connected:
-                state_changes.append(state.StateChange(
-                    state.ACTION_UPDATE,
-                    Connection,
-                    con
-                ))
-
-        with db_utils.get_db().atomic():
-            if len(new_cons) > 0:
-                con_dicts = [model_to_dict(con) for con in new_cons]
-                Connection.insert_many(con_dicts).execute()
-
-            # Every connection needs at least its last_update param reset but it
-            # should also be connected
-            existing_ids = [con.conn_id for con in existing_cons]
-            Connection \
-                .update(last_update=time_recieved, connected=True) \
-                .where(Connection.conn_id in existing_ids) \
-                .execute()
+        state_changes.extend(store.observe_connection(pair[0], pair[1], time_recieved))
 
     return state_changes
 
 
-def default_ctrl_handler(pkt, time_recieved, locks):
+def default_ctrl_handler(frame, time_recieved, store):
     """
     Default packet handler for control frames
     """
     return []
 
 
-def default_mgmt_handler(pkt, time_recieved, locks):
+def default_mgmt_handler(frame, time_recieved, store):
     """
     Default packet handler for management frames
     """
     return []
 
 
-def beacon_handler(pkt, time_recieved, locks):
+def beacon_handler(frame, time_recieved, store):
+    body = frame.body
+    # Most beacons are the same as the last one from their access point, so
+    # only look at them once in a while
+    if store.beacons is not None \
+            and store.beacons.check((frame.addr2, frame.subtype), ies.fingerprint(body), time_recieved):
+        return []
+
     state_changes = []
-    if pkt.haslayer(dot11.Dot11Elt):
-        dot11_layer = pkt
-        elt = pkt.getlayer(dot11.Dot11Elt)
-
-        network_info = {}
-        while elt:
-            if elt.ID == 0 and elt.info.decode("utf-8") != "":
-                network_info["ssid"] = elt.info.decode("utf-8")
-            elif elt.ID == 4:
-                network_info["channel"] = elt.info
-
-            # everything else would take too much time to parse...
-            elt = elt.payload.getlayer(dot11.Dot11Elt)
-
-        # We should probably save some info...
-        if "ssid" in network_info and network_info["ssid"]:
-            with locks["network"]:
-                try:
-                    network = Network.get_by_id(network_info["ssid"])
-                    if network.ssid != network_info["ssid"]:
-                        network.ssid = network_info["ssid"]
-                        network.save()
-
-                        state_changes.append(state.StateChange(
-                            state.ACTION_CREATE,
-                            Network,
-                            network,
-                            upates=["ssid"]
-                        ))
-                except peewee.DoesNotExist:
-                    network = Network.create(
-                        ssid=network_info["ssid"],
-                        channel=network_info["channel"] if "channel" in network_info else None
-                    )
-                    network.save()
-                    state_changes.append(state.StateChange(
-                        state.ACTION_CREATE,
-                        Network,
-                        network
-                    ))
-
-        # check for device and make sure is_ap is set
-        if not safe_mac(dot11_layer.addr2):
-            return state_changes
-
-        with locks["station"]:
-            try:
-                sta = Station.get_by_id(dot11_layer.addr2)
-                if not sta.is_ap:
-                    sta.is_ap = True
-                    sta.save(force_insert=True)
-
-                    state_changes.append(state.StateChange(
-                        state.ACTION_UPDATE,
-                        Station,
-                        sta,
-                        updates=["is_ap"]
-                    ))
-            except peewee.DoesNotExist:
-                sta = Station(
-                    mac=dot11_layer.addr2,
-                    is_ap=True,
-                    ssid=network_info["ssid"] if "ssid" in network_info else None
-                )
-                sta.save(force_insert=True)
-
-                state_changes.append(state.StateChange(
-                    state.ACTION_CREATE,
-                    Station,
-                    sta
-                ))
+    info = ies.parse(body)
+
+    if info.ssid:
+        state_changes.extend(store.observe_network(
+            info.ssid,
+            time_recieved,
+            channel=info.channel,
+            auth=info.auth,
+            enc=info.enc,
+            cipher=info.cipher
+        ))
+
+    # check for device and make sure is_ap is set
+    if not macs.is_station(frame.addr2):
+        return state_changes
+
+    state_changes.extend(store.observe_station(
+        frame.addr2,
+        time_recieved,
+        is_ap=True,
+        ssid=info.ssid
+    ))
 
     return state_changes
 
 
-def reassoc_handler(pkt, time_recieved, ldb_lock):
-    return []
+def observe_pair(frame, time_recieved, store, connected=None):
+    """
+    Records the stations of a management frame sent between an access point
+    and a client, and whether they are connected. With connected=None the
+    connection between them is left as it is.
+    """
+    bssid = frame.addr3
+    other = frame.addr1 if frame.addr2 == bssid else frame.addr2
 
+    # Deauths sent to broadcast kick everyone off, but that is more often an
+    # attack than the access point going away, so they are ignored
+    if other == bssid or not macs.is_station(bssid) or not macs.is_station(other):
+        return []
 
-def auth_handler(pkt, time_recieved, ldb_lock):
-    return []
+    state_changes = []
+    state_changes.extend(store.observe_station(bssid, time_recieved, is_ap=True))
+    state_changes.extend(store.observe_station(other, time_recieved))
+    if connected is not None:
+        state_changes.extend(store.observe_connection(bssid, other, time_recieved, connected=connected))
 
+    return state_changes
 
-def disconnect_handler(pkt, time_recieved, ldb_lock):
-    return []
 
-def safe_mac(mac):
-    for start in constants.MAC_RES_START:
-        if mac.lower().startswith(start):
-            return False
+def status_code(body, offset):
+    """
+    Returns the status code at offset in a frame body, or None if the body is
+    too short to have one
+    """
+    if len(body) < offset + STATUS_CODE.size:
+        return None
+
+    return STATUS_CODE.unpack_from(body, offset)[0]
+
+
+def reassoc_handler(frame, time_recieved, store):
+    """
+    Handles (re)association requests and responses. Only a response that
+    accepted the client connects it to the access point. Requests and
+    rejections just mean both stations are around.
+    """
+    connected = None
+    if frame.subtype in (constants.FRAME_SUBTYPE_ASSOC_RES, constants.FRAME_SUBTYPE_REASSOC_RES) \
+            and status_code(frame.body, ASSOC_RES_STATUS_OFFSET) == constants.STATUS_SUCCESS:
+        connected = True
+
+    return observe_pair(frame, time_recieved, store, connected)
+
+
+def auth_handler(frame, time_recieved, store):
+    """
+    Handles authentication frames. Authenticating is only the first step of
+    connecting, so these just mean both stations are around.
+    """
+    return observe_pair(frame, time_recieved, store)
+
 
-    return mac not in constants.UNSAFE_MACS
+def disconnect_handler(frame, time_recieved, store):
+    """
+    Handles deauthentication and disassociation frames, which end a
+    connection from either side
+    """
+    return observe_pair(frame, time_recieved, store, False)
@@ -0,0 +1,265 @@
+"""
+Parses the information elements at the end of beacons and probe responses.
+
+Elements are type-length-value records: a one byte element id, a one byte
+length and then that many bytes. They are walked in place on the frame's
+memoryview with struct, which is orders of magnitude faster than having
+scapy build a layer object for every element, and fast enough to parse every
+element of every beacon that gets past the beacon cache.
+"""
+import struct
+
+# Beacon and probe response bodies start with a timestamp (8 bytes) and
+# beacon interval (2 bytes), then capabilities (2 bytes) and the elements
+CAPABILITIES_OFFSET = 10
+ELEMENTS_OFFSET = 12
+CAPABILITY_PRIVACY = 0x0010
+
+ELEMENT_SSID = 0
+ELEMENT_DS_PARAMS = 3
+ELEMENT_TIM = 5
+ELEMENT_BSS_LOAD = 11
+ELEMENT_CSA = 37
+ELEMENT_QUIET = 40
+ELEMENT_HT_CAPABILITIES = 45
+ELEMENT_RSN = 48
+ELEMENT_EXT_CSA = 60
+ELEMENT_HT_OPERATION = 61
+ELEMENT_VHT_CAPABILITIES = 191
+ELEMENT_VENDOR = 221
+
+# Elements that change from one beacon to the next without anything we keep
+# changing. They are left out of fingerprints.
+VOLATILE_ELEMENTS = frozenset((
+    ELEMENT_TIM,
+    ELEMENT_BSS_LOAD,
+    ELEMENT_CSA,
+    ELEMENT_QUIET,
+    ELEMENT_EXT_CSA
+))
+
+OUI_IEEE = b"\x00\x0f\xac"
+OUI_MICROSOFT = b"\x00\x50\xf2"
+# Vendor element type Microsoft uses for the pre-RSN WPA element
+MICROSOFT_WPA = 1
+
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+SUITE_LEN = 4
+
+# Cipher suite types, the same for RSN (OUI_IEEE) and WPA (OUI_MICROSOFT)
+CIPHERS = {
+    1: "WEP",
+    2: "TKIP",
+    4: "CCMP",
+    5: "WEP",
+    8: "GCMP",
+    9: "GCMP-256",
+    10: "CCMP-256"
+}
+
+# Authentication and key management suite types, named like airodump-ng does
+AKMS = {
+    1: "MGT",
+    2: "PSK",
+    3: "MGT",
+    4: "PSK",
+    5: "MGT",
+    6: "PSK",
+    8: "SAE",
+    9: "SAE",
+    11: "MGT",
+    12: "MGT",
+    13: "MGT",
+    18: "OWE",
+    24: "SAE",
+    25: "SAE"
+}
+# AKMs that make an RSN network WPA3 rather than WPA2
+WPA3_AKMS = frozenset(("SAE", "OWE"))
+
+ENC_OPEN = "OPN"
+ENC_WEP = "WEP"
+ENC_WPA = "WPA"
+ENC_WPA2 = "WPA2"
+ENC_WPA3 = "WPA3"
+
+
+class NetworkInfo():
+    """
+    What the elements of a beacon or probe response say about its network.
+    auth, enc and cipher are space separated lists in the style of
+    airodump-ng ("WPA3 WPA2", "CCMP TKIP", "SAE PSK").
+    """
+    __slots__ = (
+        "ssid",
+        "channel",
+        "auth",
+        "enc",
+        "cipher",
+        "ht_capabilities",
+        "vht_capabilities",
+        "vendor_ouis",
+    )
+
+    def __init__(self):
+        self.ssid = None
+        self.channel = None
+        self.auth = None
+        self.enc = None
+        self.cipher = None
+        # The capabilities info fields, None if the element wasn't there
+        self.ht_capabilities = None
+        self.vht_capabilities = None
+        # Every vendor specific element's OUI, as "00:50:f2" strings
+        self.vendor_ouis = ()
+
+
+def iter_elements(body, offset=ELEMENTS_OFFSET):
+    """
+    Generator that yields (element id, offset of its value, length) for every
+    complete element in body, starting at offset. A truncated last element
+    is skipped.
+    """
+    end = len(body)
+    while offset + 2 <= end:
+        length = body[offset + 1]
+        start = offset + 2
+        offset = start + length
+        if offset > end:
+            return
+
+        yield body[start - 2], start, length
+
+
+def fingerprint(body):
+    """
+    Returns the capabilities and every element except the volatile ones as
+    bytes. Two frames with the same fingerprint tell us the same thing.
+    """
+    parts = [body[CAPABILITIES_OFFSET:ELEMENTS_OFFSET]]
+    for element_id, start, length in iter_elements(body):
+        if element_id not in VOLATILE_ELEMENTS:
+            parts.append(body[start - 2:start + length])
+
+    return b"".join(parts)
+
+
+def parse(body):
+    """
+    Parses the body of a beacon or probe response (as a memoryview or bytes)
+    into a NetworkInfo
+    """
+    info = NetworkInfo()
+    rsn = None
+    wpa = None
+    ht_channel = None
+    vendor_ouis = []
+
+    for element_id, start, length in iter_elements(body):
+        if element_id == ELEMENT_SSID:
+            # Hidden networks send an empty or all zero ssid
+            ssid = bytes(body[start:start + length])
+            if ssid.strip(b"\x00"):
+                info.ssid = ssid.decode("utf-8", "replace")
+        elif element_id == ELEMENT_DS_PARAMS and length:
+            info.channel = body[start]
+        elif element_id == ELEMENT_HT_OPERATION and length:
+            ht_channel = body[start]
+        elif element_id == ELEMENT_HT_CAPABILITIES and length >= 2:
+            info.ht_capabilities = U16.unpack_from(body, start)[0]
+        elif element_id == ELEMENT_VHT_CAPABILITIES and length >= 4:
+            info.vht_capabilities = U32.unpack_from(body, start)[0]
+        elif element_id == ELEMENT_RSN:
+            rsn = parse_rsn(body, start, start + length, OUI_IEEE)
+        elif element_id == ELEMENT_VENDOR and length >= 3:
+            oui = bytes(body[start:start + 3])
+            vendor_ouis.append(oui.hex(":"))
+            if oui == OUI_MICROSOFT and length >= 4 and body[start + 3] == MICROSOFT_WPA:
+                wpa = parse_rsn(body, start + 4, start + length, OUI_MICROSOFT)
+
+    # 5GHz access points often leave out the DS parameter set
+    if info.channel is None:
+        info.channel = ht_channel
+
+    info.vendor_ouis = tuple(vendor_ouis)
+    privacy = len(body) >= ELEMENTS_OFFSET \
+        and U16.unpack_from(body, CAPABILITIES_OFFSET)[0] & CAPABILITY_PRIVACY
+    set_security(info, rsn, wpa, privacy)
+
+    return info
+
+
+def parse_rsn(body, offset, end, oui):
+    """
+    Parses the body of an RSN element, or the WPA vendor element (which has
+    the same layout after its OUI and type), between offset and end. Returns
+    (pairwise ciphers, akms) as lists of names. Suites from other vendors are
+    skipped, and a truncated element yields whatever came before the cut.
+    """
+    ciphers = []
+    akms = []
+
+    # version, then the group cipher
+    offset += 2 + SUITE_LEN
+    if offset > end:
+        return ciphers, akms
+
+    for names, found in ((CIPHERS, ciphers), (AKMS, akms)):
+        if offset + 2 > end:
+            break
+
+        count = U16.unpack_from(body, offset)[0]
+        offset += 2
+        for _ in range(count):
+            if offset + SUITE_LEN > end:
+                return ciphers, akms
+
+            if body[offset:offset + 3] == oui:
+                name = names.get(body[offset + 3])
+                if name is not None and name not in found:
+                    found.append(name)
+
+            offset += SUITE_LEN
+
+    return ciphers, akms
+
+
+def set_security(info, rsn, wpa, privacy):
+    """
+    Fills in auth, enc and cipher of info from the parsed RSN and WPA
+    elements and the privacy capability bit
+    """
+    encs = []
+    ciphers = []
+    auths = []
+
+    for element, enc in ((rsn, ENC_WPA2), (wpa, ENC_WPA)):
+        if element is None:
+            continue
+
+        element_ciphers, element_akms = element
+        if enc == ENC_WPA2 and WPA3_AKMS.intersection(element_akms):
+            encs.append(ENC_WPA3)
+            # Transition mode networks take both SAE and PSK
+            if any(akm not in WPA3_AKMS for akm in element_akms):
+                encs.append(ENC_WPA2)
+        else:
+            encs.append(enc)
+
+        ciphers.extend(cipher for cipher in element_ciphers if cipher not in ciphers)
+        auths.extend(akm for akm in element_akms if akm not in auths)
+
+    if not encs:
+        if privacy:
+            encs.append(ENC_WEP)
+            ciphers.append("WEP")
+        else:
+            encs.append(ENC_OPEN)
+
+    # Strongest first
+    auths.sort(key=lambda akm: akm not in WPA3_AKMS)
+
+    info.enc = " ".join(encs)
+    info.cipher = " ".join(ciphers) or None
+    info.auth = " ".join(auths) or None
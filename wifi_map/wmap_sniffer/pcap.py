@@ -0,0 +1,313 @@
+import gzip
+import struct
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+
+PCAPNG_BLOCK_SHB = 0x0a0d0d0a
+PCAPNG_BLOCK_IDB = 0x00000001
+PCAPNG_BLOCK_PB = 0x00000002
+PCAPNG_BLOCK_SPB = 0x00000003
+PCAPNG_BLOCK_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_OPT_END = 0
+PCAPNG_OPT_IF_TSRESOL = 9
+PCAPNG_OPT_IF_TSOFFSET = 14
+
+LINKTYPE_IEEE802_11 = 105
+LINKTYPE_PRISM = 119
+LINKTYPE_RADIOTAP = 127
+LINKTYPE_AVS = 163
+LINKTYPE_PPI = 192
+
+RADIOTAP_PRESENT_TSFT = 0x1
+RADIOTAP_PRESENT_FLAGS = 0x2
+RADIOTAP_PRESENT_EXT = 0x80000000
+RADIOTAP_FLAG_FCS = 0x10
+RADIOTAP_FLAG_BAD_FCS = 0x40
+
+FCS_LEN = 4
+
+
+class PcapError(Exception):
+    """
+    Raised when a capture file can't be parsed
+    """
+    pass
+
+
+def open_capture(fname):
+    """
+    Opens a capture file for binary reading. Transparently decompresses
+    gzipped captures.
+    """
+    f = open(fname, "rb")
+    magic = f.read(len(GZIP_MAGIC))
+    f.seek(0)
+
+    if magic == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=f, mode="rb")
+
+    return f
+
+
+def read_frames(fname):
+    """
+    Generator that yields (frame, timestamp) tuples for every 802.11 frame in a
+    pcap or pcapng file (optionally gzipped). frame is the raw 802.11 header
+    and body with any radio/link layer header and FCS removed.
+
+    Records are read one at a time so memory use doesn't depend on the size of
+    the capture.
+    """
+    with open_capture(fname) as f:
+        head = f.read(4)
+        if len(head) < 4:
+            raise PcapError("{} is too short to be a capture file".format(fname))
+
+        if struct.unpack("<I", head)[0] == PCAPNG_BLOCK_SHB:
+            records = _read_pcapng(f, head)
+        else:
+            records = _read_pcap(f, head)
+
+        for linktype, data, timestamp in records:
+            frame = strip_link_header(linktype, data)
+            if frame is not None:
+                yield frame, timestamp
+
+
+def write_pcap(fname, frames, linktype=LINKTYPE_IEEE802_11):
+    """
+    Writes (frame, timestamp) tuples to a classic pcap file, gzipped if fname
+    ends in .gz. frames can be a generator so captures bigger than memory can
+    be written. Returns the number of frames written.
+    """
+    opener = gzip.open if fname.endswith(".gz") else open
+    record_header = struct.Struct("<IIII")
+    count = 0
+
+    with opener(fname, "wb") as f:
+        f.write(struct.pack("<IHHiIII", PCAP_MAGIC_USEC, 2, 4, 0, 0, 0xffff, linktype))
+        for frame, timestamp in frames:
+            ts_sec = int(timestamp)
+            ts_usec = int(round((timestamp - ts_sec) * 1e6))
+            if ts_usec >= 1000000:
+                ts_sec += 1
+                ts_usec -= 1000000
+
+            f.write(record_header.pack(ts_sec, ts_usec, len(frame), len(frame)))
+            f.write(frame)
+            count += 1
+
+    return count
+
+
+def _read_exact(f, length):
+    """
+    Reads exactly length bytes from f. Returns None at a clean end of file.
+    """
+    data = f.read(length)
+    if len(data) == length:
+        return data
+    elif len(data) == 0:
+        return None
+
+    raise PcapError("Capture file is truncated")
+
+
+def _read_pcap(f, head):
+    """
+    Yields (linktype, data, timestamp) for every record in a classic pcap file
+    """
+    for endian in ("<", ">"):
+        magic = struct.unpack(endian + "I", head)[0]
+        if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            break
+    else:
+        raise PcapError("Not a pcap or pcapng file")
+
+    divisor = 1e9 if magic == PCAP_MAGIC_NSEC else 1e6
+
+    global_header = _read_exact(f, 20)
+    if global_header is None:
+        raise PcapError("Missing pcap global header")
+
+    linktype = struct.unpack(endian + "IHHiIII", head + global_header)[6]
+    # Only the low 16 bits are the link type, the rest is FCS info
+    linktype &= 0xffff
+
+    record_header = struct.Struct(endian + "IIII")
+    while True:
+        header = _read_exact(f, record_header.size)
+        if header is None:
+            return
+
+        ts_sec, ts_frac, caplen, _ = record_header.unpack(header)
+        data = _read_exact(f, caplen)
+        if data is None:
+            raise PcapError("Capture file is truncated")
+
+        yield linktype, data, ts_sec + ts_frac / divisor
+
+
+def _read_pcapng(f, head):
+    """
+    Yields (linktype, data, timestamp) for every packet block in a pcapng file
+    """
+    endian = "<"
+    # (linktype, ticks per second, timestamp offset) for each interface in
+    # the current section
+    interfaces = []
+    last_timestamp = 0.0
+
+    block_type_bytes = head
+    while block_type_bytes is not None:
+        length_bytes = _read_exact(f, 4)
+        if length_bytes is None:
+            raise PcapError("Capture file is truncated")
+
+        if block_type_bytes == struct.pack("<I", PCAPNG_BLOCK_SHB):
+            # The section header is the only place the byte order is known
+            order = _read_exact(f, 4)
+            if order is None:
+                raise PcapError("Capture file is truncated")
+
+            if struct.unpack("<I", order)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+                endian = "<"
+            elif struct.unpack(">I", order)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+                endian = ">"
+            else:
+                raise PcapError("Bad pcapng byte order magic")
+
+            block_len = struct.unpack(endian + "I", length_bytes)[0]
+            body = order + _read_exact(f, block_len - 12)
+            interfaces = []
+        else:
+            block_len = struct.unpack(endian + "I", length_bytes)[0]
+            if block_len < 12:
+                raise PcapError("Bad pcapng block length {}".format(block_len))
+            body = _read_exact(f, block_len - 8)
+
+        if body is None:
+            raise PcapError("Capture file is truncated")
+
+        # the trailing block length isn't needed
+        body = memoryview(body)[:-4]
+        block_type = struct.unpack(endian + "I", block_type_bytes)[0]
+
+        if block_type == PCAPNG_BLOCK_IDB:
+            interfaces.append(_parse_idb(body, endian))
+        elif block_type == PCAPNG_BLOCK_EPB:
+            if_id, ts_high, ts_low, caplen, _ = struct.unpack_from(endian + "IIIII", body)
+            linktype, tps, offset = interfaces[if_id]
+            last_timestamp = offset + ((ts_high << 32) | ts_low) / tps
+            yield linktype, body[20:20 + caplen], last_timestamp
+        elif block_type == PCAPNG_BLOCK_SPB:
+            # Simple packet blocks have no timestamp and always belong to the
+            # first interface
+            linktype = interfaces[0][0]
+            origlen = struct.unpack_from(endian + "I", body)[0]
+            yield linktype, body[4:4 + origlen], last_timestamp
+        elif block_type == PCAPNG_BLOCK_PB:
+            if_id, _, ts_high, ts_low, caplen, _ = struct.unpack_from(endian + "HHIIII", body)
+            linktype, tps, offset = interfaces[if_id]
+            last_timestamp = offset + ((ts_high << 32) | ts_low) / tps
+            yield linktype, body[20:20 + caplen], last_timestamp
+
+        block_type_bytes = _read_exact(f, 4)
+
+
+def _parse_idb(body, endian):
+    """
+    Returns (linktype, ticks per second, timestamp offset) for an interface
+    description block
+    """
+    linktype = struct.unpack_from(endian + "H", body)[0]
+    tps = 1e6
+    ts_offset = 0
+
+    pos = 8
+    while pos + 4 <= len(body):
+        code, length = struct.unpack_from(endian + "HH", body, pos)
+        pos += 4
+        if code == PCAPNG_OPT_END:
+            break
+        elif code == PCAPNG_OPT_IF_TSRESOL:
+            resol = body[pos]
+            if resol & 0x80:
+                tps = float(2 ** (resol & 0x7f))
+            else:
+                tps = float(10 ** resol)
+        elif code == PCAPNG_OPT_IF_TSOFFSET:
+            ts_offset = struct.unpack_from(endian + "q", body, pos)[0]
+
+        # options are padded to 32 bits
+        pos += (length + 3) & ~3
+
+    return linktype, tps, ts_offset
+
+
+def strip_link_header(linktype, data):
+    """
+    Strips the radio/link header (and FCS if there is one) from a captured
+    packet and returns the raw 802.11 frame. Returns None if the link type isn't
+    802.11 based or the frame failed its FCS check.
+    """
+    if linktype == LINKTYPE_IEEE802_11:
+        return bytes(data)
+    elif linktype == LINKTYPE_RADIOTAP:
+        return _strip_radiotap(data)
+    elif linktype == LINKTYPE_PPI:
+        if len(data) < 8:
+            return None
+
+        ppi_len, dlt = struct.unpack_from("<HI", data, 2)
+        return strip_link_header(dlt, data[ppi_len:])
+    elif linktype == LINKTYPE_PRISM:
+        if len(data) < 8:
+            return None
+
+        prism_len = struct.unpack_from("<I", data, 4)[0]
+        return bytes(data[prism_len:])
+    elif linktype == LINKTYPE_AVS:
+        if len(data) < 8:
+            return None
+
+        avs_len = struct.unpack_from(">I", data, 4)[0]
+        return bytes(data[avs_len:])
+
+    return None
+
+
+def _strip_radiotap(data):
+    """
+    Returns the 802.11 frame inside of a radiotap header
+    """
+    if len(data) < 8:
+        return None
+
+    rt_len, present = struct.unpack_from("<HI", data, 2)
+    flags = 0
+
+    # Flags is the only field we care about. It comes after the
+    # (possibly extended) present bitmasks and the TSFT field
+    offset = 8
+    ext = present
+    while ext & RADIOTAP_PRESENT_EXT and offset + 4 <= rt_len:
+        ext = struct.unpack_from("<I", data, offset)[0]
+        offset += 4
+
+    if present & RADIOTAP_PRESENT_TSFT:
+        offset = ((offset + 7) & ~7) + 8
+
+    if present & RADIOTAP_PRESENT_FLAGS and offset < rt_len:
+        flags = data[offset]
+
+    if flags & RADIOTAP_FLAG_BAD_FCS:
+        return None
+    elif flags & RADIOTAP_FLAG_FCS:
+        return bytes(data[rt_len:len(data) - FCS_LEN])
+
+    return bytes(data[rt_len:])
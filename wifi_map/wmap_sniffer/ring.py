@@ -0,0 +1,145 @@
+import array
+import threading
+import time
+
+# Bytes per slot. Big enough for any 802.11 frame without aggregation.
+# Longer frames are truncated, which only loses the end of the body.
+FRAME_SLOT_SIZE = 2368
+
+
+class FrameRing():
+    """
+    Fixed capacity queue of frames between one producer (the capture loop)
+    and one consumer (a worker).
+
+    Frame bytes, lengths and timestamps live in arrays allocated up front, so
+    putting a frame is a copy into a free slot rather than a new object, and
+    the consumer reads it in place through a memoryview. head and tail are
+    each only written by one side, so with the GIL no lock is needed on the
+    fast path. Events are only touched when a side actually has to wait.
+
+    When the ring is full put either waits for a free slot (block=True, used
+    when reading capture files) or drops the new frame (block=False, used for
+    live capture where waiting would just push the loss into the kernel).
+    """
+
+    def __init__(self, slots, slot_size=FRAME_SLOT_SIZE):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buffer = bytearray(slots * slot_size)
+        self.view = memoryview(self.buffer)
+        self.lengths = array.array("I", [0]) * slots
+        self.timestamps = array.array("d", [0.0]) * slots
+        # time.monotonic() when each frame was put, for measuring latency
+        self.queued_at = array.array("d", [0.0]) * slots
+
+        # Total frames read (head) and written (tail). Slot is count % slots.
+        self.head = 0
+        self.tail = 0
+
+        self._consumer_waiting = False
+        self._producer_waiting = False
+        self._not_empty = threading.Event()
+        self._not_full = threading.Event()
+
+        # Stats
+        self.frames_in = 0
+        self.dropped = 0
+        self.truncated = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def put(self, frame, timestamp, block=True, timeout=None):
+        """
+        Copies a frame into the next free slot. Returns False if the frame
+        was dropped because the ring is full.
+        """
+        while self.tail - self.head >= self.slots:
+            if not block or not self._wait_not_full(timeout):
+                self.dropped += 1
+                return False
+
+        length = len(frame)
+        if length > self.slot_size:
+            length = self.slot_size
+            frame = memoryview(frame)[:length]
+            self.truncated += 1
+
+        index = self.tail % self.slots
+        start = index * self.slot_size
+        self.view[start:start + length] = frame
+        self.lengths[index] = length
+        self.timestamps[index] = timestamp
+        self.queued_at[index] = time.monotonic()
+
+        # Publishing the frame has to come after it is written
+        self.tail += 1
+        self.frames_in += 1
+
+        used = self.tail - self.head
+        if used > self.high_water:
+            self.high_water = used
+
+        if self._consumer_waiting:
+            self._not_empty.set()
+
+        return True
+
+    def get(self, timeout=None):
+        """
+        Returns (frame, timestamp, queued_at) for the oldest frame, or None if
+        there wasn't one within timeout seconds. frame is a memoryview into
+        the slot, which stays valid until release is called.
+        """
+        if self.tail == self.head and not self._wait_not_empty(timeout):
+            return None
+
+        index = self.head % self.slots
+        start = index * self.slot_size
+        return (
+            self.view[start:start + self.lengths[index]],
+            self.timestamps[index],
+            self.queued_at[index]
+        )
+
+    def release(self):
+        """
+        Gives the slot of the frame returned by get back to the producer
+        """
+        self.head += 1
+        if self._producer_waiting:
+            self._not_full.set()
+
+    def _wait_not_empty(self, timeout):
+        self._consumer_waiting = True
+        self._not_empty.clear()
+        # The producer may have added a frame before it saw that we are
+        # waiting, so check again before sleeping
+        if self.tail == self.head:
+            self._not_empty.wait(timeout)
+
+        self._consumer_waiting = False
+        return self.tail != self.head
+
+    def _wait_not_full(self, timeout):
+        self._producer_waiting = True
+        self._not_full.clear()
+        if self.tail - self.head >= self.slots:
+            self._not_full.wait(timeout)
+
+        self._producer_waiting = False
+        return self.tail - self.head < self.slots
+
+    def stats(self):
+        """
+        Returns a one line summary of the ring's counters
+        """
+        return "{} frames in, {} dropped, {} truncated, at most {} of {} slots used".format(
+            self.frames_in,
+            self.dropped,
+            self.truncated,
+            self.high_water,
+            self.slots
+        )
@@ -1,14 +1,20 @@
 # import threading
-import threading
 import time
-import os
 import queue
 
 import scapy.all as sc
 import scapy.layers.dot11 as dot11
 
+from wmap_common import constants
+from wmap_common import trace
 from wmap_common.constants import DEFAULT_CONFIG
-from . import handlers
+from . import capture
+from . import pcap
+from . import workers
+
+# Replay doesn't sleep for gaps shorter than this (in seconds), since sleeping
+# that little isn't accurate anyway. The gaps catch up with later frames.
+MIN_REPLAY_SLEEP = 0.001
 
 
 def sniff(interface, update_queue, config=DEFAULT_CONFIG):
@@ -16,10 +22,57 @@ def sniff(interface, update_queue, config=DEFAULT_CONFIG):
     Listens for 802.11 packets on an interface and stores/queues
     revelant information.
     """
-    packet_queue = queue.Queue()
-    completion_event = threading.Event()
-    spawn_workers(packet_queue, update_queue, completion_event)
+    pool = workers.start_pool(update_queue, config)
+
+    if config.get("capture_backend", constants.DEFAULT_CAPTURE_BACKEND) == constants.CAPTURE_BACKEND_SCAPY:
+        sniff_scapy(interface, pool)
+    else:
+        sniff_socket(interface, pool, config)
+
+    print("Closing...")
+    pool.close()
+
+
+def sniff_socket(interface, pool, config=DEFAULT_CONFIG):
+    """
+    Captures frames with a raw socket and hands them to the pool until
+    interrupted
+    """
+    try:
+        live = capture.LiveCapture(
+            interface,
+            ring_frames=config.get("ring_frames", constants.DEFAULT_RING_FRAMES)
+        )
+    except capture.CaptureError as err:
+        print("Failed to capture on {}: {}".format(interface, err))
+        return
 
+    dropped = 0
+    with live:
+        print("Sniffing packets...")
+        try:
+            for frame, time_recieved in live.frames():
+                try:
+                    pool.dispatch(frame, time_recieved, block=False)
+                except queue.Full:
+                    # The workers can't keep up. Dropping is better than
+                    # letting the queue eat all of the memory
+                    dropped += 1
+        except KeyboardInterrupt:
+            pass
+
+        _, kernel_dropped = live.stats()
+
+    print("Dropped {} frames the workers couldn't keep up with and {} the kernel couldn't".format(
+        dropped, kernel_dropped
+    ))
+
+
+def sniff_scapy(interface, pool):
+    """
+    Captures frames with scapy and hands them to the pool until interrupted.
+    Slower than sniff_socket but works on any platform scapy does.
+    """
     def callback(packet):
         if packet.haslayer(dot11.Dot11):
             # We don't need anything below the dot11 layer
@@ -27,123 +80,81 @@ def sniff(interface, update_queue, config=DEFAULT_CONFIG):
             layer_bytes = sc.raw(dot11_layer)
             time_recieved = time.time()
 
-            message = {
-                "pkt": layer_bytes,
-                "rcvd": time_recieved
-            }
-
-            packet_queue.put(message, block=False)
-
-    # TODO replace with raw socket listen. Scapy has too much overhead.
-    sniff_proc = threading.Thread(
-        target=sc.sniff,
-        kwargs={
-            "iface": interface,
-            "prn": callback
-        }
-    )
+            try:
+                pool.dispatch(layer_bytes, time_recieved, block=False)
+            except queue.Full:
+                # The workers can't keep up. Dropping is better than letting
+                # the queue eat all of the memory
+                pass
 
     print("Sniffing packets...")
-    sniff_proc.start()
+    # scapy stops sniffing when it gets a KeyboardInterrupt
+    sc.sniff(iface=interface, prn=callback, store=False)
 
 
 def read(fname, update_queue, config=DEFAULT_CONFIG):
     """
     Reads 802.11 packets from a pcap file and stores/queues
     relevant information.
+
+    Frames keep the timestamps from the capture. If config has a speed the
+    frames are handed out at that many times the pace they were captured at,
+    otherwise they are read as fast as the workers can handle them and the
+    throughput and latency are printed at the end. Returns the
+    LatencyHistogram of the frames read.
+
+    If config has a profile file the whole replay is run under the sampling
+    profiler and the stacks are written to it.
     """
-    # TODO probably need to limit the # number of packets
-    # written to the queue per second. We're writing
-    # wayyyyyyy faster than we're reading.
-    packet_queue = queue.Queue()
-    completion_event = threading.Event()
-    workers = spawn_workers(packet_queue, update_queue, completion_event)
+    speed = config.get("speed", constants.DEFAULT_SPEED)
+    profile = config.get("profile", constants.DEFAULT_PROFILE)
+
+    sampler = None
+    if profile is not None:
+        sampler = trace.StackSampler()
+        sampler.start()
 
+    pool = workers.start_pool(update_queue, config)
+
+    frames = 0
+    start = time.monotonic()
     try:
         print("Reading...")
-        packets = sc.rdpcap(fname)
-        print("Placing on queue...")
-        for packet in packets:
-            if packet.haslayer(dot11.Dot11):
-                # We don't need anything below the dot11 layer
-                dot11_layer = packet.getlayer(dot11.Dot11)
-                layer_bytes = sc.raw(dot11_layer)
-                time_recieved = time.time()
-
-                message = {
-                    "pkt": layer_bytes,
-                    "rcvd": time_recieved
-                }
-
-                packet_queue.put(message, block=False)
-        print("Threading...")
-        # completion_event.set()
+        first_timestamp = None
+        for frame, timestamp in pcap.read_frames(fname):
+            if speed is not None:
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+
+                # How far ahead of the capture's pace we are
+                delay = (timestamp - first_timestamp) / speed - (time.monotonic() - start)
+                if delay > MIN_REPLAY_SLEEP:
+                    time.sleep(delay)
+
+            # The queues are bounded so this blocks instead of reading the
+            # whole file into memory when it gets ahead of the workers.
+            pool.dispatch(frame, timestamp)
+            frames += 1
     except KeyboardInterrupt:
         print("Closing...")
-        completion_event.set()
+    except pcap.PcapError as err:
+        print("Failed to read {}: {}".format(fname, err))
 
-    for worker in workers:
-        worker.join()
+    latency = pool.close()
+    elapsed = time.monotonic() - start
 
     print("Completed queueing updates")
 
+    if sampler is not None:
+        stacks = sampler.stop()
+        stacks.update(pool.stacks)
+        trace.write_folded(profile, stacks)
+        print("Wrote {} profile samples to {}".format(sum(stacks.values()), profile))
 
-def spawn_workers(packet_queue, update_queue, completion_event):
-    """
-    Spawns subprocesses to grab packets from the packet queue
-    """
-    num_workers = os.cpu_count()
-    procs = []
-
-    # This lock must be acquired before executing database writes or database
-    # reads followed by dependent database writes.
-    # TODO implement this more efficiently. This is rather hamfisted.
-    locks = {
-        "station": threading.Lock(),
-        "connection": threading.Lock(),
-        "network": threading.Lock()
-    }
-
-    for i in range(num_workers):
-        proc = threading.Thread(
-            target=process_packets, args=(packet_queue, locks, completion_event, update_queue)
-        )
-        proc.start()
-        procs.append(proc)
-
-    return procs
-
-
-def process_packets(packet_queue, locks, completion_event, update_queue):
-    """
-    Reads packets of the packet_queue, writes new info to the database,
-    and places any updates on the update queue for the server to pull from
-    """
-    while True:
-        try:
-            message = packet_queue.get(block=False)
-            packet = dot11.Dot11(message["pkt"])
-            time_recieved = message["rcvd"]
-            handler = handlers.get_handler(packet.type, packet.subtype)
-
-            changes = handler(packet, time_recieved, locks)
-
-            if len(changes) > 0:
-                update = {}
-                for change in changes:
-                    class_name = change.objtype.class_name
-                    if class_name not in update:
-                        update[class_name] = []
-
-                    update[class_name].append(change.to_dict())
-
-                update_queue.put(update, block=False)
-
-        except queue.Empty:
-            if completion_event.is_set():
-                print("Queue empty. leaving")
-                return
-            else:
-                time.sleep(1)
+    if speed is None:
+        print("Handled {} frames in {:.2f}s ({:.0f} frames/sec)".format(
+            frames, elapsed, frames / elapsed if elapsed else 0
+        ))
+        print("Latency from reading a frame to queueing its updates: {}".format(latency.summary()))
 
-        # TODO enqueue update
+    return latency
@@ -0,0 +1,155 @@
+"""
+Generates synthetic 802.11 traffic for benchmarking.
+
+The traffic comes from a made up neighbourhood of access points and the
+stations associated with them: beacons from the access points, probe requests
+from the stations and data frames between the two. Frames are built with
+struct rather than scapy so captures with millions of frames can be generated
+in reasonable time, and a seed makes them reproducible.
+"""
+import random
+import struct
+
+from wmap_common import constants
+
+FRAME_KIND_BEACON = "beacon"
+FRAME_KIND_PROBE = "probe"
+FRAME_KIND_DATA = "data"
+FRAME_KINDS = (FRAME_KIND_BEACON, FRAME_KIND_PROBE, FRAME_KIND_DATA)
+
+# Share of each kind of frame when no mix is given
+DEFAULT_MIX = {
+    FRAME_KIND_BEACON: 0.2,
+    FRAME_KIND_PROBE: 0.1,
+    FRAME_KIND_DATA: 0.7
+}
+
+DEFAULT_STATIONS_PER_AP = 20
+
+# Frames per second of capture time
+DEFAULT_RATE = 2000.0
+
+# First frame control byte (subtype << 4 | type << 2) of each kind
+FC_BEACON = constants.FRAME_SUBTYPE_BEACON << 4 | constants.FRAME_TYPE_MGMT << 2
+FC_PROBE_REQ = constants.FRAME_SUBTYPE_PROBE_REQ << 4 | constants.FRAME_TYPE_MGMT << 2
+FC_DATA = constants.FRAME_TYPE_DATA << 2
+
+BROADCAST = b"\xff" * 6
+
+# frame control, flags, duration, addr1, addr2, addr3, sequence control
+HEADER = struct.Struct("<BBH6s6s6sH")
+# beacon timestamp, beacon interval, capabilities (ESS and privacy)
+BEACON_FIXED = struct.Struct("<QHH")
+BEACON_INTERVAL = 100
+BEACON_CAPABILITIES = 0x0011
+
+# Supported rates element: 1, 2, 5.5, 11, 6, 9, 12 and 18 Mbps
+RATES_ELEMENT = bytes([1, 8, 0x82, 0x84, 0x8b, 0x96, 0x0c, 0x12, 0x18, 0x24])
+
+# Stand in for an LLC/SNAP header and some payload
+DATA_BODY = bytes([0xaa, 0xaa, 0x03, 0, 0, 0, 0x08, 0x00]) + bytes(56)
+
+CHANNELS = (1, 6, 11, 36, 40, 44, 48, 149, 153, 157, 161)
+
+
+def parse_mix(value):
+    """
+    Parses a frame mix like "beacon=0.2,probe=0.1,data=0.7" into a dict.
+    Kinds that aren't mentioned get no frames. Raises ValueError if the
+    string isn't valid.
+    """
+    mix = {}
+    for part in value.split(","):
+        kind, _, share = part.partition("=")
+        kind = kind.strip()
+        if kind not in FRAME_KINDS:
+            raise ValueError("Unknown frame kind {}".format(kind))
+
+        mix[kind] = float(share)
+        if mix[kind] < 0:
+            raise ValueError("Share of {} frames can't be negative".format(kind))
+
+    if not sum(mix.values()):
+        raise ValueError("Frame mix is empty")
+
+    return mix
+
+
+def make_mac(prefix, index):
+    """
+    Returns a locally administered unicast mac address (as bytes) that is
+    unique for the prefix and index
+    """
+    return bytes([prefix & 0xfe | 0x02]) + index.to_bytes(5, "big")
+
+
+def generate_frames(stations, frames, aps=None, mix=None, rate=DEFAULT_RATE, seed=0, start=0.0):
+    """
+    Generator that yields (frame, timestamp) tuples of synthetic traffic,
+    same as pcap.read_frames.
+
+    stations client stations are spread evenly over aps access points (one
+    per DEFAULT_STATIONS_PER_AP stations by default). mix is the share of
+    each kind of frame (see DEFAULT_MIX). Frames are rate per second apart
+    on average, starting at the start timestamp.
+    """
+    if aps is None:
+        aps = max(1, stations // DEFAULT_STATIONS_PER_AP)
+
+    mix = mix or DEFAULT_MIX
+    total = sum(mix.values())
+    beacon_share = mix.get(FRAME_KIND_BEACON, 0) / total
+    probe_share = beacon_share + mix.get(FRAME_KIND_PROBE, 0) / total
+
+    rng = random.Random(seed)
+
+    bssids = [make_mac(0x00, i) for i in range(aps)]
+    # The router on the wired side of each access point
+    gateways = [make_mac(0x08, i) for i in range(aps)]
+    beacon_tails = []
+    for i in range(aps):
+        ssid = "synth-{}".format(i).encode()
+        channel = CHANNELS[i % len(CHANNELS)]
+        beacon_tails.append(bytes([0, len(ssid)]) + ssid + RATES_ELEMENT + bytes([3, 1, channel]))
+
+    # Probe requests either look for the station's own network or anything
+    probe_tails = [b"\x00\x00" + RATES_ELEMENT]
+    probe_tails.extend(tail[:2 + tail[1]] + RATES_ELEMENT for tail in beacon_tails)
+
+    clients = [make_mac(0x04, i) for i in range(stations)]
+    # index of the access point each station is associated with
+    homes = [i % aps for i in range(stations)]
+
+    timestamp = start
+    gap = 2.0 / rate
+    seq = 0
+
+    for _ in range(frames):
+        timestamp += rng.random() * gap
+        seq = (seq + 1) & 0xfff
+        roll = rng.random()
+
+        if roll < beacon_share or not stations:
+            ap = rng.randrange(aps)
+            bssid = bssids[ap]
+            frame = HEADER.pack(FC_BEACON, 0, 0, BROADCAST, bssid, bssid, seq << 4) \
+                + BEACON_FIXED.pack(int(timestamp * 1e6), BEACON_INTERVAL, BEACON_CAPABILITIES) \
+                + beacon_tails[ap]
+        else:
+            index = rng.randrange(stations)
+            client = clients[index]
+            home = homes[index]
+
+            if roll < probe_share:
+                tail = probe_tails[0] if rng.random() < 0.5 else probe_tails[home + 1]
+                frame = HEADER.pack(FC_PROBE_REQ, 0, 0, BROADCAST, client, BROADCAST, seq << 4) + tail
+            elif rng.random() < 0.5:
+                # client to the network through its access point
+                frame = HEADER.pack(FC_DATA, constants.FC_FLAG_TO_DS, 0, bssids[home], client,
+                                    gateways[home], seq << 4) + DATA_BODY
+            else:
+                # from the network to the client
+                frame = HEADER.pack(FC_DATA, constants.FC_FLAG_FROM_DS, 0, client, bssids[home],
+                                    gateways[home], seq << 4) + DATA_BODY
+
+        yield frame, timestamp
@@ -0,0 +1,728 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from wmap_common import constants
+from wmap_common import metrics
+from wmap_common import trace
+from wmap_common.db_utils import get_db
+from wmap_common.metrics import LatencyHistogram, WorkerMetrics
+from wmap_common.store import StateStore, get_last_conn_id, partition_of
+from . import frame as wmap_frame
+from . import handlers
+from .ring import FrameRing
+
+# How long an idle worker waits for a packet before checking if it should exit
+WORKER_POLL_INTERVAL = 0.1
+
+# How often worker processes send their metrics to the parent, in seconds
+METRICS_INTERVAL = 1.0
+
+log = logging.getLogger(__name__)
+
+
+def start_pool(update_queue, config=constants.DEFAULT_CONFIG):
+    """
+    Starts the workers that decode and handle frames. Returns a ThreadPool or
+    a ProcessPool depending on the configured worker mode.
+    """
+    num_workers = config.get("workers") or os.cpu_count()
+
+    if config.get("worker_mode", constants.DEFAULT_WORKER_MODE) == constants.WORKER_MODE_PROCESS:
+        return ProcessPool(update_queue, num_workers, config)
+
+    return ThreadPool(update_queue, num_workers, config)
+
+
+def make_store(config, partition=0, partitions=1, mailboxes=None, last_conn_id=0):
+    """
+    Returns a StateStore for one worker's partition, set up from config.
+    last_conn_id is the result of get_last_conn_id, queried once for all
+    the partitions.
+    """
+    return StateStore(
+        partition=partition,
+        partitions=partitions,
+        mailboxes=mailboxes,
+        flush_interval=config.get("flush_interval", constants.DEFAULT_FLUSH_INTERVAL),
+        flush_batch_size=config.get("flush_batch_size", constants.DEFAULT_FLUSH_BATCH_SIZE),
+        beacon_cache_size=config.get("beacon_cache_size", constants.DEFAULT_BEACON_CACHE_SIZE),
+        beacon_cache_ttl=config.get("beacon_cache_ttl", constants.DEFAULT_BEACON_CACHE_TTL),
+        duplicate_cache_size=config.get("duplicate_cache_size", constants.DEFAULT_DUPLICATE_CACHE_SIZE),
+        duplicate_window=config.get("duplicate_window", constants.DEFAULT_DUPLICATE_WINDOW),
+        connection_timeout=config.get("connection_timeout", constants.DEFAULT_CONNECTION_TIMEOUT),
+        max_stations=config.get("max_stations", constants.DEFAULT_MAX_STATIONS),
+        archive_stations=config.get("archive_stations", constants.DEFAULT_ARCHIVE_STATIONS),
+        last_conn_id=last_conn_id
+    )
+
+
+def report_stats(store, ring=None):
+    """
+    Logs the summaries of a worker's store (and ring, for thread workers)
+    when it exits
+    """
+    log.info(store.flush_stats())
+    if store.beacons is not None:
+        log.info("partition %d: beacon cache %s", store.partition, store.beacons.stats())
+    if store.duplicates is not None:
+        log.info("partition %d: duplicate cache %s", store.partition, store.duplicates.stats())
+    log.info("partition %d: %s", store.partition, store.station_stats())
+    log.info("partition %d: %s", store.partition, store.connection_stats())
+    if ring is not None:
+        log.info("partition %d: %s", store.partition, ring.stats())
+
+
+class ThreadPool():
+    """
+    Handles frames with a worker thread per partition of the state. Frames
+    are copied into a preallocated FrameRing per worker.
+    """
+
+    def __init__(self, update_queue, num_workers, config=constants.DEFAULT_CONFIG):
+        self.completion_event = threading.Event()
+        self.rings = [
+            FrameRing(max(1, constants.PACKET_QUEUE_SIZE // num_workers))
+            for i in range(num_workers)
+        ]
+
+        # Workers use these to hand each other observations of records they
+        # don't own.
+        mailboxes = [queue.Queue() for i in range(num_workers)]
+        drained_barrier = threading.Barrier(num_workers)
+
+        # How long frames took from dispatch to having their changes queued
+        self.latencies = [LatencyHistogram() for i in range(num_workers)]
+
+        # Workers only time their handlers when metrics are on
+        self.worker_metrics = None
+        if config.get("metrics", constants.DEFAULT_METRICS):
+            self.worker_metrics = [WorkerMetrics(i) for i in range(num_workers)]
+            metrics.REGISTRY.register(self.collect_metrics)
+
+        # Stacks sampled by worker processes. The profiler in this process
+        # sees worker threads already.
+        self.stacks = trace.StackCounts()
+
+        trace_writer = trace.get_writer(config)
+
+        last_conn_id = get_last_conn_id()
+        self.stores = []
+        self.workers = []
+        for i in range(num_workers):
+            store = make_store(config, i, num_workers, mailboxes, last_conn_id)
+
+            tracer = None
+            if trace_writer is not None:
+                tracer = trace.FrameTracer(i, trace_writer.write, trace_writer.sample, trace_writer.slow)
+
+            worker = threading.Thread(
+                target=process_packets,
+                args=(self.rings[i], mailboxes[i], store, drained_barrier,
+                      self.completion_event, update_queue, self.latencies[i],
+                      self.worker_metrics[i] if self.worker_metrics else None, tracer)
+            )
+            worker.start()
+            self.stores.append(store)
+            self.workers.append(worker)
+
+    def dispatch(self, frame, time_recieved, block=True):
+        """
+        Copies a raw frame into the ring of the worker that owns it. Raises
+        queue.Full if block is False and that worker's ring is full.
+        """
+        try:
+            owner = wmap_frame.owner_address(frame)
+        except ValueError:
+            # Too short to be worth handing to a worker
+            return
+
+        index = partition_of(owner, len(self.rings))
+        if not self.rings[index].put(frame, time_recieved, block=block):
+            raise queue.Full
+
+    def close(self):
+        """
+        Lets the workers finish whatever is queued and waits for them to exit.
+        Returns the LatencyHistogram of every frame handled.
+        """
+        self.completion_event.set()
+        for worker in self.workers:
+            worker.join()
+
+        return metrics.merged(self.latencies)
+
+    def collect_metrics(self):
+        """
+        Metrics collector for the pool
+        """
+        for worker_metrics, store in zip(self.worker_metrics, self.stores):
+            worker_metrics.copy_store_stats(store)
+
+        samples = [
+            metrics.counter(
+                "wifi_map_frames_dispatched_total", "Frames handed to the workers",
+                sum(ring.frames_in for ring in self.rings)
+            ),
+            metrics.counter(
+                "wifi_map_frames_dropped_total", "Frames dropped because a worker's queue was full",
+                sum(ring.dropped for ring in self.rings)
+            ),
+            metrics.gauge(
+                "wifi_map_packet_queue_frames", "Frames waiting for a worker",
+                sum(len(ring) for ring in self.rings)
+            )
+        ]
+        samples.extend(metrics.worker_samples(self.worker_metrics, metrics.merged(self.latencies)))
+
+        return samples
+
+
+class ProcessPool():
+    """
+    Handles frames with a worker process per partition of the state so that
+    decoding and handling aren't limited to one core by the GIL.
+
+    Frames are sent to the workers in batches to keep the cost of pickling
+    and the pipe writes down. The state changes each worker produces are sent
+    back in batches too, and a thread in this process moves them onto the
+    update queue.
+    """
+
+    def __init__(self, update_queue, num_workers, config=constants.DEFAULT_CONFIG):
+        # The workers rely on inheriting the parent's modules so this has to
+        # fork. SQLite connections can't be shared with the children.
+        context = multiprocessing.get_context("fork")
+        last_conn_id = get_last_conn_id()
+        get_db().close()
+
+        self.batch_size = config.get("batch_size", constants.DEFAULT_WORKER_BATCH_SIZE)
+        self.batch_timeout = config.get("batch_timeout", constants.DEFAULT_WORKER_BATCH_TIMEOUT)
+        self.completion_event = context.Event()
+
+        max_batches = max(1, constants.PACKET_QUEUE_SIZE // self.batch_size // num_workers)
+        self.packet_queues = [context.Queue(maxsize=max_batches) for i in range(num_workers)]
+        mailboxes = [context.Queue() for i in range(num_workers)]
+        drained_barrier = context.Barrier(num_workers)
+        result_queue = context.Queue()
+
+        self._batches = [[] for i in range(num_workers)]
+        self._batch_started = [0.0] * num_workers
+        self._batch_lock = threading.Lock()
+
+        self.workers = []
+        for i in range(num_workers):
+            worker = context.Process(
+                target=process_worker,
+                args=(i, num_workers, self.packet_queues[i], mailboxes, drained_barrier,
+                      self.completion_event, result_queue, config, last_conn_id),
+                daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+
+        self.dispatched = 0
+        self.dropped = 0
+        self.latency = LatencyHistogram()
+        # The latest metrics sent by each worker, when metrics are on
+        self.worker_metrics = [WorkerMetrics(i) for i in range(num_workers)]
+        if config.get("metrics", constants.DEFAULT_METRICS):
+            metrics.REGISTRY.register(self.collect_metrics)
+
+        self.stacks = trace.StackCounts()
+
+        self._closed = threading.Event()
+        self._forwarder = threading.Thread(
+            target=forward_results,
+            args=(result_queue, update_queue, num_workers, self.latency, self.worker_metrics,
+                  self.stacks, trace.get_writer(config)),
+            daemon=True
+        )
+        self._forwarder.start()
+
+        # Makes sure a partly filled batch doesn't sit around while capture
+        # is quiet
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def dispatch(self, frame, time_recieved, block=True):
+        """
+        Adds a raw frame to the batch for the worker that owns it. Raises
+        queue.Full if block is False and that worker's queue is full.
+        """
+        try:
+            owner = wmap_frame.owner_address(frame)
+        except ValueError:
+            # Too short to be worth handing to a worker
+            return
+
+        index = partition_of(owner, len(self.packet_queues))
+
+        with self._batch_lock:
+            batch = self._batches[index]
+            if not batch:
+                self._batch_started[index] = time.monotonic()
+
+            batch.append((frame, time_recieved, time.monotonic()))
+            self.dispatched += 1
+            if len(batch) >= self.batch_size:
+                try:
+                    self._send_batch(index, block)
+                except queue.Full:
+                    # The workers can't keep up with live capture so the
+                    # whole batch is dropped
+                    self.dropped += len(batch)
+                    self._batches[index] = []
+                    raise
+
+    def _send_batch(self, index, block=True):
+        self.packet_queues[index].put(self._batches[index], block=block)
+        self._batches[index] = []
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.batch_timeout):
+            self.flush(stale_only=True)
+
+    def flush(self, stale_only=False):
+        """
+        Sends every partly filled batch to its worker. With stale_only only
+        batches older than batch_timeout are sent.
+        """
+        now = time.monotonic()
+        with self._batch_lock:
+            for index, batch in enumerate(self._batches):
+                if batch and (not stale_only or now - self._batch_started[index] >= self.batch_timeout):
+                    try:
+                        self._send_batch(index, block=not stale_only)
+                    except queue.Full:
+                        # The batch is kept and tried again later
+                        pass
+
+    def close(self):
+        """
+        Sends the last batches, lets the workers finish whatever is queued and
+        waits for them and the result forwarder to exit. Returns the
+        LatencyHistogram of every frame handled.
+        """
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+
+        self.completion_event.set()
+        for worker in self.workers:
+            worker.join()
+
+        self._forwarder.join()
+
+        return self.latency
+
+    def collect_metrics(self):
+        """
+        Metrics collector for the pool. Worker numbers are as of the last
+        time each worker sent them.
+        """
+        latencies = [worker.latency for worker in self.worker_metrics if worker.latency is not None]
+
+        samples = [
+            metrics.counter(
+                "wifi_map_frames_dispatched_total", "Frames handed to the workers", self.dispatched
+            ),
+            metrics.counter(
+                "wifi_map_frames_dropped_total", "Frames dropped because a worker's queue was full",
+                self.dropped
+            ),
+            metrics.gauge(
+                "wifi_map_packet_queue_frames", "Frames waiting for a worker",
+                sum(packet_queue.qsize() for packet_queue in self.packet_queues) * self.batch_size
+                + sum(len(batch) for batch in self._batches)
+            )
+        ]
+        samples.extend(metrics.worker_samples(self.worker_metrics, metrics.merged(latencies)))
+
+        return samples
+
+
+def process_packets(ring, mailbox, store, drained_barrier, completion_event, update_queue, latency,
+                    worker_metrics=None, tracer=None):
+    """
+    Reads packets of the worker's ring, writes new info to the worker's
+    partition of the state, and places any updates on the update queue for the
+    server to pull from. How long each frame took is recorded in latency, the
+    frame types and handler times in worker_metrics if it is given and
+    sampled frames in tracer if it is given.
+    """
+    drained = False
+    try:
+        while True:
+            # Observations from other workers about records this worker owns
+            while not mailbox.empty():
+                queue_changes(update_queue, store.apply(mailbox.get()))
+
+            store.flush_if_due()
+            if tracer is not None:
+                tracer.check_flush(store)
+                tracer.send()
+
+            item = ring.get(timeout=WORKER_POLL_INTERVAL)
+            if item is None:
+                if tracer is not None:
+                    tracer.send(force=True)
+
+                if completion_event.is_set():
+                    break
+
+                continue
+
+            frame, time_recieved, queued_at = item
+            try:
+                if tracer is None:
+                    queue_changes(update_queue, handle_frame(frame, time_recieved, store, worker_metrics))
+                else:
+                    update = trace_frame(frame, time_recieved, store, tracer, worker_metrics)
+                    if update:
+                        update_queue.put(update, block=False)
+            except Exception:
+                frame_failed(store, worker_metrics)
+
+            ring.release()
+            latency.record(time.monotonic() - queued_at)
+
+        # Once every worker is out of packets nothing else can be forwarded,
+        # so whatever is left in the mailbox is the last of it.
+        wait_drained(drained_barrier, store)
+        drained = True
+        while not mailbox.empty():
+            queue_changes(update_queue, store.apply(mailbox.get()))
+
+        store.flush()
+        if tracer is not None:
+            tracer.check_flush(store)
+            tracer.send(force=True)
+
+        report_stats(store, ring)
+    finally:
+        # If this worker died before getting to the barrier the others stop
+        # waiting for it
+        if not drained:
+            drained_barrier.abort()
+
+
+def process_worker(index, partitions, packet_queue, mailboxes, drained_barrier, completion_event,
+                   result_queue, config, last_conn_id=0):
+    """
+    Entry point of a worker process. Same as process_packets but frames come
+    in batches and state changes go back to the parent in batches.
+    """
+    latency = LatencyHistogram()
+    drained = threading.Event()
+    try:
+        run_worker(index, partitions, packet_queue, mailboxes, drained_barrier, drained, completion_event,
+                   result_queue, config, last_conn_id, latency)
+    finally:
+        # If this worker died before getting to the barrier the others stop
+        # waiting for it
+        if not drained.is_set():
+            drained_barrier.abort()
+
+        # Tells the forwarder this worker is done
+        result_queue.put(latency)
+
+
+def run_worker(index, partitions, packet_queue, mailboxes, drained_barrier, drained, completion_event,
+               result_queue, config, last_conn_id, latency):
+    """
+    The loop of a worker process. Sets drained once it is past
+    drained_barrier.
+    """
+    store = make_store(config, index, partitions, mailboxes, last_conn_id)
+    mailbox = mailboxes[index]
+
+    worker_metrics = None
+    if config.get("metrics", constants.DEFAULT_METRICS):
+        worker_metrics = WorkerMetrics(index)
+        worker_metrics.latency = latency
+    metrics_sent = time.monotonic()
+
+    # The trace file belongs to the parent so records are sent there
+    tracer = None
+    if config.get("trace", constants.DEFAULT_TRACE) is not None:
+        tracer = trace.FrameTracer(
+            index,
+            lambda records: result_queue.put(trace.TraceRecords(records)),
+            config.get("trace_sample", constants.DEFAULT_TRACE_SAMPLE),
+            config.get("trace_slow", constants.DEFAULT_TRACE_SLOW)
+        )
+
+    sampler = None
+    if config.get("profile", constants.DEFAULT_PROFILE) is not None:
+        sampler = trace.StackSampler(prefix="worker-{};".format(index))
+        sampler.start()
+
+    while True:
+        changes = drain_mailbox(mailbox, store)
+        store.flush_if_due()
+        if tracer is not None:
+            tracer.check_flush(store)
+            tracer.send()
+
+        try:
+            batch = packet_queue.get(timeout=WORKER_POLL_INTERVAL)
+        except queue.Empty:
+            queue_changes(result_queue, changes)
+            if tracer is not None:
+                tracer.send(force=True)
+
+            if completion_event.is_set():
+                break
+
+            continue
+
+        if tracer is None:
+            for frame, time_recieved, _ in batch:
+                try:
+                    changes.extend(handle_frame(frame, time_recieved, store, worker_metrics))
+                except Exception:
+                    frame_failed(store, worker_metrics)
+
+            queue_changes(result_queue, changes)
+        else:
+            # Changes are serialized per frame when tracing so that shows
+            # up in the trace
+            queue_changes(result_queue, changes)
+            update = {}
+            for frame, time_recieved, _ in batch:
+                try:
+                    traced = trace_frame(frame, time_recieved, store, tracer, worker_metrics)
+                except Exception:
+                    frame_failed(store, worker_metrics)
+                    continue
+
+                for class_name, objects in traced.items():
+                    update.setdefault(class_name, []).extend(objects)
+
+            if update:
+                result_queue.put(update)
+
+        # time.monotonic() is system wide so the parent's dispatch times can
+        # be compared with it
+        now = time.monotonic()
+        for _, _, queued_at in batch:
+            latency.record(now - queued_at)
+
+        if worker_metrics is not None and now - metrics_sent >= METRICS_INTERVAL:
+            send_metrics(result_queue, worker_metrics, store)
+            metrics_sent = now
+
+    # Make sure everything this worker forwarded has actually been written to
+    # the other workers' mailboxes before saying it is done.
+    for i, other in enumerate(mailboxes):
+        if i != index:
+            other.close()
+            other.join_thread()
+    # Nothing can be forwarded now. What is left can only evict stations,
+    # and the other workers are done with their connections anyway.
+    store.mailboxes = None
+
+    wait_drained(drained_barrier, store)
+    drained.set()
+    queue_changes(result_queue, drain_mailbox(mailbox, store))
+    store.flush()
+    report_stats(store)
+
+    if worker_metrics is not None:
+        send_metrics(result_queue, worker_metrics, store)
+
+    if tracer is not None:
+        tracer.check_flush(store)
+        tracer.send(force=True)
+
+    if sampler is not None:
+        result_queue.put(sampler.stop())
+
+
+def frame_failed(store, worker_metrics):
+    """
+    Logs what a frame's decoder or handler raised and counts the frame as
+    malformed, so that one bad frame doesn't take its worker down
+    """
+    log.exception("partition %d: couldn't handle a frame", store.partition)
+    if worker_metrics is not None:
+        worker_metrics.malformed += 1
+
+
+def wait_drained(drained_barrier, store):
+    """
+    Waits for every worker to run out of frames. If one of them died the
+    barrier is broken, and this worker finishes up without it.
+    """
+    try:
+        drained_barrier.wait()
+    except threading.BrokenBarrierError:
+        log.error("partition %d: a worker died, observations it forwarded may be lost", store.partition)
+
+
+def send_metrics(result_queue, worker_metrics, store):
+    """
+    Sends a copy of a worker process's metrics to the parent
+    """
+    worker_metrics.copy_store_stats(store)
+    result_queue.put(worker_metrics)
+
+
+def drain_mailbox(mailbox, store):
+    """
+    Applies every observation waiting in a multiprocessing mailbox. Returns
+    the resulting state changes.
+    """
+    changes = []
+    while True:
+        try:
+            changes.extend(store.apply(mailbox.get_nowait()))
+        except queue.Empty:
+            return changes
+
+
+def forward_results(result_queue, update_queue, num_workers, latency, worker_metrics, stacks,
+                    trace_writer=None):
+    """
+    Moves updates from the worker processes onto the update queue until every
+    worker has finished. Each worker's LatencyHistogram, which it sends when
+    it is done, is merged into latency. WorkerMetrics the workers send replace
+    their entry in worker_metrics, profiled stacks are added to stacks and
+    trace records are written to trace_writer.
+    """
+    finished = 0
+    while finished < num_workers:
+        update = result_queue.get()
+        if isinstance(update, LatencyHistogram):
+            latency.merge(update)
+            finished += 1
+        elif isinstance(update, WorkerMetrics):
+            worker_metrics[update.worker] = update
+        elif isinstance(update, trace.TraceRecords):
+            trace_writer.write(update)
+        elif isinstance(update, trace.StackCounts):
+            stacks.update(update)
+        else:
+            update_queue.put(update, block=False)
+
+
+def handle_frame(raw, time_recieved, store, worker_metrics=None):
+    """
+    Decodes a raw frame and runs it through its handler, after aging out idle
+    connections if that is due. Data frames that repeat a recent one are
+    skipped without being decoded. Returns the resulting state changes. If
+    worker_metrics is given the frame and the time its handler took are
+    recorded in it.
+    """
+    changes = []
+    if time_recieved >= store.next_aging:
+        changes = store.age_connections(time_recieved)
+
+    if is_duplicate(raw, time_recieved, store):
+        return changes
+
+    try:
+        frame = wmap_frame.decode(raw)
+        handler = handlers.get_handler(frame.type, frame.subtype)
+    except ValueError:
+        # Malformed frame or a frame type we don't know about
+        if worker_metrics is not None:
+            worker_metrics.malformed += 1
+
+        return changes
+
+    if worker_metrics is None:
+        changes.extend(handler(frame, time_recieved, store))
+        return changes
+
+    start = time.perf_counter()
+    changes.extend(handler(frame, time_recieved, store))
+    worker_metrics.record(frame.type, frame.subtype, handler.__name__, time.perf_counter() - start)
+
+    return changes
+
+
+def trace_frame(raw, time_recieved, store, tracer, worker_metrics=None):
+    """
+    Same as handle_frame but times decoding, handling and serializing the
+    changes, and gives them to the tracer. Returns the changes grouped by
+    object type, ready for the update queue. Skipped duplicates aren't traced.
+    """
+    changes = []
+    if time_recieved >= store.next_aging:
+        changes = store.age_connections(time_recieved)
+
+    if is_duplicate(raw, time_recieved, store):
+        return group_changes(changes)
+
+    start = time.perf_counter()
+    try:
+        frame = wmap_frame.decode(raw)
+        handler = handlers.get_handler(frame.type, frame.subtype)
+    except ValueError:
+        if worker_metrics is not None:
+            worker_metrics.malformed += 1
+
+        return group_changes(changes)
+
+    decoded = time.perf_counter()
+    changes.extend(handler(frame, time_recieved, store))
+    handled = time.perf_counter()
+    update = group_changes(changes)
+    serialized = time.perf_counter()
+
+    if worker_metrics is not None:
+        worker_metrics.record(frame.type, frame.subtype, handler.__name__, handled - decoded)
+
+    tracer.frame(time_recieved, frame, len(raw), decoded - start, handled - decoded, serialized - handled,
+                 len(changes))
+
+    return update
+
+
+def is_duplicate(raw, time_recieved, store):
+    """
+    True if raw is a data frame that repeats one handled less than the
+    duplicate window ago, so it can be skipped
+    """
+    if store.duplicates is None:
+        return False
+
+    flow = wmap_frame.flow_key(raw)
+    if flow is None:
+        return False
+
+    if store.duplicates.check(flow[0], flow[1], time_recieved):
+        store.refresh_flow(flow[0], time_recieved)
+        return True
+
+    store.track_flow(flow[0])
+    return False
+
+
+def group_changes(changes):
+    """
+    Groups state changes by object type, as dicts
+    """
+    update = {}
+    for change in changes:
+        class_name = change.objtype.class_name
+        if class_name not in update:
+            update[class_name] = []
+
+        update[class_name].append(change.to_dict())
+
+    return update
+
+
+def queue_changes(update_queue, changes):
+    """
+    Groups state changes by object type and places them on the update queue
+    """
+    if len(changes) > 0:
+        update_queue.put(group_changes(changes), block=False)
+